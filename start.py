@@ -9,25 +9,40 @@
 # all dependencies (Python, FFmpeg, Spleeter, etc.) are properly installed.
 # --------------------------------------------------------------------------
 
+import time
+
+# Measured from the very first import, reported by /status
+_started = time.time()
+
+import functools
+import json
 import logging
+import mimetypes
+import multiprocessing
+import queue
 import threading
 import os
-import subprocess
+import re
+import signal
+import socket
 import sys
+import uuid
 
 # Janis Rubins step 2:
 # Here we import Flask and relevant modules for creating a web server,
 # handling file uploads, returning JSON, and so on.
-from flask import Flask, request, render_template, jsonify, send_from_directory
+from flask import Flask, Request, Response, request, render_template, jsonify, send_from_directory, stream_with_context
+from flask.logging import default_handler
+from werkzeug.security import safe_join
 
 # Janis Rubins step 3:
 # We import gevent WSGIServer for production-level serving, and use a
 # custom request handler to override some default behaviors.
-from gevent.pywsgi import WSGIServer, WSGIHandler
+from gevent.pywsgi import WSGIServer
 
 # Janis Rubins step 4:
 # RotatingFileHandler for logging to file with a maximum size and backups.
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 # Janis Rubins step 5:
 # Importing local modules from 'vocal' directory. 'cfg' is config, 'tool'
@@ -37,13 +52,16 @@ from vocal import cfg, tool
 from vocal.cfg import ROOT_DIR
 
 # Janis Rubins step 6:
-# Spleeter is the library to separate audio into stems.
-from spleeter.separator import Separator
+# Spleeter is the library to separate audio into stems. The models registry
+# keeps one warm Separator per model so requests don't rebuild the graph.
+from vocal import cache, decode, janitor, jobs, media, metrics, models, modelserver, separation, serve, \
+    singleflight, transcode, uploads
 
 # Janis Rubins step 7:
 # Create a custom request handler to disable default request logging,
 # since we'll use our own extensive logging approach.
-class CustomRequestHandler(WSGIHandler):
+# File responses are sent with os.sendfile, see serve.SendfileHandler.
+class CustomRequestHandler(serve.SendfileHandler):
     def log_request(self):
         # We override this method to avoid noisy default logs.
         pass
@@ -57,14 +75,34 @@ log.handlers[:] = []
 log.setLevel(logging.WARNING)
 
 # Janis Rubins step 9:
-# Initialize the Flask application. We define static_folder and
-# template_folder as sub-directories of ROOT_DIR for a consistent structure.
+# Initialize the Flask application. We define template_folder as a
+# sub-directory of ROOT_DIR for a consistent structure. Flask's own static
+# route is disabled, static_files() below serves cfg.STATIC_DIR instead.
 app = Flask(
     __name__,
-    static_folder=os.path.join(ROOT_DIR, 'static'),
-    static_url_path='/static',
+    static_folder=None,
     template_folder=os.path.join(ROOT_DIR, 'templates')
 )
+# Let Apache/lighttpd send files when they front us (X-Sendfile)
+app.config['USE_X_SENDFILE'] = cfg.USE_X_SENDFILE
+
+# Uploads to /upload and /api are piped into the decoder while the
+# multipart body is still being parsed, see decode.StreamDecoder.
+class StreamingRequest(Request):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # before the body is read, so upload timings include receiving it
+        self.started = time.perf_counter()
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if filename and self.path in ('/upload', '/api'):
+            ext = os.path.splitext(filename)[1].lower()
+            if ext in decode.STREAMABLE:
+                return decode.StreamDecoder(ext, cfg.TMP_DIR)
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+
+app.request_class = StreamingRequest
 
 # Janis Rubins step 10:
 # We configure the "root" logger to ensure it won't print too much, as
@@ -74,9 +112,9 @@ root_log.handlers = []
 root_log.setLevel(logging.WARNING)
 
 # Janis Rubins step 11:
-# We set the Flask app’s logger level to WARNING. Later, we’ll attach
-# RotatingFileHandler to store logs in a file if needed.
-app.logger.setLevel(logging.WARNING)
+# We set the Flask app’s logger level from cfg.LOG_LEVEL (WARNING by
+# default), so debug calls are dropped before any handler runs.
+app.logger.setLevel(cfg.LOG_LEVEL)
 
 # Janis Rubins step 12:
 # Configure RotatingFileHandler. We store logs in 'vocal.log' with a max
@@ -88,29 +126,51 @@ file_handler = RotatingFileHandler(
 )
 
 # Janis Rubins step 13:
-# Format for the logs. This includes timestamp, module, log level,
-# and the actual message.
-formatter = logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Format for the logs: one JSON object per line (timestamp, logger, level,
+# message and any extra fields), or plain text with VOCAL_LOG_FORMAT=text.
+if cfg.LOG_FORMAT == 'text':
+    formatter = logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+else:
+    formatter = tool.JsonFormatter()
 
 # Janis Rubins step 14:
-# Set up the level and the formatter for our file handler, then add it
-# to the Flask app’s logger.
+# Set up the level and the formatter for our file handler.
 file_handler.setLevel(logging.WARNING)
 file_handler.setFormatter(formatter)
-app.logger.addHandler(file_handler)
 
 # Janis Rubins step 15:
-# Add a second logger for console output with a deep logging approach.
-# This ensures we see detailed logs in the terminal as well.
+# Add a second handler for console output. Neither handler runs on the
+# request path: app.logger only puts records on a queue and a background
+# listener thread formats and writes them. Records below WARNING are
+# sampled at cfg.LOG_SAMPLE so busy nodes don't drown in debug lines.
 console_handler = logging.StreamHandler(sys.stdout)
 console_handler.setLevel(logging.DEBUG)
-console_formatter = logging.Formatter(
-    '[%(asctime)s] [%(levelname)s] %(message)s'
-)
-console_handler.setFormatter(console_formatter)
-app.logger.addHandler(console_handler)
+console_handler.setFormatter(formatter)
+
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+queue_handler.addFilter(tool.SampleFilter(cfg.LOG_SAMPLE))
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(queue_handler)
+# the vocal package logs under its module names, through the same queue
+vocal_log = logging.getLogger('vocal')
+vocal_log.setLevel(cfg.LOG_LEVEL)
+vocal_log.addHandler(queue_handler)
+vocal_log.propagate = False
+log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+log_listener.start()
+
+
+# Seconds from the first import until the server accepts connections
+startup_seconds = None
+
+# Read at scrape time, the rest of the metrics are recorded where they happen
+metrics.Gauge('vocal_queue_depth', 'Separation jobs queued or running', fn=lambda: jobs.job_queue.pending())
+metrics.Gauge('vocal_cache_hit_ratio', 'Result cache hit ratio', fn=lambda: cache.result_cache.stats()['hit_ratio'])
+metrics.Gauge('vocal_startup_seconds', 'Seconds from import until the server accepted connections',
+              fn=lambda: startup_seconds)
 
 
 # --------------------------------------------------------------------------
@@ -120,11 +180,23 @@ app.logger.addHandler(console_handler)
 def static_files(filename):
     """
     Janis Rubins step 16:
-    This route serves static files from the specified static folder.
-    We add a debug log so we can see whenever a static file is requested.
+    This route serves static files from the static folder. Responses
+    support byte ranges, ETag/Last-Modified and 304s, and the body is sent
+    with sendfile. Stems under files/ live in content-addressed folders,
+    so they may be cached for long. With cfg.ACCEL_REDIRECT set, files/
+    and tmp/ are handed to the front proxy (nginx X-Accel-Redirect).
     """
-    app.logger.debug(f'[static_files] Request for static file: {filename}')
-    return send_from_directory(app.config['STATIC_FOLDER'], filename)
+    # uploads and stems may live elsewhere (shared storage), see cfg.DATA_DIR
+    directory = cfg.DATA_DIR if filename.startswith(('files/', 'tmp/')) else cfg.STATIC_DIR
+    if cfg.ACCEL_REDIRECT and filename.startswith(('files/', 'tmp/')):
+        path = safe_join(directory, filename)
+        if path is None or not os.path.isfile(path):
+            return jsonify({"code": 1, "msg": f"{filename} {cfg.transobj['lang5']}"}), 404
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{cfg.ACCEL_REDIRECT.rstrip('/')}/{filename}"
+        return response
+    max_age = cfg.STATIC_MAX_AGE if filename.startswith('files/') else None
+    return send_from_directory(directory, filename, max_age=max_age)
 
 
 # --------------------------------------------------------------------------
@@ -141,12 +213,132 @@ def index():
     return render_template(
         "index.html",
         version=vocal.version_str,
-        cuda=cfg.cuda,
+        cuda=cfg.probe_cuda(wait=False),
         language=cfg.LANG,
         root_dir=ROOT_DIR.replace('\\', '/')
     )
 
 
+# --------------------------------------------------------------------------
+# INGEST HELPERS
+# --------------------------------------------------------------------------
+class IngestError(Exception):
+    """Raised when an uploaded file cannot be turned into a WAV."""
+
+
+UPLOAD_EXTS = ['.mp4', '.mov', '.avi', '.mkv', '.mpeg', '.mp3', '.flac', '.wav']
+
+
+def _ingest(audio_file, tag):
+    """Store an upload, see _store_upload(), and record its size and timing."""
+    result = _store_upload(audio_file, tag)
+    metrics.upload_seconds.observe(time.perf_counter() - request.started)
+    metrics.upload_bytes.observe(getattr(audio_file.stream, 'size', None) or request.content_length or 0)
+    return result
+
+
+def _store_upload(audio_file, tag):
+    """
+    Save an uploaded file under the hash of its content and convert it to
+    WAV if needed. Streamable formats were already decoded while the body
+    was parsed; mp4/mov/avi are written to disk once and converted.
+    Returns (wav_name, converted). The same content always maps to the
+    same '<digest>.wav', so re-uploads under another name are served from
+    the result cache and different songs with the same file name never
+    collide. Concurrent uploads of the same content are converted once.
+    """
+    _, ext = os.path.splitext(audio_file.filename)
+    ext = ext.lower()
+    if ext not in UPLOAD_EXTS:
+        raise IngestError(f"{cfg.transobj['lang3']} {ext}")  # e.g. "Unsupported format"
+
+    if isinstance(audio_file.stream, decode.StreamDecoder):
+        # Already decoded while the body arrived, no original on disk
+        try:
+            digest, wav_part = tool.offload(audio_file.stream.finish)
+        except RuntimeError as e:
+            raise IngestError(str(e))
+        app.logger.debug(f'[{tag}] {audio_file.filename} has digest {digest}, decoded while uploading')
+        return _store_decoded(digest, wav_part, ext)
+
+    # Hash the upload while writing it to a unique temporary name
+    part_file = os.path.join(cfg.TMP_DIR, f'{uuid.uuid4().hex}{ext}.part')
+    digest = cache.hash_stream(audio_file.stream, part_file)
+    app.logger.debug(f'[{tag}] {audio_file.filename} has digest {digest}')
+    return _store_original(part_file, digest, ext, tag, request.form.get('upload_id') or None)
+
+
+def _store_decoded(digest, wav_part, ext):
+    """Keep a WAV decoded while uploading as '<digest>.wav'. Returns (wav_name, converted)."""
+    wav_file = os.path.join(cfg.TMP_DIR, f'{digest}.wav')
+    if cache.result_cache.lookup_wav(digest):
+        os.remove(wav_part)
+        return os.path.basename(wav_file), False
+    os.replace(wav_part, wav_file)
+    cache.result_cache.add_wav(digest, wav_file)
+    return os.path.basename(wav_file), ext != '.wav'
+
+
+def _store_original(part_file, digest, ext, tag, progress_key=None):
+    """
+    Convert an original saved as part_file to '<digest>.wav', then remove
+    it. Returns (wav_name, converted).
+    """
+    wav_file = os.path.join(cfg.TMP_DIR, f'{digest}.wav')
+
+    # Same content already converted, skip FFmpeg entirely
+    if cache.result_cache.lookup_wav(digest):
+        app.logger.debug(f'[{tag}] WAV for {digest} is cached, skipping conversion')
+        os.remove(part_file)
+        return os.path.basename(wav_file), False
+
+    # A WAV already in the models' input format is kept as it is
+    if ext == '.wav' and media.conforms(media.read_wav_header(part_file), *models.input_format()):
+        app.logger.debug(f'[{tag}] {digest} is a WAV in the models\' format, skipping conversion')
+        os.replace(part_file, wav_file)
+        cache.result_cache.add_wav(digest, wav_file)
+        return os.path.basename(wav_file), False
+
+    # Identical uploads arriving together are converted once, the others wait for it
+    try:
+        _, shared = singleflight.conversions.do(digest, _convert, part_file, ext, wav_file, progress_key, tag)
+    finally:
+        # The original is only needed for conversion
+        os.remove(part_file)
+    if shared:
+        app.logger.debug(f'[{tag}] {digest} was converted by a concurrent upload')
+    return os.path.basename(wav_file), True
+
+
+def _convert(source_file, ext, wav_file, progress_key, tag):
+    """
+    Convert source_file to wav_file with FFmpeg, through a unique temporary
+    name so a half written WAV is never visible under its final name. The
+    WAV is resampled and downmixed to the models' input format in the same
+    pass. A client supplied progress_key (upload_id) lets it poll
+    /transcode/<upload_id> for progress.
+    """
+    digest = os.path.splitext(os.path.basename(wav_file))[0]
+    if cache.result_cache.lookup_wav(digest):
+        return wav_file
+    out_part = os.path.join(cfg.TMP_DIR, f'{uuid.uuid4().hex}.wav.part')
+    params = ["-i", source_file]
+    # If not an audio-only file (mp3/flac), remove video track
+    if ext not in ['.mp3', '.flac']:
+        params.append('-vn')
+    params += decode.wav_args(*models.input_format()) + [out_part]
+
+    app.logger.debug(f'[{tag}] Running FFmpeg with params: {params}')
+    rs = tool.runffmpeg(params, key=progress_key)
+    if rs != 'ok':
+        if os.path.exists(out_part):
+            os.remove(out_part)
+        raise IngestError(rs)
+    os.replace(out_part, wav_file)
+    cache.result_cache.add_wav(digest, wav_file)
+    return wav_file
+
+
 # --------------------------------------------------------------------------
 # UPLOAD ROUTE
 # --------------------------------------------------------------------------
@@ -156,60 +348,16 @@ def upload():
     Janis Rubins step 18:
     This route handles file uploads. We take the uploaded file from the
     request, determine if it’s audio or video, and convert to WAV if needed
-    using FFmpeg.
+    using FFmpeg. Files are stored by content hash, see _ingest().
     """
     try:
         app.logger.debug('[upload] Starting file upload process...')
         audio_file = request.files['audio']
-        noextname, ext = os.path.splitext(audio_file.filename)
-        ext = ext.lower()
-        wav_file = os.path.join(cfg.TMP_DIR, f'{noextname}.wav')
-
-        app.logger.debug(f'[upload] Uploaded file name: {audio_file.filename}, '
-                         f'Extension: {ext}, Target WAV path: {wav_file}')
-
-        # If the WAV already exists and has non-zero size, skip reprocessing
-        if os.path.exists(wav_file) and os.path.getsize(wav_file) > 0:
-            app.logger.debug('[upload] WAV file already exists, skipping reprocessing')
-            return jsonify({
-                'code': 0,
-                'msg': cfg.transobj['lang1'],  # e.g. "File uploaded successfully."
-                "data": os.path.basename(wav_file)
-            })
-
-        msg = ""
-        if ext in ['.mp4', '.mov', '.avi', '.mkv', '.mpeg', '.mp3', '.flac']:
-            # Save the uploaded file to a temporary location
-            video_file = os.path.join(cfg.TMP_DIR, f'{noextname}{ext}')
-            audio_file.save(video_file)
-            app.logger.debug(f'[upload] Saved file to: {video_file}')
-
-            # Build FFmpeg params
-            params = [
-                "-i",
-                video_file,
-            ]
-            # If not an audio-only file (mp3/flac), remove video track
-            if ext not in ['.mp3', '.flac']:
-                params.append('-vn')
-            params.append(wav_file)
-
-            app.logger.debug(f'[upload] Running FFmpeg with params: {params}')
-            rs = tool.runffmpeg(params)
-            if rs != 'ok':
-                app.logger.error(f'[upload] FFmpeg error: {rs}')
-                return jsonify({"code": 1, "msg": rs})
-            # e.g. "File uploaded successfully, Video file converted."
-            msg = "," + cfg.transobj['lang9']
-        elif ext == '.wav':
-            # Directly save the WAV
-            audio_file.save(wav_file)
-            app.logger.debug('[upload] Directly saved WAV, no FFmpeg needed')
-        else:
-            # Unsupported file format
-            err_msg = f"{cfg.transobj['lang3']} {ext}"  # e.g. "Unsupported format"
-            app.logger.warning(f'[upload] Unsupported format: {err_msg}')
-            return jsonify({"code": 1, "msg": err_msg})
+        app.logger.debug(f'[upload] Uploaded file name: {audio_file.filename}')
+
+        wav_name, converted = _ingest(audio_file, 'upload')
+        # e.g. "File uploaded successfully, Video file converted."
+        msg = "," + cfg.transobj['lang9'] if converted else ""
 
         # Success
         success_msg = cfg.transobj['lang1'] + msg  # e.g. "File uploaded successfully"
@@ -217,13 +365,214 @@ def upload():
         return jsonify({
             'code': 0,
             'msg': success_msg,
-            "data": os.path.basename(wav_file)
+            "data": wav_name
         })
+    except IngestError as e:
+        app.logger.warning(f'[upload] {e}')
+        return jsonify({"code": 1, "msg": str(e)})
     except Exception as e:
         app.logger.error(f'[upload] Unexpected error: {e}', exc_info=True)
         return jsonify({'code': 2, 'msg': cfg.transobj['lang2']})  # e.g. "An error occurred."
 
 
+# --------------------------------------------------------------------------
+# RESUMABLE UPLOAD ROUTES
+# --------------------------------------------------------------------------
+def _upload_state(upload, status=200):
+    response = jsonify({"code": 0 if status == 200 else 1, "msg": "ok" if status == 200 else "offset",
+                        "data": upload.to_dict()})
+    response.headers['Upload-Offset'] = str(upload.offset)
+    return response, status
+
+
+@app.route('/uploads', methods=['POST'])
+def upload_create():
+    """
+    Start a resumable upload of 'filename', optionally announcing its 'size'
+    in bytes. Returns the upload id and the chunk size to send; the chunks
+    are PUT to /uploads/<id> and the file is stored with
+    /uploads/<id>/finalize.
+    """
+    data = request.get_json(silent=True) or request.form
+    filename = os.path.basename(str(data.get('filename') or '').strip())
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in UPLOAD_EXTS:
+        return jsonify({"code": 1, "msg": f"{cfg.transobj['lang3']} {ext}"})
+    try:
+        size = int(data['size']) if str(data.get('size') or '').strip() else None
+    except ValueError:
+        return jsonify({"code": 1, "msg": "size must be a number of bytes"})
+    upload = uploads.store.create(filename, size)
+    app.logger.debug(f'[uploads] {upload.id} started for {filename} ({size} bytes)')
+    return jsonify({"code": 0, "msg": "ok", "data": {**upload.to_dict(), "chunk_size": cfg.UPLOAD_CHUNK_MB * 1024 * 1024}})
+
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """Bytes received so far (also in the Upload-Offset header), to resume from."""
+    try:
+        upload = uploads.store.get(upload_id)
+    except uploads.UploadNotFound:
+        return jsonify({"code": 1, "msg": f"{upload_id} {cfg.transobj['lang5']}"}), 404
+    upload.refresh()
+    return _upload_state(upload)
+
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_put(upload_id):
+    """
+    Append the request body at the offset given in the Upload-Offset header
+    (or ?offset=). The body goes to disk, and into the decoder, as it
+    arrives. A chunk that doesn't start at the current offset gets 409 with
+    the offset to continue from.
+    """
+    try:
+        upload = uploads.store.get(upload_id)
+        offset = int(request.headers.get('Upload-Offset', request.args.get('offset', -1)))
+        upload.write(offset, request.stream)
+    except uploads.UploadNotFound:
+        return jsonify({"code": 1, "msg": f"{upload_id} {cfg.transobj['lang5']}"}), 404
+    except (uploads.OffsetMismatch, uploads.UploadBusy):
+        return _upload_state(upload, 409)
+    except ValueError as e:
+        return jsonify({"code": 1, "msg": str(e)}), 400
+    return _upload_state(upload)
+
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def upload_delete(upload_id):
+    """Abandon an upload and delete what was received."""
+    try:
+        uploads.store.get(upload_id)
+    except uploads.UploadNotFound:
+        return jsonify({"code": 1, "msg": f"{upload_id} {cfg.transobj['lang5']}"}), 404
+    uploads.store.remove(upload_id)
+    return jsonify({"code": 0, "msg": "deleted"})
+
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def upload_finalize(upload_id):
+    """
+    Store a completely received upload like /upload does and answer the
+    same way, with the WAV name in 'data'. Conversion progress of formats
+    that could not be decoded while uploading is at /transcode/<upload_id>.
+    """
+    try:
+        upload = uploads.store.get(upload_id)
+    except uploads.UploadNotFound:
+        return jsonify({"code": 1, "msg": f"{upload_id} {cfg.transobj['lang5']}"}), 404
+    upload.refresh()
+    if not upload.complete:
+        return _upload_state(upload, 409)
+    uploads.store.remove(upload_id, discard=False)
+    try:
+        decoded = tool.offload(upload.decode)
+        if decoded is not None:
+            wav_name, converted = _store_decoded(*decoded, upload.ext)
+        else:
+            digest = tool.offload(upload.digest)
+            wav_name, converted = _store_original(upload.path, digest, upload.ext, 'uploads', upload_id)
+        metrics.upload_bytes.observe(upload.offset)
+    except (IngestError, RuntimeError) as e:
+        app.logger.warning(f'[uploads] {upload_id}: {e}')
+        return jsonify({"code": 1, "msg": str(e)})
+    except Exception as e:
+        app.logger.error(f'[uploads] Unexpected error: {e}', exc_info=True)
+        return jsonify({'code': 2, 'msg': cfg.transobj['lang2']})
+    finally:
+        upload.discard()
+    msg = "," + cfg.transobj['lang9'] if converted else ""
+    return jsonify({'code': 0, 'msg': cfg.transobj['lang1'] + msg, "data": wav_name})
+
+
+# --------------------------------------------------------------------------
+# SEPARATION HELPERS
+# --------------------------------------------------------------------------
+def _tmp_file(name):
+    """static/tmp/<name> when name is a plain file name, which may not exist yet, else None."""
+    if not name or name.startswith('.') or os.path.basename(name) != name:
+        return None
+    return os.path.join(cfg.TMP_DIR, name)
+
+
+def _public_url():
+    # what clients reach this service at, the same for every node behind a load balancer
+    return cfg.PUBLIC_URL or f'http://{cfg.web_address}'
+
+
+def _stem_urls(result, options):
+    """
+    Build the public URL of every stem of a separation result in the codec
+    and bitrate of options, the request's own, which may differ from the
+    job's when the request joined a job or hit the cache. Stems already
+    stored that way are served as static files, the others through
+    /download, which transcodes and caches them on demand.
+    """
+    dirname = result['dirname']
+    outname = os.path.basename(dirname)
+    codec = options.get('codec', 'wav')
+    # a lossy stem stored at another bitrate than asked for is a /download variant
+    bitrate = options.get('bitrate') if transcode.CODECS[codec][1] else None
+    query = f'?bitrate={bitrate}' if bitrate else ''
+    urls = []
+    for stem in dict.fromkeys(os.path.splitext(it)[0] for it in result['files']):
+        if os.path.exists(os.path.join(dirname, f'{stem}.{codec}')) and bitrate in (None, result.get('bitrate')):
+            urls.append(f'{_public_url()}/static/files/{outname}/{stem}.{codec}')
+        else:
+            urls.append(f'{_public_url()}/download/{outname}/{stem}.{codec}{query}')
+    return urls
+
+
+def _options(form):
+    # Optional separation settings shared by /process, /api and /jobs
+    options = {}
+    if form.get('segment', '').strip():
+        options['segment'] = float(form['segment'])
+    codec = form.get('codec', '').strip().lower()
+    if codec:
+        if codec not in transcode.CODECS:
+            raise ValueError(f"{cfg.transobj['lang3']} {codec}")
+        options['codec'] = codec
+    if form.get('bitrate', '').strip():
+        options['bitrate'] = _bitrate(form['bitrate'].strip())
+    return options
+
+
+def _submit_separation(wav_file, model, options=None):
+    """
+    Queue a separation job, or return an already finished one when the
+    stems for this content and model are in the result cache. Raises
+    jobs.QueueFull when the queue has no room.
+    """
+    digest = os.path.splitext(os.path.basename(wav_file))[0]
+    dirname = os.path.join(cfg.FILES_DIR, f'{digest}-{model}')
+    spec = {'wav_file': wav_file, 'model': model, 'dirname': dirname, **(options or {})}
+
+    cached = cache.result_cache.lookup_stems(digest, model)
+    if cached:
+        app.logger.debug(f'[separation] Cache hit for {digest} with {model}')
+        return jobs.job_queue.completed(spec, {'dirname': cached, 'files': separation.list_stems(cached)})
+
+    # Keyed by output directory: a request for the same content and model
+    # while it is being separated joins that job instead of writing alongside
+    job = jobs.job_queue.submit(spec, on_done=functools.partial(janitor.separation_done, digest, model), key=dirname)
+    app.logger.debug(f'[separation] Submitted job {job.id} for {wav_file} with {model}')
+    return job
+
+
+def _run_separation(wav_file, model, options=None):
+    """
+    Separate wav_file and wait for the result without blocking the gevent
+    server. Returns the finished job. Every queue's wait() polls with
+    tool.sleep, at the pace its backend affords (the shared SQLite store
+    every jobstore.POLL seconds), and holds none of the hub's few threads.
+    """
+    job = _submit_separation(wav_file, model, options)
+    if job.status in jobs.FINISHED:
+        return job
+    return jobs.job_queue.wait(job.id)
+
+
 # --------------------------------------------------------------------------
 # PROCESS ROUTE
 # --------------------------------------------------------------------------
@@ -232,69 +581,39 @@ def process():
     """
     Janis Rubins step 19:
     This route processes the WAV file with Spleeter, splitting it into
-    different stems (vocals, accompaniment, drums, etc.).
+    different stems (vocals, accompaniment, drums, etc.). The separation
+    itself runs on the job queue; this route just waits for the result.
     """
     try:
         app.logger.debug('[process] Starting process route...')
         wav_name = request.form.get("wav_name", "").strip()
         model = request.form.get("model", "").strip()
-        wav_file = os.path.join(cfg.TMP_DIR, wav_name)
-        noextname = wav_name[:-4] if wav_name.lower().endswith('.wav') else wav_name
+        wav_file = _tmp_file(wav_name)
+        if wav_file is None:
+            return jsonify({"code": 1, "msg": f"{wav_name} {cfg.transobj['lang5']}"}), 400
 
         app.logger.debug(f'[process] Received wav_name: {wav_name}, model: {model}')
         app.logger.debug(f'[process] Constructed wav_file path: {wav_file}')
 
         # Check if the WAV file exists
         if not os.path.exists(wav_file):
-            err_msg = f"{wav_file} {cfg.langlist['lang5']}"  # e.g. "File not found."
+            err_msg = f"{wav_file} {cfg.transobj['lang5']}"  # e.g. "File not found."
             app.logger.error(f'[process] WAV file does not exist: {err_msg}')
             return jsonify({"code": 1, "msg": err_msg})
 
         # Check if the model exists
-        if not os.path.exists(os.path.join(cfg.MODEL_DIR, model, 'model.meta')):
+        if not models.model_exists(model):
             err_msg = f"{model} {cfg.transobj['lang4']}"  # e.g. "Model does not exist."
             app.logger.error(f'[process] Model does not exist: {err_msg}')
             return jsonify({"code": 1, "msg": err_msg})
 
-        # Use ffprobe to get duration
-        try:
-            app.logger.debug('[process] Using ffprobe to detect WAV duration...')
-            p = subprocess.run(
-                [
-                    'ffprobe', '-v', 'error',
-                    '-show_entries', 'format=duration',
-                    '-of', 'default=noprint_wrappers=1:nokey=1',
-                    wav_file
-                ],
-                capture_output=True,
-                check=False
-            )
-            if p.returncode == 0:
-                sec = float(p.stdout)
-            else:
-                app.logger.warning('[process] ffprobe did not return 0, setting sec=1800')
-                sec = 1800.0
-        except Exception as e_ffprobe:
-            app.logger.warning(f'[process] ffprobe exception: {e_ffprobe}, setting sec=1800', exc_info=True)
-            sec = 1800.0
-
-        app.logger.debug(f'[process] Audio duration (sec): {sec}')
-
-        # Initialize Spleeter Separator
-        separator = Separator(f'spleeter:{model}', multiprocess=False)
-        dirname = os.path.join(cfg.FILES_DIR, noextname)
-
-        app.logger.debug(f'[process] Output directory: {dirname}')
-        os.makedirs(dirname, exist_ok=True)
-
-        # Separate audio
+        # Separate audio on the worker pool
         app.logger.debug('[process] Starting spleeter separation...')
-        separator.separate_to_file(
-            wav_file,
-            destination=dirname,
-            filename_format="{instrument}.{codec}",
-            duration=sec
-        )
+        options = _options(request.form)
+        job = _run_separation(wav_file, model, options)
+        if job.status != jobs.DONE:
+            app.logger.error(f'[process] Job {job.id} ended as {job.status}: {job.error}')
+            return jsonify({"code": 1, "msg": job.error or cfg.transobj['lang7']})
         app.logger.debug('[process] Spleeter separation completed.')
 
         # Mapping for the separated stems, now in English
@@ -307,28 +626,24 @@ def process():
             "other":         "other"
         }
 
-        data = []
-        urllist = []
-        for it in os.listdir(dirname):
-            if it.endswith('.wav'):
-                app.logger.debug(f'[process] Found separated track: {it}')
-                instrument_name = it[:-4]  # e.g. "accompaniment", "vocals", etc.
-                # If the user’s language is not 'en', they may have some other logic,
-                # but we remove all Chinese text here and keep it in English:
-                display_name = status.get(instrument_name, instrument_name)
-                data.append(display_name)
-
-                # Build the URL to the separated WAV
-                track_url = f'http://{cfg.web_address}/static/files/{noextname}/{it}'
-                urllist.append(track_url)
+        files = job.result['files']
+        # e.g. "accompaniment", "vocals", etc.
+        stems = list(dict.fromkeys(os.path.splitext(it)[0] for it in files))
+        data = [status.get(it, it) for it in stems]
+        urllist = _stem_urls(job.result, options)
 
         return jsonify({
             "code": 0,
             "msg": cfg.transobj['lang6'],  # e.g. "Separation completed."
             "data": data,
             "urllist": urllist,
-            "dirname": dirname
+            "dirname": job.result['dirname'],
+            # waveform peaks and preview clips, see /peaks
+            "peaks": f"/peaks/{os.path.basename(job.result['dirname'])}"
         })
+    except jobs.QueueFull as e:
+        app.logger.warning(f'[process] Queue full: {e}')
+        return jsonify({"code": 1, "msg": str(e)}), 429
     except Exception as e:
         app.logger.error(f'[process] Unexpected error: {e}', exc_info=True)
         return jsonify({"code": 1, "msg": str(e)})
@@ -349,87 +664,25 @@ def api():
         audio_file = request.files['file']
         model = request.form.get("model", "").strip()
 
-        noextname, ext = os.path.splitext(audio_file.filename)
-        ext = ext.lower()
-        wav_file = os.path.join(cfg.TMP_DIR, f'{noextname}.wav')
-
-        app.logger.debug(f'[api] Received file: {audio_file.filename}, '
-                         f'Model: {model}, WAV path: {wav_file}')
-
-        # Only process if the WAV doesn't exist or is empty
-        if not os.path.exists(wav_file) or os.path.getsize(wav_file) == 0:
-            # If it’s a known video or audio format, convert to WAV
-            if ext in ['.mp4', '.mov', '.avi', '.mkv', '.mpeg', '.mp3', '.flac']:
-                video_file = os.path.join(cfg.TMP_DIR, f'{noextname}{ext}')
-                audio_file.save(video_file)
-                app.logger.debug(f'[api] Saved file to: {video_file}')
-
-                params = ["-i", video_file]
-                if ext not in ['.mp3', '.flac']:
-                    params.append('-vn')
-                params.append(wav_file)
-
-                app.logger.debug(f'[api] Running FFmpeg: {params}')
-                rs = tool.runffmpeg(params)
-                if rs != 'ok':
-                    app.logger.error(f'[api] FFmpeg error: {rs}')
-                    return jsonify({"code": 1, "msg": rs})
-            elif ext == '.wav':
-                audio_file.save(wav_file)
-                app.logger.debug('[api] File is WAV, saved directly')
-            else:
-                err_msg = f"{cfg.transobj['lang3']} {ext}"  # e.g. "Unsupported format"
-                app.logger.warning(f'[api] Unsupported format: {err_msg}')
-                return jsonify({"code": 1, "msg": err_msg})
-
-        # Double-check that WAV now exists
-        if not os.path.exists(wav_file):
-            err_msg = f"{wav_file} {cfg.langlist['lang5']}"  # e.g. "File not found."
-            app.logger.error(f'[api] WAV file does not exist after conversion: {err_msg}')
-            return jsonify({"code": 1, "msg": err_msg})
+        app.logger.debug(f'[api] Received file: {audio_file.filename}, Model: {model}')
 
         # Check if the model is valid
-        if not os.path.exists(os.path.join(cfg.MODEL_DIR, model, 'model.meta')):
+        if not models.model_exists(model):
             err_msg = f"{model} {cfg.transobj['lang4']}"  # e.g. "Model does not exist."
             app.logger.error(f'[api] Model not found: {err_msg}')
             return jsonify({"code": 1, "msg": err_msg})
 
-        # Attempt ffprobe to get duration
-        try:
-            app.logger.debug('[api] Running ffprobe to detect WAV duration...')
-            p = subprocess.run(
-                [
-                    'ffprobe', '-v', 'error',
-                    '-show_entries', 'format=duration',
-                    '-of', 'default=noprint_wrappers=1:nokey=1',
-                    wav_file
-                ],
-                capture_output=True,
-                check=False
-            )
-            if p.returncode == 0:
-                sec = float(p.stdout)
-            else:
-                app.logger.warning('[api] ffprobe returned a non-zero exit code. Setting sec=1800.')
-                sec = 1800.0
-        except Exception as e_ffprobe:
-            app.logger.warning(f'[api] ffprobe exception: {e_ffprobe}, setting sec=1800', exc_info=True)
-            sec = 1800.0
-
-        app.logger.debug(f'[api] Audio duration: {sec}')
-
-        # Spleeter separation
-        separator = Separator(f'spleeter:{model}', multiprocess=False)
-        dirname = os.path.join(cfg.FILES_DIR, noextname)
-        os.makedirs(dirname, exist_ok=True)
+        # Save by content hash and convert to WAV if needed
+        wav_name, _ = _ingest(audio_file, 'api')
+        wav_file = os.path.join(cfg.TMP_DIR, wav_name)
 
+        # Spleeter separation on the worker pool
         app.logger.debug('[api] Starting Spleeter separation...')
-        separator.separate_to_file(
-            wav_file,
-            destination=dirname,
-            filename_format="{instrument}.{codec}",
-            duration=sec
-        )
+        options = _options(request.form)
+        job = _run_separation(wav_file, model, options)
+        if job.status != jobs.DONE:
+            app.logger.error(f'[api] Job {job.id} ended as {job.status}: {job.error}')
+            return jsonify({"code": 1, "msg": job.error or cfg.transobj['lang7']})
         app.logger.debug('[api] Spleeter separation completed.')
 
         # Build the status dictionary in English:
@@ -442,12 +695,8 @@ def api():
             "other.wav":         "other audio"
         }
 
-        urllist = []
-        for it in os.listdir(dirname):
-            if it.endswith('.wav'):
-                track_url = f'http://{cfg.web_address}/static/files/{noextname}/{it}'
-                urllist.append(track_url)
-                app.logger.debug(f'[api] Found separated track: {it}, URL: {track_url}')
+        urllist = _stem_urls(job.result, options)
+        app.logger.debug(f'[api] Separated tracks: {urllist}')
 
         return jsonify({
             "code": 0,
@@ -455,11 +704,592 @@ def api():
             "data": urllist,
             "status_text": status
         })
+    except IngestError as e:
+        app.logger.warning(f'[api] {e}')
+        return jsonify({"code": 1, "msg": str(e)})
+    except jobs.QueueFull as e:
+        app.logger.warning(f'[api] Queue full: {e}')
+        return jsonify({"code": 1, "msg": str(e)}), 429
     except Exception as e:
         app.logger.error(f'[api] Unexpected error: {e}', exc_info=True)
         return jsonify({'code': 2, 'msg': cfg.transobj['lang2']})  # e.g. "An error occurred."
 
 
+# --------------------------------------------------------------------------
+# WAVEFORM ROUTE
+# --------------------------------------------------------------------------
+@app.route('/waveform', methods=['POST'])
+def waveform_api():
+    """
+    Separate a waveform sent as the request body and stream the stems back
+    without writing anything to disk. The body is raw interleaved PCM
+    (?format=f32le|s16le&channels=1|2, 44.1kHz) or a NumPy .npy array
+    (Content-Type: application/x-npy). ?output=zip (default) answers with a
+    zip of <instrument>.wav, ?output=multipart with a multipart/mixed body
+    holding one raw PCM part per stem, in the input format.
+    """
+    from vocal import waveform
+    model = request.args.get('model', '').strip()
+    output = request.args.get('output', 'zip')
+    fmt = request.args.get('format', 'f32le')
+    if not models.model_exists(model):
+        return jsonify({"code": 1, "msg": f"{model} {cfg.transobj['lang4']}"})
+    if output not in ('zip', 'multipart'):
+        return jsonify({"code": 1, "msg": f"unsupported output {output}"}), 400
+    try:
+        sample_rate = int(request.args.get('sample_rate', waveform.SAMPLE_RATE))
+        if sample_rate != waveform.SAMPLE_RATE:
+            raise ValueError(f'sample rate must be {waveform.SAMPLE_RATE}')
+        if request.mimetype == 'application/x-npy':
+            samples = waveform.from_npy(request.get_data(cache=False))
+        else:
+            samples = waveform.from_pcm(request.get_data(cache=False), fmt, int(request.args.get('channels', 2)))
+    except ValueError as e:
+        return jsonify({"code": 1, "msg": str(e)}), 400
+
+    try:
+        result = jobs.job_queue.run({'kind': 'waveform', 'model': model, 'waveform': samples})
+    except jobs.QueueFull as e:
+        app.logger.warning(f'[waveform] Queue full: {e}')
+        return jsonify({"code": 1, "msg": str(e)}), 429
+    except Exception as e:
+        app.logger.error(f'[waveform] Separation failed: {e}', exc_info=True)
+        return jsonify({"code": 1, "msg": cfg.transobj['lang7']}), 500
+
+    if output == 'multipart':
+        boundary = uuid.uuid4().hex
+        pcm = fmt if fmt in waveform.FORMATS else 'f32le'
+        return Response(waveform.stream_multipart(result['stems'], boundary, pcm),
+                        mimetype=f'multipart/mixed; boundary={boundary}')
+    return Response(waveform.stream_zip(result['stems']), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=stems.zip'})
+
+
+# --------------------------------------------------------------------------
+# STREAMING ROUTE
+# --------------------------------------------------------------------------
+def _stream_options(args):
+    """Validated /stream query parameters, raises ValueError."""
+    model = args.get('model', '').strip()
+    if not models.model_exists(model):
+        raise ValueError(f"{model} {cfg.transobj['lang4']}")
+    stems = [it.strip() for it in args.get('stems', '').split(',') if it.strip()] or models.STEMS[model]
+    unknown = [it for it in stems if it not in models.STEMS[model]]
+    if unknown:
+        raise ValueError(f"{model} has no stem {', '.join(unknown)}")
+    latency = float(args.get('latency', cfg.STREAM_LATENCY))
+    lookahead = float(args.get('lookahead', cfg.STREAM_LOOKAHEAD))
+    # written so NaN fails too
+    if not 0 < latency < float('inf') or not lookahead >= 0:
+        raise ValueError('latency must be a positive number of seconds and lookahead at least 0')
+    latency = max(0.1, latency)
+    lookahead = min(lookahead, latency / 2)
+    return {
+        'model': model,
+        'stems': stems,
+        'format': args.get('format', 'f32le'),
+        'channels': int(args.get('channels', 2)),
+        'hop': latency - lookahead,
+        'lookahead': lookahead,
+    }
+
+
+def _stream_separator(options):
+    from vocal import streaming
+
+    def separate(window):
+        spec = {'kind': 'waveform', 'model': options['model'], 'waveform': window}
+        return jobs.job_queue.run(spec)['stems']
+
+    return streaming.StreamSeparator(separate, hop=options['hop'], lookahead=options['lookahead'],
+                                     context=cfg.STREAM_CONTEXT)
+
+
+@app.route('/stream', methods=['POST'])
+@app.route('/stream', methods=['GET'], websocket=True)
+def stream():
+    """
+    Separate live audio with bounded latency, eg. for karaoke. The input is
+    interleaved PCM (?format=f32le|s16le&channels=1|2, 44.1kHz), the output
+    interleaved PCM in the same format with the stereo pairs of ?stems
+    (default all of the model's) side by side. ?latency is the target in
+    seconds, of which ?lookahead is audio after each emitted hop.
+
+    As a WebSocket (GET with Upgrade), the server first sends a JSON text
+    message describing the output, then one binary message per hop; the
+    client sends binary PCM messages and the text message "end" to flush
+    the rest. As a POST, the chunked request body is the input and the
+    response body streams the output.
+    """
+    from vocal import streaming, waveform
+    try:
+        options = _stream_options(request.args)
+        decoder = waveform.PcmDecoder(options['format'], options['channels'])
+        separator = _stream_separator(options)
+    except ValueError as e:
+        return jsonify({"code": 1, "msg": str(e)}), 400
+    stems, fmt = options['stems'], options['format']
+    info = {'stems': stems, 'format': fmt, 'channels': 2 * len(stems),
+            'sample_rate': waveform.SAMPLE_RATE, 'latency': separator.latency}
+
+    def encode(block):
+        return waveform.to_pcm(streaming.interleave(block, stems), fmt)
+
+    if request.method == 'GET':
+        headers = serve.websocket_response_headers(request.environ)
+        if headers is None:
+            return jsonify({"code": 1, "msg": "websocket upgrade expected"}), 400
+
+        def session(ws):
+            ws.send(json.dumps(info))
+            try:
+                while True:
+                    message = ws.receive()
+                    if message is None:
+                        return
+                    if message == 'end':
+                        break
+                    if isinstance(message, bytes):
+                        for block in separator.push(decoder.feed(message)):
+                            ws.send(encode(block))
+                for block in separator.flush():
+                    ws.send(encode(block))
+            except jobs.QueueFull as e:
+                ws.send(json.dumps({'error': str(e)}))
+                ws.close(1013)
+            except serve.WebSocketClosed:
+                raise
+            except Exception as e:
+                app.logger.error(f'[stream] Separation failed: {e}', exc_info=True)
+                ws.send(json.dumps({'error': cfg.transobj['lang7']}))
+                ws.close(1011)
+
+        request.environ['vocal.websocket'] = session
+        return Response(status=101, headers=headers)
+
+    def generate():
+        try:
+            while True:
+                data = request.stream.read(16384)
+                if not data:
+                    break
+                for block in separator.push(decoder.feed(data)):
+                    yield encode(block)
+            for block in separator.flush():
+                yield encode(block)
+        except Exception as e:
+            app.logger.error(f'[stream] Separation failed: {e}', exc_info=True)
+
+    return Response(stream_with_context(generate()), mimetype='application/octet-stream', headers={
+        'X-Stems': ','.join(stems),
+        'X-Audio-Format': f"{fmt}; rate={waveform.SAMPLE_RATE}; channels={info['channels']}",
+        'X-Latency': str(round(separator.latency, 3)),
+    })
+
+
+# --------------------------------------------------------------------------
+# JOB ROUTES
+# --------------------------------------------------------------------------
+@app.route('/jobs', methods=['POST'])
+def job_submit():
+    """
+    Submit a separation job and return its id right away. Takes the
+    'wav_name' returned by /upload plus 'model'. Poll /jobs/<job_id> for
+    status and /jobs/<job_id>/result for the stems. Answers 429 when the
+    queue is full.
+    """
+    try:
+        model = request.form.get("model", "").strip()
+        wav_name = request.form.get("wav_name", "").strip()
+        if not models.model_exists(model):
+            return jsonify({"code": 1, "msg": f"{model} {cfg.transobj['lang4']}"})
+        wav_file = _tmp_file(wav_name)
+        if wav_file is None:
+            return jsonify({"code": 1, "msg": f"{wav_name} {cfg.transobj['lang5']}"}), 400
+        if not os.path.exists(wav_file):
+            return jsonify({"code": 1, "msg": f"{wav_file} {cfg.transobj['lang5']}"})
+        job = _submit_separation(wav_file, model, _options(request.form))
+        return jsonify({"code": 0, "msg": "ok", "data": job.to_dict()})
+    except jobs.QueueFull as e:
+        return jsonify({"code": 1, "msg": str(e)}), 429
+    except Exception as e:
+        app.logger.error(f'[jobs] Unexpected error: {e}', exc_info=True)
+        return jsonify({"code": 2, "msg": str(e)})
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Status, stage and progress (0..1) of a job."""
+    try:
+        return jsonify({"code": 0, "msg": "ok", "data": jobs.job_queue.get(job_id).to_dict()})
+    except jobs.JobNotFound:
+        return jsonify({"code": 1, "msg": f"{job_id} {cfg.transobj['lang5']}"}), 404
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """
+    Stem URLs of a finished job, or its status while it is still running.
+    The URLs are in the codec and bitrate the job was submitted with, or in
+    ?codec=&bitrate= when given, eg. by a request that joined the job.
+    """
+    try:
+        job = jobs.job_queue.get(job_id)
+    except jobs.JobNotFound:
+        return jsonify({"code": 1, "msg": f"{job_id} {cfg.transobj['lang5']}"}), 404
+    options = {key: job.spec[key] for key in ('codec', 'bitrate') if job.spec.get(key)}
+    try:
+        options.update(_options(request.args))
+    except ValueError as e:
+        return jsonify({"code": 1, "msg": str(e)}), 400
+    if job.status != jobs.DONE:
+        return jsonify({"code": 1, "msg": job.error or job.status, "data": job.to_dict()})
+    return jsonify({
+        "code": 0,
+        "msg": cfg.transobj['lang6'],
+        "data": _stem_urls(job.result, options),
+        "dirname": job.result['dirname'],
+        "report": job.result.get('report')
+    })
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    """Cancel a queued or running job."""
+    try:
+        cancelled = jobs.job_queue.cancel(job_id)
+    except jobs.JobNotFound:
+        return jsonify({"code": 1, "msg": f"{job_id} {cfg.transobj['lang5']}"}), 404
+    return jsonify({"code": 0 if cancelled else 1, "msg": "cancelled" if cancelled else "finished",
+                    "data": jobs.job_queue.get(job_id).to_dict()})
+
+
+@app.route('/batch', methods=['POST'])
+def batch_submit():
+    """
+    Separate many files on this machine with one model load. 'inputs' is
+    one or more directories, glob patterns or manifest files (one per
+    line), relative to cfg.BATCH_ROOT; nothing outside it is read, and
+    without VOCAL_BATCH_ROOT the endpoint is disabled. Returns a job id;
+    /jobs/<job_id>/result then lists every stem URL and 'report' holds
+    the per-file outcome.
+    """
+    from vocal import batch
+    if not cfg.BATCH_ROOT:
+        return jsonify({"code": 1, "msg": "batch over HTTP is disabled, set VOCAL_BATCH_ROOT"}), 403
+    try:
+        model = request.form.get("model", "").strip()
+        inputs = [it.strip() for it in request.form.get("inputs", "").splitlines() if it.strip()]
+        if not models.model_exists(model):
+            return jsonify({"code": 1, "msg": f"{model} {cfg.transobj['lang4']}"})
+        if not inputs:
+            return jsonify({"code": 1, "msg": cfg.transobj['lang5']})
+        outside = [it for it in inputs if not batch.inside(os.path.join(cfg.BATCH_ROOT, it), cfg.BATCH_ROOT)]
+        if outside:
+            return jsonify({"code": 1, "msg": f"outside the batch root: {', '.join(outside)}"}), 400
+        dirname = os.path.join(cfg.FILES_DIR, f'batch-{uuid.uuid4().hex[:12]}')
+        job = jobs.job_queue.submit({'kind': 'batch', 'inputs': inputs, 'model': model, 'dirname': dirname,
+                                     'root': cfg.BATCH_ROOT})
+        app.logger.debug(f'[batch] Submitted job {job.id} for {len(inputs)} inputs with {model}')
+        return jsonify({"code": 0, "msg": "ok", "data": job.to_dict()})
+    except jobs.QueueFull as e:
+        return jsonify({"code": 1, "msg": str(e)}), 429
+    except Exception as e:
+        app.logger.error(f'[batch] Unexpected error: {e}', exc_info=True)
+        return jsonify({"code": 2, "msg": str(e)})
+
+
+def _stems_dir(outname):
+    """static/files/<outname> when outname names a folder right in it, else None."""
+    if not outname or outname.startswith('.') or os.path.basename(outname) != outname:
+        return None
+    dirname = os.path.join(cfg.FILES_DIR, outname)
+    return dirname if os.path.isdir(dirname) else None
+
+
+def _bitrate(value):
+    """A bitrate like 128k, the only form passed to ffmpeg or into file names; None when not given."""
+    if not value:
+        return None
+    if not isinstance(value, str) or not re.fullmatch(r'[1-9][0-9]{0,3}k', value):
+        raise ValueError(f'bitrate {value}: expected eg. 128k')
+    return value
+
+
+@app.route('/download/<outname>/<path:filename>', methods=['GET'])
+def download(outname, filename):
+    """
+    Serve a stem in the format named by its extension, eg.
+    /download/<dir>/vocals.mp3?bitrate=128k. The compressed variant is
+    transcoded from the stored stem on first request and kept next to it,
+    those with an explicit bitrate in variants/<stem>.<bitrate>.<codec>.
+    """
+    stem, ext = os.path.splitext(filename)
+    codec = ext[1:].lower()
+    dirname = _stems_dir(outname)
+    if codec not in transcode.CODECS or dirname is None or os.path.basename(filename) != filename \
+            or filename.startswith('.'):
+        return jsonify({"code": 1, "msg": f"{filename} {cfg.transobj['lang5']}"}), 404
+    try:
+        bitrate = _bitrate(request.args.get('bitrate')) if transcode.CODECS[codec][1] else None
+    except ValueError as e:
+        return jsonify({"code": 1, "msg": str(e)}), 400
+    # the stored stem, or the default encoding, unless another bitrate is asked for
+    folder = os.path.join(dirname, 'variants') if bitrate else dirname
+    name = f'{stem}.{bitrate}.{codec}' if bitrate else f'{stem}.{codec}'
+    target = os.path.join(folder, name)
+    if not os.path.exists(target):
+        sources = [os.path.join(dirname, f'{stem}.{it}') for it in ['wav', 'flac', *transcode.CODECS]]
+        source = next((it for it in sources if os.path.exists(it)), None)
+        if source is None:
+            return jsonify({"code": 1, "msg": f"{filename} {cfg.transobj['lang5']}"}), 404
+        os.makedirs(folder, exist_ok=True)
+        try:
+            singleflight.transcodes.do(target, transcode.encode, source, target, codec, bitrate)
+        except transcode.TranscodeError as e:
+            app.logger.error(f'[download] Transcoding {source} to {codec} failed: {e}')
+            return jsonify({"code": 1, "msg": str(e)}), 500
+    return send_from_directory(folder, name)
+
+
+@app.route('/transcode/<key>', methods=['GET'])
+def transcode_status(key):
+    """Progress (0..1) of a running conversion started with upload_id=<key>."""
+    job = transcode.active.get(key)
+    if job is None:
+        return jsonify({"code": 1, "msg": f"{key} {cfg.transobj['lang5']}"}), 404
+    return jsonify({"code": 0, "msg": "ok", "data": {"progress": round(job.progress, 3), "duration": job.duration}})
+
+
+@app.route('/transcode/<key>', methods=['DELETE'])
+def transcode_cancel(key):
+    """Cancel a running conversion."""
+    if not transcode.cancel(key):
+        return jsonify({"code": 1, "msg": f"{key} {cfg.transobj['lang5']}"}), 404
+    return jsonify({"code": 0, "msg": "cancelled"})
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Result cache size and hit/miss counters."""
+    return jsonify({"code": 0, "msg": "ok", "data": cache.result_cache.stats()})
+
+
+@app.route('/janitor', methods=['GET', 'POST'])
+def janitor_sweep():
+    """GET: what the janitor deleted so far. POST: sweep now and report what was deleted."""
+    if isinstance(jobs.job_queue, modelserver.RemoteJobQueue):
+        # the janitor runs next to the job queue, which knows what is in use
+        data = jobs.job_queue.janitor('sweep' if request.method == 'POST' else 'stats')
+    elif request.method == 'POST':
+        data = tool.offload(janitor.janitor.sweep)
+    else:
+        data = janitor.janitor.stats()
+    return jsonify({"code": 0, "msg": "ok", "data": data})
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Counters, gauges and stage timing histograms in the Prometheus text format."""
+    if isinstance(jobs.job_queue, modelserver.RemoteJobQueue):
+        # job timings are recorded by the process running the queue
+        remote = metrics.JOB_METRICS | janitor.METRICS
+        text = metrics.render(exclude=remote) + jobs.job_queue.render_metrics(remote)
+    else:
+        text = metrics.render()
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/status', methods=['GET'])
+def status():
+    """Version, startup time and device of this process, and the job backend it uses."""
+    return jsonify({"code": 0, "msg": "ok", "data": {
+        "version": vocal.version_str,
+        "startup_seconds": startup_seconds,
+        "cuda": cfg.probe_cuda(wait=False),
+        "pending_jobs": jobs.job_queue.pending(),
+        "job_backend": cfg.JOB_BACKEND,
+        "node": cfg.NODE_ID
+    }})
+
+
+# --------------------------------------------------------------------------
+# REMIX ROUTE
+# --------------------------------------------------------------------------
+def _stem_wav(dirname, stem):
+    # remixing reads WAVs, stems stored in another codec are converted once and kept in remix/
+    from vocal import remix
+    target = os.path.join(dirname, f'{stem}.wav')
+    if not os.path.exists(target):
+        target = os.path.join(dirname, remix.REMIX_DIR, f'{stem}.wav')
+    if not os.path.exists(target):
+        source = next(it for it in (os.path.join(dirname, f'{stem}.{c}') for c in transcode.CODECS) if os.path.exists(it))
+        singleflight.transcodes.do(target, transcode.encode, source, target, 'wav')
+    return target
+
+
+def _stem_names(value, name):
+    # stem names given as a JSON list or a comma-separated string
+    if isinstance(value, str):
+        return [it.strip() for it in value.split(',') if it.strip()]
+    if isinstance(value, list) and all(isinstance(it, str) for it in value):
+        return [it.strip() for it in value]
+    raise ValueError(f'{name} must be a list or comma-separated stem names')
+
+
+def _gain(stem, value):
+    # a number from JSON, or a string from the query
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f'gain of {stem} must be a number')
+    try:
+        gain = float(value)
+    except ValueError:
+        raise ValueError(f'gain of {stem} must be a number')
+    # written so NaN fails too
+    if not 0 <= gain <= 10:
+        raise ValueError('gain must be between 0 and 10')
+    return gain
+
+
+def _remix_gains(stems):
+    # {stem: gain} from a JSON body {"gains": {...}}, gain.<stem>=x parameters,
+    # stems=a,b (gain 1) or exclude=a (all others at 1); default every stem at 1
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    gains = data.get('gains')
+    if gains is not None and not isinstance(gains, dict):
+        raise ValueError('gains must be an object of {stem: gain}')
+    if gains is None:
+        gains = {k[5:]: v for k, v in request.values.items() if k.startswith('gain.')} or None
+    if gains is None and (data.get('stems') or request.values.get('stems')):
+        gains = {stem: 1 for stem in _stem_names(data.get('stems') or request.values['stems'], 'stems')}
+    if gains is None:
+        excluded = _stem_names(data.get('exclude') or request.values.get('exclude', ''), 'exclude')
+        gains = {stem: 1 for stem in stems if stem not in excluded}
+    unknown = [stem for stem in gains if stem not in stems]
+    if unknown:
+        raise ValueError(f"{', '.join(unknown)} {cfg.transobj['lang5']}")
+    return {stem: _gain(stem, gain) for stem, gain in gains.items()}
+
+
+@app.route('/remix/<outname>', methods=['GET', 'POST'])
+def remix_stems(outname):
+    """
+    Mix the stems of a separation with a gain per stem, eg.
+    /remix/<dir>?exclude=vocals&format=mp3 or /remix/<dir>?gain.vocals=0.3&gain.drums=1.2.
+    A WAV is streamed as it is mixed; other formats are encoded from the mixed WAV.
+    Every (gains, format) is kept in the stems folder's remix/ and served from there next time.
+    """
+    from vocal import remix
+    dirname = _stems_dir(outname)
+    if dirname is None:
+        return jsonify({"code": 1, "msg": f"{outname} {cfg.transobj['lang5']}"}), 404
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict):
+        values = request.values
+    codec = str(values.get('format') or 'wav').lower()
+    stems = sorted({os.path.splitext(it)[0] for it in separation.list_stems(dirname)})
+    folder = os.path.join(dirname, remix.REMIX_DIR)
+    try:
+        if codec not in transcode.CODECS:
+            raise ValueError(f"{codec} {cfg.transobj['lang5']}")
+        bitrate = _bitrate(values.get('bitrate'))
+        gains = _remix_gains(stems)
+        name = remix.cache_name(gains, codec, bitrate)
+        target = os.path.join(folder, name)
+        if os.path.exists(target):
+            remix.remix_total.inc(cache='hit')
+            return send_from_directory(folder, name)
+        remix.remix_total.inc(cache='miss')
+        os.makedirs(folder, exist_ok=True)
+        mix = remix.Remix({tool.offload(_stem_wav, dirname, stem): gain for stem, gain in gains.items()})
+    except ValueError as e:
+        return jsonify({"code": 1, "msg": str(e)}), 400
+    except transcode.TranscodeError as e:
+        app.logger.error(f'[remix] Converting stems of {outname} failed: {e}')
+        return jsonify({"code": 1, "msg": str(e)}), 500
+    if codec == 'wav':
+        return Response(stream_with_context(mix.stream_to(target)), mimetype='audio/wav',
+                        headers={'Content-Length': str(mix.size)})
+
+    def render():
+        wav = tool.offload(mix.write, f'{target}.{uuid.uuid4().hex[:8]}.wav')
+        try:
+            transcode.encode(wav, target, codec, bitrate)
+        finally:
+            os.remove(wav)
+
+    try:
+        singleflight.transcodes.do(target, render)
+    except transcode.TranscodeError as e:
+        app.logger.error(f'[remix] Encoding {name} failed: {e}')
+        return jsonify({"code": 1, "msg": str(e)}), 500
+    return send_from_directory(folder, name)
+
+
+# --------------------------------------------------------------------------
+# PEAKS ROUTES
+# --------------------------------------------------------------------------
+def _peaks_index(outname):
+    # the peaks index of a result, built now for results separated without one
+    from vocal import peaks
+    dirname = _stems_dir(outname)
+    if dirname is None:
+        return None, None
+    index = peaks.load(dirname)
+    if index is None:
+        index, _ = singleflight.previews.do(dirname, tool.offload, peaks.build_dir, dirname)
+    return dirname, index
+
+
+@app.route('/peaks/<outname>', methods=['GET'])
+def peaks_index(outname):
+    """
+    Peak levels and preview clips of the stems in static/files/<outname>, written when
+    the separation finished. Every stem comes with the URL of its preview clip (when
+    there is one) and of the full stem, which the page only loads on demand.
+    """
+    dirname, index = _peaks_index(outname)
+    if index is None:
+        return jsonify({"code": 1, "msg": f"{outname} {cfg.transobj['lang5']}"}), 404
+    stored = {os.path.splitext(it)[0]: it for it in separation.list_stems(dirname)}
+    base = f'{_public_url()}/static/files/{outname}'
+    for stem, entry in index['stems'].items():
+        if entry.get('preview'):
+            entry['preview'] = f"{base}/preview/{entry['preview']}"
+        entry['url'] = f'{base}/{stored[stem]}' if stem in stored else None
+    return jsonify({"code": 0, "msg": "ok", "data": index})
+
+
+@app.route('/peaks/<outname>/<stem>', methods=['GET'])
+def peaks_level(outname, stem):
+    """
+    One peak level of a stem, the coarsest with at least `width` peaks: JSON
+    {samples_per_peak, count, peaks: [min, max, rms, ...]} scaled to 127, or with
+    format=bin the same triples as raw int8.
+    """
+    from vocal import peaks
+    dirname, index = _peaks_index(outname)
+    if index is None or stem not in index['stems']:
+        return jsonify({"code": 1, "msg": f"{stem} {cfg.transobj['lang5']}"}), 404
+    level, data = peaks.read_level(dirname, stem, index, request.args.get('width', type=int))
+    if request.args.get('format') == 'bin':
+        response = Response(data, mimetype='application/octet-stream')
+        response.headers['X-Samples-Per-Peak'] = str(level['samples_per_peak'])
+        response.headers['X-Peak-Count'] = str(level['count'])
+    else:
+        response = jsonify({"code": 0, "msg": "ok", "data": {
+            "samples_per_peak": level['samples_per_peak'],
+            "count": level['count'],
+            "peaks": memoryview(data).cast('b').tolist(),
+        }})
+    # stems never change once written
+    response.cache_control.max_age = cfg.STATIC_MAX_AGE
+    return response
+
+
 # --------------------------------------------------------------------------
 # CHECK UPDATE ROUTE
 # --------------------------------------------------------------------------
@@ -473,6 +1303,131 @@ def checkupdate():
     return jsonify({'code': 0, "msg": cfg.updatetips})
 
 
+# --------------------------------------------------------------------------
+# MULTI-PROCESS SERVING
+# --------------------------------------------------------------------------
+# Log records of the children, written to vocal.log and the console by the parent alone
+log_forward = None
+log_collector = None
+
+
+def _start_listener(*handlers):
+    global log_listener
+    log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+
+
+def _model_server_main(server):
+    """Child process owning the job queue and its inference workers."""
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    jobs.job_queue.start()
+    janitor.janitor.start()
+    server.start()
+    app.logger.warning(f'[models] Model server {os.getpid()} listening on {server.address}')
+    try:
+        while True:
+            signal.pause()
+    finally:
+        jobs.job_queue.shutdown()
+
+
+def _http_worker_main(sock, address, authkey):
+    """Child process serving HTTP on the shared socket, jobs go to the model server."""
+    global startup_seconds
+    import gevent
+    gevent.reinit()
+    client = modelserver.ModelClient(address, authkey)
+    jobs.job_queue = modelserver.RemoteJobQueue(client)
+    cache.result_cache = modelserver.RemoteResultCache(client)
+    threading.Thread(target=tool.checkupdate, daemon=True).start()
+    http_server = WSGIServer(sock, app, handler_class=CustomRequestHandler)
+    http_server.start()
+    startup_seconds = round(time.time() - _started, 3)
+    app.logger.warning(f'[main] HTTP worker {os.getpid()} ready in {startup_seconds}s')
+    http_server.serve_forever()
+
+
+def _fork(target, *args):
+    # The listener may hold a handler's lock, so it is stopped while forking. The collector
+    # only reads the children's pipe, and this process never writes to it until shutdown,
+    # so every child starts the queue's feeder thread of its own.
+    log_listener.stop()
+    pid = os.fork()
+    if pid == 0:
+        _start_listener(QueueHandler(log_forward))
+        code = 0
+        try:
+            target(*args)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            app.logger.error(f'[main] Process {os.getpid()} failed', exc_info=True)
+            code = 1
+        finally:
+            log_listener.stop()
+            # os._exit() skips the queue's own flush
+            log_forward.close()
+            log_forward.join_thread()
+            os._exit(code)
+    _start_listener(file_handler, console_handler)
+    return pid
+
+
+def serve_multiprocess(host, port, http_workers):
+    """
+    Serve with http_workers processes accepting on one shared socket, in
+    front of one model server process running the job queue. This process
+    only supervises: it forks the children before starting any thread of
+    its own but logging and restarts whichever of them exits. It is the only
+    process writing vocal.log, the children send their records to it.
+    """
+    global log_forward, log_collector
+    log_forward = multiprocessing.get_context('fork').Queue()
+    log_collector = QueueListener(log_forward, file_handler, console_handler, respect_handler_level=True)
+    log_collector.start()
+    server = modelserver.ModelServer(jobs.job_queue, cache.result_cache)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    # each worker's gevent loop waits for connections itself
+    sock.setblocking(False)
+    children = {_fork(_model_server_main, server): 'model server'}
+    for _ in range(http_workers):
+        children[_fork(_http_worker_main, sock, server.address, server.authkey)] = 'http worker'
+    app.logger.warning(f'[main] Serving http://{host}:{port} with {http_workers} HTTP workers, pids {sorted(children)}')
+    threading.Thread(target=tool.openweb, args=(f'{host}:{port}',)).start()
+
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        while True:
+            pid, status = os.wait()
+            role = children.pop(pid, None)
+            if role is None:
+                continue
+            app.logger.error(f'[main] {role} {pid} exited with status {status}, restarting')
+            time.sleep(1)
+            if role == 'model server':
+                children[_fork(_model_server_main, server)] = role
+            else:
+                children[_fork(_http_worker_main, sock, server.address, server.authkey)] = role
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        server.close()
+        log_collector.stop()
+
+
 # --------------------------------------------------------------------------
 # MAIN ENTRY POINT
 # --------------------------------------------------------------------------
@@ -481,9 +1436,20 @@ if __name__ == '__main__':
     # We wrap our server in a try/except to gracefully handle startup errors.
     http_server = None
     try:
+        if cfg.HTTP_WORKERS > 1 and hasattr(os, 'fork'):
+            host = cfg.web_address.split(':')
+            serve_multiprocess(host[0], int(host[1]), cfg.HTTP_WORKERS)
+            sys.exit(0)
+
         app.logger.debug('[main] Starting background thread for checkupdate...')
         threading.Thread(target=tool.checkupdate).start()
 
+        # Start the separation workers, they preload cfg.PRELOAD_MODELS themselves
+        app.logger.debug('[main] Starting separation job queue...')
+        jobs.job_queue.start()
+        # Delete expired and over quota files in TMP_DIR and FILES_DIR
+        janitor.janitor.start()
+
         try:
             app.logger.debug('[main] Parsing host and port from cfg.web_address...')
             host = cfg.web_address.split(':')
@@ -501,16 +1467,22 @@ if __name__ == '__main__':
             threading.Thread(target=tool.openweb, args=(cfg.web_address,)).start()
 
             # Start serving forever
-            app.logger.info(f'[main] Starting server at http://{cfg.web_address}')
+            http_server.start()
+            startup_seconds = round(time.time() - _started, 3)
+            app.logger.warning(f'[main] Server ready at http://{cfg.web_address} in {startup_seconds}s')
             http_server.serve_forever()
         finally:
             # If we exit, ensure http_server is stopped.
             if http_server:
                 app.logger.warning('[main] Stopping HTTP server...')
                 http_server.stop()
+            jobs.job_queue.shutdown()
     except Exception as e:
         # Log any top-level exceptions
         if http_server:
             http_server.stop()
         app.logger.error(f'[main] Critical error during startup: {str(e)}', exc_info=True)
         print("Critical startup error:", str(e))
+    finally:
+        # flush whatever is still queued for the log handlers
+        log_listener.stop()
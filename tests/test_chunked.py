@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+import wave
+
+import numpy as np
+
+from vocal import chunked, media
+
+RATE = 1000
+
+
+def write_wav(path, samples, sample_rate=RATE):
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(samples.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes((samples * 32767).astype('<i2').tobytes())
+
+
+def read_wav(path):
+    data, scale, _ = media.open_wav(path)
+    return np.asarray(data, dtype=np.float32) * scale
+
+
+class Identity:
+    # a "model" returning the input, and half of it as a second stem
+    def separate(self, waveform):
+        return {'vocals': waveform, 'accompaniment': waveform * 0.5}
+
+
+class Counting:
+    # every call returns a constant: 1 for the first window, 2 for the second, ...
+    def __init__(self):
+        self.calls = 0
+
+    def separate(self, waveform):
+        self.calls += 1
+        return {'vocals': np.full_like(waveform, 0.1 * self.calls)}
+
+
+class SeparateChunkedTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.dir.name, 'in.wav')
+        rng = np.random.default_rng(0)
+        self.samples = rng.uniform(-0.5, 0.5, (3500, 2)).astype(np.float32)
+        write_wav(self.source, self.samples)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def separate(self, separator, **kwargs):
+        out = os.path.join(self.dir.name, 'out')
+        os.makedirs(out, exist_ok=True)
+        chunked.separate_chunked(separator, self.source, out, segment=1.0, overlap=0.2, sample_rate=RATE, **kwargs)
+        return {it[:-4]: read_wav(os.path.join(out, it)) for it in os.listdir(out)}
+
+    def test_windows_add_up_to_the_input(self):
+        stems = self.separate(Identity())
+        self.assertEqual(set(stems), {'vocals', 'accompaniment'})
+        self.assertEqual(len(stems['vocals']), len(self.samples))
+        np.testing.assert_allclose(stems['vocals'], self.samples, atol=1e-4)
+        np.testing.assert_allclose(stems['accompaniment'], self.samples * 0.5, atol=1e-4)
+
+    def test_batched_windows_match_single_ones(self):
+        single = self.separate(Identity())
+        batched = self.separate(Identity(), batch=3)
+        np.testing.assert_array_equal(batched['vocals'], single['vocals'])
+
+    def test_overlaps_are_crossfaded(self):
+        vocals = self.separate(Counting())['vocals'][:, 0]
+        # window 1 is samples 0..999, window 2 starts at the hop, 800; the overlap ramps from one to the other
+        np.testing.assert_allclose(vocals[:800], 0.1, atol=1e-4)
+        fade = vocals[800:1000]
+        self.assertTrue(np.all(np.diff(fade) >= -1e-4))
+        self.assertAlmostEqual(float(fade[0]), 0.1, places=3)
+        self.assertAlmostEqual(float(fade[-1]), 0.2, places=3)
+        np.testing.assert_allclose(vocals[1000:1600], 0.2, atol=1e-4)
+
+    def test_progress_reaches_one(self):
+        seen = []
+        self.separate(Identity(), duration=len(self.samples) / RATE, progress=seen.append)
+        self.assertEqual(seen, sorted(seen))
+        self.assertAlmostEqual(seen[-1], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from vocal import jobs, singleflight
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.started = []
+
+        def run(job_id, spec):
+            self.started.append(spec)
+            self.release.wait(5)
+            return {'n': spec['n']}
+        patches = [mock.patch.object(jobs, '_run', run), mock.patch.object(jobs, '_init_worker', lambda *args: None)]
+        for it in patches:
+            it.start()
+            self.addCleanup(it.stop)
+        self.queue = jobs.JobQueue(workers=0, max_pending=4)
+
+    def tearDown(self):
+        self.release.set()
+        self.queue.shutdown()
+
+    def wait_started(self, count):
+        deadline = time.monotonic() + 5
+        while len(self.started) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.started), count)
+
+    def test_same_key_joins_the_unfinished_job(self):
+        done = []
+        first = self.queue.submit({'n': 1}, on_done=done.append, key='digest-2stems')
+        again = self.queue.submit({'n': 1}, on_done=done.append, key='digest-2stems')
+        other = self.queue.submit({'n': 2}, key='digest-4stems')
+        self.assertIs(again, first)
+        self.assertEqual(first.waiters, 2)
+        self.assertIsNot(other, first)
+        self.release.set()
+        self.assertEqual(self.queue.wait(first.id, timeout=5).status, jobs.DONE)
+        self.assertEqual(self.queue.wait(other.id, timeout=5).status, jobs.DONE)
+        self.assertEqual([spec['n'] for spec in self.started], [1, 2])
+        # the first submitter's on_done stands for both
+        self.assertEqual(done, [first])
+
+    def test_finished_job_is_not_joined(self):
+        self.release.set()
+        first = self.queue.submit({'n': 1}, key='k')
+        self.queue.wait(first.id, timeout=5)
+        second = self.queue.submit({'n': 1}, key='k')
+        self.assertIsNot(second, first)
+        self.assertEqual(second.waiters, 1)
+
+    def test_cancel_of_a_joined_job_leaves_it_to_the_others(self):
+        job = self.queue.submit({'n': 1}, key='k')
+        self.queue.submit({'n': 1}, key='k')
+        self.wait_started(1)
+        self.assertTrue(self.queue.cancel(job.id))
+        self.assertNotIn(job.status, jobs.FINISHED)
+        self.assertEqual(job.waiters, 1)
+        self.release.set()
+        self.assertEqual(self.queue.wait(job.id, timeout=5).status, jobs.DONE)
+        self.assertFalse(self.queue.cancel(job.id))
+
+    def test_cancelled_queued_job_never_runs(self):
+        running = self.queue.submit({'n': 1})
+        self.wait_started(1)
+        queued = self.queue.submit({'n': 2}, key='k')
+        self.assertTrue(self.queue.cancel(queued.id))
+        self.assertEqual(queued.status, jobs.CANCELLED)
+        # its key is free again
+        self.assertIsNot(self.queue.submit({'n': 3}, key='k'), queued)
+        self.release.set()
+        self.queue.wait(running.id, timeout=5)
+        time.sleep(0.1)
+        self.assertNotIn({'n': 2}, self.started)
+
+    def test_queue_full_but_joinable(self):
+        for n in range(4):
+            self.queue.submit({'n': n}, key=n)
+        with self.assertRaises(jobs.QueueFull):
+            self.queue.submit({'n': 4})
+        # joining takes no room
+        self.assertEqual(self.queue.submit({'n': 3}, key=3).waiters, 2)
+
+    def test_unknown_job(self):
+        with self.assertRaises(jobs.JobNotFound):
+            self.queue.get('nope')
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_concurrent_calls_run_once(self):
+        flight = singleflight.SingleFlight('test')
+        calls = []
+        release = threading.Event()
+
+        def work(value):
+            calls.append(value)
+            release.wait(5)
+            return value * 2
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('k', work, 21))) for _ in range(3)]
+        for it in threads:
+            it.start()
+        deadline = time.monotonic() + 5
+        while flight.running() != ['k'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        release.set()
+        for it in threads:
+            it.join(5)
+        self.assertEqual(calls, [21])
+        self.assertEqual(sorted(results), [(42, False), (42, True), (42, True)])
+        self.assertEqual(flight.running(), [])
+
+    def test_waiters_share_the_exception(self):
+        flight = singleflight.SingleFlight('test')
+        release = threading.Event()
+        errors = []
+
+        def work():
+            release.wait(5)
+            raise ValueError('broken')
+
+        def call():
+            try:
+                flight.do('k', work)
+            except ValueError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=call) for _ in range(2)]
+        for it in threads:
+            it.start()
+        time.sleep(0.1)
+        release.set()
+        for it in threads:
+            it.join(5)
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from vocal import jobs, jobstore
+
+
+class JobStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = jobstore.JobStore(os.path.join(self.dir.name, 'jobs.sqlite3'), max_pending=4, max_attempts=2)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_lease_takes_oldest_queued_job_once(self):
+        first, _ = self.store.submit({'n': 1})
+        self.store.submit({'n': 2})
+        job = self.store.lease('a', 30)
+        self.assertEqual(job.id, first.id)
+        self.assertEqual(job.status, jobs.RUNNING)
+        self.assertEqual(self.store.lease('b', 30).spec, {'n': 2})
+        self.assertIsNone(self.store.lease('c', 30))
+
+    def test_submit_joins_unfinished_job_with_same_key(self):
+        job, joined = self.store.submit({'n': 1}, key='k')
+        again, joined_again = self.store.submit({'n': 1}, key='k')
+        self.assertFalse(joined)
+        self.assertTrue(joined_again)
+        self.assertEqual(again.id, job.id)
+        self.assertEqual(self.store.get(job.id).waiters, 2)
+
+    def test_submit_raises_queue_full(self):
+        for n in range(4):
+            self.store.submit({'n': n})
+        with self.assertRaises(jobs.QueueFull):
+            self.store.submit({'n': 4})
+
+    def test_heartbeat_renews_lease_and_records_progress(self):
+        job, _ = self.store.submit({'n': 1})
+        self.store.lease('a', -1)
+        self.assertTrue(self.store.heartbeat(job.id, 'a', 30, 'separating', 0.5))
+        # renewed, so not expired for another node
+        self.assertIsNone(self.store.lease('b', 30))
+        job = self.store.get(job.id)
+        self.assertEqual((job.stage, job.progress), ('separating', 0.5))
+        self.assertFalse(self.store.heartbeat(job.id, 'b', 30))
+
+    def test_expired_lease_is_leased_again(self):
+        job, _ = self.store.submit({'n': 1})
+        self.store.lease('a', -1)
+        again = self.store.lease('b', 30)
+        self.assertEqual(again.id, job.id)
+        # the node that lost its lease can neither renew nor finish the job
+        self.assertFalse(self.store.heartbeat(job.id, 'a', 30))
+        self.assertFalse(self.store.finish(job.id, 'a', jobs.DONE, {'dirname': 'x'}))
+        self.assertTrue(self.store.finish(job.id, 'b', jobs.DONE, {'dirname': 'x'}))
+        self.assertEqual(self.store.get(job.id).result, {'dirname': 'x'})
+
+    def test_job_fails_after_max_attempts(self):
+        job, _ = self.store.submit({'n': 1})
+        self.store.lease('a', -1)
+        self.store.lease('b', -1)
+        self.assertIsNone(self.store.lease('c', 30))
+        job = self.store.get(job.id)
+        self.assertEqual(job.status, jobs.FAILED)
+        self.assertEqual(job.error, 'lost by node b')
+
+    def test_release_queues_job_again_until_max_attempts(self):
+        job, _ = self.store.submit({'n': 1})
+        self.store.lease('a', 30)
+        self.assertFalse(self.store.release(job.id, 'b'))
+        self.assertTrue(self.store.release(job.id, 'a', 'worker process died'))
+        self.assertEqual(self.store.get(job.id).status, jobs.QUEUED)
+        self.store.lease('b', 30)
+        self.assertTrue(self.store.release(job.id, 'b', 'worker process died'))
+        job = self.store.get(job.id)
+        self.assertEqual((job.status, job.error), (jobs.FAILED, 'worker process died'))
+
+    def test_cancel_stops_heartbeat(self):
+        job, _ = self.store.submit({'n': 1})
+        self.store.lease('a', 30)
+        self.assertEqual(self.store.cancel(job.id), (True, jobs.RUNNING))
+        self.assertFalse(self.store.heartbeat(job.id, 'a', 30))
+        self.assertEqual(self.store.get(job.id).status, jobs.CANCELLED)
+
+    def test_in_use_lists_paths_of_unfinished_jobs(self):
+        job, _ = self.store.submit({'wav_file': 'a.wav', 'dirname': 'a-2stems'})
+        self.store.submit({'wav_file': 'b.wav'})
+        self.assertEqual(self.store.in_use(), {'a.wav', 'a-2stems', 'b.wav'})
+        self.store.lease('a', 30)
+        self.store.finish(job.id, 'a', jobs.DONE, {'dirname': 'a-2stems'})
+        self.assertEqual(self.store.in_use(), {'b.wav'})
+
+
+class CrashingQueue:
+    """Stands in for a local jobs.JobQueue whose worker process dies on every job."""
+
+    workers = 1
+
+    def __init__(self):
+        self.submitted = threading.Event()
+
+    def submit(self, spec):
+        job = jobs.Job(spec)
+        job.status = jobs.FAILED
+        job.error = 'worker process died'
+        job.crashed = True
+        self.submitted.set()
+        return job
+
+
+class WorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = jobstore.JobStore(os.path.join(self.dir.name, 'jobs.sqlite3'), max_attempts=3)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_crashed_job_is_given_back_and_node_pauses(self):
+        job, _ = self.store.submit({'n': 1})
+        local = CrashingQueue()
+        worker = jobstore.Worker(self.store, local, node='a', lease=30)
+        worker.start()
+        try:
+            self.assertTrue(local.submitted.wait(5))
+            deadline = time.monotonic() + 5
+            while self.store.get(job.id).status != jobs.QUEUED and time.monotonic() < deadline:
+                time.sleep(0.01)
+            time.sleep(jobstore.POLL * 2)
+        finally:
+            worker.stop()
+        job = self.store.get(job.id)
+        # queued again for any node, and not leased again by the paused one
+        self.assertEqual(job.status, jobs.QUEUED)
+        self.assertEqual(self.store.lease('b', 30).id, job.id)
+
+
+if __name__ == '__main__':
+    unittest.main()
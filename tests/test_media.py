@@ -0,0 +1,149 @@
+import io
+import os
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+from vocal import chunked, media
+
+
+def riff(fmt_body, data, extra_chunks=b'', data_size=None):
+    fmt = b'fmt ' + struct.pack('<I', len(fmt_body)) + fmt_body
+    if len(fmt_body) & 1:
+        fmt += b'\0'
+    size = len(data) if data_size is None else data_size
+    body = b'WAVE' + fmt + extra_chunks + b'data' + struct.pack('<I', size) + data
+    return b'RIFF' + struct.pack('<I', len(body)) + body
+
+
+def fmt_chunk(format_tag=media.WAVE_FORMAT_PCM, channels=2, sample_rate=44100, bits=16):
+    block_align = channels * bits // 8
+    return struct.pack('<HHIIHH', format_tag, channels, sample_rate, sample_rate * block_align, block_align, bits)
+
+
+def parse(data, file_size=-1):
+    return media.parse_wav_header(io.BytesIO(data), len(data) if file_size == -1 else file_size)
+
+
+class ParseWavHeaderTest(unittest.TestCase):
+    def test_pcm(self):
+        info = parse(riff(fmt_chunk(), b'\0' * 44100 * 4))
+        self.assertEqual((info.sample_rate, info.channels, info.bits_per_sample), (44100, 2, 16))
+        self.assertEqual(info.format_tag, media.WAVE_FORMAT_PCM)
+        self.assertAlmostEqual(info.duration, 1.0)
+        self.assertEqual((info.data_offset, info.data_size), (44, 44100 * 4))
+
+    def test_skips_other_chunks_word_aligned(self):
+        data = riff(fmt_chunk(channels=1, sample_rate=8000), b'\0' * 1600, extra_chunks=b'LIST' + struct.pack('<I', 3) + b'abc\0')
+        info = parse(data)
+        self.assertEqual(info.data_offset, 56)
+        self.assertAlmostEqual(info.duration, 0.1)
+
+    def test_extensible_uses_the_sub_format(self):
+        body = struct.pack('<HHIIHH', media.WAVE_FORMAT_EXTENSIBLE, 2, 48000, 48000 * 8, 8, 32)
+        body += struct.pack('<HHI', 22, 32, 3) + struct.pack('<H', media.WAVE_FORMAT_IEEE_FLOAT) + b'\0' * 14
+        info = parse(riff(body, b'\0' * 800))
+        self.assertEqual(info.format_tag, media.WAVE_FORMAT_IEEE_FLOAT)
+        self.assertEqual(info.bits_per_sample, 32)
+
+    def test_streamed_size_is_taken_from_the_file(self):
+        for size in (0, 0xFFFFFFFF, 10 ** 9):
+            info = parse(riff(fmt_chunk(), b'\0' * 400, data_size=size))
+            self.assertEqual(info.data_size, 400)
+
+    def test_stream_start_keeps_the_header_size(self):
+        info = parse(riff(fmt_chunk(), b'', data_size=44100 * 4 * 60), file_size=None)
+        self.assertAlmostEqual(info.duration, 60.0)
+
+    def test_not_a_wav(self):
+        self.assertIsNone(parse(b'ID3\x04' + b'\0' * 100))
+        self.assertIsNone(parse(b''))
+
+    def test_truncated_before_data(self):
+        data = riff(fmt_chunk(), b'\0' * 16)
+        self.assertIsNone(parse(data[:30]))
+        # data before fmt
+        self.assertIsNone(parse(b'RIFF' + struct.pack('<I', 20) + b'WAVEdata' + struct.pack('<I', 0)))
+
+
+class ConformsTest(unittest.TestCase):
+    def info(self, format_tag=media.WAVE_FORMAT_PCM, channels=2, sample_rate=44100, bits=16):
+        return parse(riff(fmt_chunk(format_tag, channels, sample_rate, bits), b'\0' * 64))
+
+    def test_pcm16_and_float32_at_the_model_format(self):
+        self.assertTrue(media.conforms(self.info(), 44100, 2))
+        self.assertTrue(media.conforms(self.info(media.WAVE_FORMAT_IEEE_FLOAT, bits=32), 44100, 2))
+
+    def test_anything_else_is_converted(self):
+        self.assertFalse(media.conforms(self.info(sample_rate=48000), 44100, 2))
+        self.assertFalse(media.conforms(self.info(channels=1), 44100, 2))
+        self.assertFalse(media.conforms(self.info(bits=24), 44100, 2))
+        self.assertFalse(media.conforms(self.info(bits=32), 44100, 2))
+        self.assertFalse(media.conforms(None, 44100, 2))
+
+
+class OpenWavTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'a.wav')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_samples_are_mapped_and_scaled(self):
+        samples = np.array([[0, 16384], [-32768, 32767], [8192, -8192]], dtype='<i2')
+        with open(self.path, 'wb') as f:
+            f.write(riff(fmt_chunk(), samples.tobytes(), extra_chunks=b'LIST' + struct.pack('<I', 2) + b'ab'))
+        data, scale, info = media.open_wav(self.path)
+        np.testing.assert_array_equal(data, samples)
+        self.assertEqual(scale, 1 / 32768)
+        np.testing.assert_allclose(chunked.load_wav(self.path), samples / 32768)
+        # not at the model's rate: left to ffmpeg
+        self.assertIsNone(chunked.load_wav(self.path, sample_rate=48000))
+
+    def test_float_wav(self):
+        samples = np.array([[0.25, -0.5]], dtype='<f4')
+        with open(self.path, 'wb') as f:
+            f.write(riff(fmt_chunk(media.WAVE_FORMAT_IEEE_FLOAT, bits=32), samples.tobytes()))
+        data, scale, _ = media.open_wav(self.path)
+        np.testing.assert_array_equal(data, samples)
+        self.assertEqual(scale, 1.0)
+
+    def test_unsupported_format_raises(self):
+        with open(self.path, 'wb') as f:
+            f.write(riff(fmt_chunk(bits=24), b'\0' * 6))
+        with self.assertRaises(ValueError):
+            media.open_wav(self.path)
+
+
+class ProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'a.wav')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, seconds):
+        with open(self.path, 'wb') as f:
+            f.write(riff(fmt_chunk(), b'\0' * int(44100 * 4 * seconds)))
+
+    def test_wav_is_probed_in_process(self):
+        self.write(0.5)
+        self.assertAlmostEqual(media.probe(self.path).duration, 0.5)
+
+    def test_rewritten_file_is_probed_again(self):
+        self.write(0.5)
+        media.probe(self.path)
+        self.write(0.25)
+        os.utime(self.path, ns=(0, 10 ** 9))
+        self.assertAlmostEqual(media.probe(self.path).duration, 0.25)
+
+    def test_missing_file(self):
+        self.assertIsNone(media.probe(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
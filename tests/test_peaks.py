@@ -0,0 +1,156 @@
+import os
+import tempfile
+import unittest
+import wave
+from unittest import mock
+
+import numpy as np
+
+from vocal import cfg, peaks
+
+
+def write_wav(path, samples, sample_rate=44100):
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(samples.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.astype('<i2').tobytes())
+
+
+class SummarizeTest(unittest.TestCase):
+    def test_finest_level(self):
+        data = np.zeros((peaks.PEAK_SAMPLES * 2 + 10, 2), dtype=np.float32)
+        data[5, 0] = 0.5
+        data[7, 1] = -0.25
+        data[peaks.PEAK_SAMPLES:2 * peaks.PEAK_SAMPLES] = 0.1
+        levels, energy = peaks.summarize(data)
+        self.assertEqual(len(levels), 1)
+        samples_per_peak, level = levels[0]
+        self.assertEqual(samples_per_peak, peaks.PEAK_SAMPLES)
+        # the last, partial bucket counts too
+        self.assertEqual(level.shape, (3, 3))
+        self.assertEqual(level.dtype, np.int8)
+        self.assertEqual(level[0, 0], round(-0.25 * 127))
+        self.assertEqual(level[0, 1], round(0.5 * 127))
+        self.assertEqual(list(level[1]), [13, 13, 13])
+        self.assertEqual(list(level[2]), [0, 0, 0])
+        self.assertAlmostEqual(float(energy[1]), 0.01, places=6)
+
+    def test_scale_and_clipping(self):
+        data = np.full((peaks.PEAK_SAMPLES, 1), 16384, dtype=np.int16)
+        (_, level), = peaks.summarize(data, 1 / 32768)[0]
+        self.assertEqual(list(level[0]), [64, 64, 64])
+        (_, level), = peaks.summarize(data, 1.0)[0]
+        self.assertEqual(list(level[0]), [127, 127, 127])
+
+    def test_coarser_levels_merge_buckets(self):
+        count = peaks.MIN_PEAKS * peaks.FACTOR ** 2
+        rng = np.random.default_rng(0)
+        data = rng.uniform(-1, 1, (count * peaks.PEAK_SAMPLES, 1)).astype(np.float32)
+        levels, _ = peaks.summarize(data)
+        self.assertEqual([it[0] for it in levels],
+                         [peaks.PEAK_SAMPLES * peaks.FACTOR ** n for n in range(3)])
+        self.assertEqual([len(it[1]) for it in levels], [count, count // 4, count // 16])
+        fine, coarse = levels[0][1], levels[1][1]
+        np.testing.assert_array_equal(coarse[:, 0], fine[:, 0].reshape(-1, 4).min(axis=1))
+        np.testing.assert_array_equal(coarse[:, 1], fine[:, 1].reshape(-1, 4).max(axis=1))
+        self.assertGreaterEqual(len(levels[-1][1]), peaks.MIN_PEAKS)
+
+    def test_blocks_make_no_difference(self):
+        rng = np.random.default_rng(1)
+        data = rng.uniform(-1, 1, (peaks.BLOCK * 2 + 1000, 2)).astype(np.float32)
+        levels, _ = peaks.summarize(data)
+        with mock.patch.object(peaks, 'BLOCK', peaks.PEAK_SAMPLES * 3):
+            other, _ = peaks.summarize(data)
+        np.testing.assert_array_equal(levels[0][1], other[0][1])
+
+
+class PreviewWindowTest(unittest.TestCase):
+    def test_loudest_window_over_all_stems(self):
+        quiet = np.zeros(1000)
+        loud = np.zeros(1000)
+        loud[600:650] = 1.0
+        start, duration = peaks.preview_window([quiet, loud], 44100, 50 * peaks.PEAK_SAMPLES / 44100)
+        self.assertAlmostEqual(start, 600 * peaks.PEAK_SAMPLES / 44100)
+        self.assertAlmostEqual(duration, 50 * peaks.PEAK_SAMPLES / 44100)
+
+    def test_short_track_is_previewed_whole(self):
+        self.assertEqual(peaks.preview_window([np.ones(10)], 44100, 30), (0.0, 10 * peaks.PEAK_SAMPLES / 44100))
+
+
+class BuildTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        patch = mock.patch.object(cfg, 'PREVIEW_SECONDS', 0)
+        patch.start()
+        self.addCleanup(patch.stop)
+        rng = np.random.default_rng(2)
+        count = peaks.MIN_PEAKS * peaks.FACTOR
+        write_wav(os.path.join(self.dir.name, 'vocals.wav'), rng.integers(-9000, 9000, (count * peaks.PEAK_SAMPLES, 2)))
+        write_wav(os.path.join(self.dir.name, 'drums.wav'), rng.integers(-9000, 9000, (count * peaks.PEAK_SAMPLES, 2)))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_build_dir_and_read_levels(self):
+        index = peaks.build_dir(self.dir.name)
+        self.assertEqual(peaks.load(self.dir.name), index)
+        self.assertEqual(sorted(index['stems']), ['drums', 'vocals'])
+        self.assertNotIn('preview', index)
+        counts = [it['count'] for it in index['stems']['vocals']['levels']]
+        self.assertEqual(counts, [peaks.MIN_PEAKS * peaks.FACTOR, peaks.MIN_PEAKS])
+        # the coarsest level with at least width peaks
+        level, data = peaks.read_level(self.dir.name, 'vocals', index, width=600)
+        self.assertEqual(level['count'], peaks.MIN_PEAKS * peaks.FACTOR)
+        self.assertEqual(len(data), level['count'] * 3)
+        level, data = peaks.read_level(self.dir.name, 'vocals', index, width=100)
+        self.assertEqual(level['count'], peaks.MIN_PEAKS)
+        self.assertEqual(peaks.read_level(self.dir.name, 'vocals', index)[0]['count'], counts[0])
+        # the coarse level is stored right after the fine one
+        fine = np.frombuffer(peaks.read_level(self.dir.name, 'vocals', index)[1], dtype=np.int8).reshape(-1, 3)
+        coarse = np.frombuffer(data, dtype=np.int8).reshape(-1, 3)
+        np.testing.assert_array_equal(coarse[:, 1], fine[:, 1].reshape(-1, 4).max(axis=1))
+
+    def test_no_stems(self):
+        empty = os.path.join(self.dir.name, 'empty')
+        os.makedirs(empty)
+        self.assertIsNone(peaks.build_dir(empty))
+        self.assertIsNone(peaks.load(empty))
+
+
+class PeaksRouteTest(unittest.TestCase):
+    def setUp(self):
+        import start
+        self.dir = tempfile.TemporaryDirectory()
+        for patch in (mock.patch.object(cfg, 'FILES_DIR', self.dir.name), mock.patch.object(cfg, 'PREVIEW_SECONDS', 0)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        stems = os.path.join(self.dir.name, 'abc-2stems')
+        os.makedirs(stems)
+        rng = np.random.default_rng(3)
+        for stem in ('vocals', 'drums'):
+            write_wav(os.path.join(stems, f'{stem}.wav'),
+                      rng.integers(-9000, 9000, (peaks.MIN_PEAKS * peaks.FACTOR * peaks.PEAK_SAMPLES, 2)))
+        self.client = start.app.test_client()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_index_is_built_on_request_and_levels_served(self):
+        data = self.client.get('/peaks/abc-2stems').get_json()['data']
+        self.assertEqual(sorted(data['stems']), ['drums', 'vocals'])
+        self.assertTrue(data['stems']['vocals']['url'].endswith('/static/files/abc-2stems/vocals.wav'))
+        response = self.client.get('/peaks/abc-2stems/vocals?width=100&format=bin')
+        self.assertEqual(response.headers['X-Peak-Count'], str(peaks.MIN_PEAKS))
+        self.assertEqual(len(response.data), peaks.MIN_PEAKS * 3)
+        level = self.client.get('/peaks/abc-2stems/drums?width=600').get_json()['data']
+        self.assertEqual(level['count'], peaks.MIN_PEAKS * peaks.FACTOR)
+
+    def test_unknown_folder_or_stem_is_404(self):
+        for url in ('/peaks/missing', '/peaks/..', '/peaks/.hidden', '/peaks/abc-2stems/piano',
+                    '/peaks/missing/vocals'):
+            self.assertEqual(self.client.get(url).status_code, 404, url)
+
+
+if __name__ == '__main__':
+    unittest.main()
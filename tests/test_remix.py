@@ -0,0 +1,130 @@
+import io
+import os
+import tempfile
+import unittest
+import wave
+from unittest import mock
+
+import numpy as np
+
+from vocal import cfg, media, remix, separation
+
+
+def write_wav(path, samples, sample_rate=44100):
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(samples.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.astype('<i2').tobytes())
+
+
+def pcm(data):
+    data = data[44:] if data[:4] == b'RIFF' else data
+    return np.frombuffer(data, dtype='<i2').reshape(-1, 2)
+
+
+class RemixTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.vocals = os.path.join(self.dir.name, 'vocals.wav')
+        self.drums = os.path.join(self.dir.name, 'drums.wav')
+        rng = np.random.default_rng(0)
+        self.v = rng.integers(-8000, 8000, (1000, 2))
+        self.d = rng.integers(-8000, 8000, (1000, 1))
+        write_wav(self.vocals, self.v)
+        write_wav(self.drums, self.d)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_gains_are_applied_and_summed(self):
+        mix = remix.Remix({self.vocals: 0.5, self.drums: 2.0})
+        data = b''.join(mix.stream())
+        self.assertEqual(len(data), mix.size)
+        info = media.parse_wav_header(io.BytesIO(data), len(data))
+        self.assertEqual((info.channels, info.sample_rate, info.data_size), (2, 44100, 4000))
+        # the mono stem goes to both channels
+        expected = self.v * 0.5 + self.d * 2.0
+        np.testing.assert_allclose(pcm(data), expected, atol=2)
+
+    def test_mix_is_clipped(self):
+        mix = remix.Remix({self.vocals: 10, self.drums: 10})
+        out = pcm(b''.join(mix.stream())).astype(int)
+        self.assertLessEqual(out.max(), 32767)
+        self.assertGreaterEqual(out.min(), -32767)
+        self.assertEqual(np.abs(out).max(), 32767)
+
+    def test_blocks_make_no_difference(self):
+        mix = remix.Remix({self.vocals: 0.3, self.drums: 1.2})
+        whole = b''.join(mix.blocks(block=4096))
+        self.assertEqual(b''.join(mix.blocks(block=7)), whole)
+
+    def test_silent_stem_is_left_out(self):
+        mix = remix.Remix({self.vocals: 1.0, self.drums: 0})
+        self.assertEqual(len(mix.sources), 1)
+        np.testing.assert_allclose(pcm(b''.join(mix.stream())), self.v, atol=1)
+
+    def test_no_stems(self):
+        with self.assertRaises(ValueError):
+            remix.Remix({})
+
+    def test_cache_name(self):
+        name = remix.cache_name({'vocals': 0.5, 'drums': 1}, 'mp3')
+        self.assertEqual(name, remix.cache_name({'drums': 1.0, 'vocals': 0.50001, 'bass': 0}, 'mp3', '192k'))
+        self.assertNotEqual(name, remix.cache_name({'vocals': 0.5, 'drums': 1}, 'mp3', '320k'))
+        self.assertNotEqual(name, remix.cache_name({'vocals': 0.5, 'drums': 1}, 'flac'))
+        self.assertTrue(name.startswith('remix-') and name.endswith('.mp3'))
+
+
+class RemixRouteTest(unittest.TestCase):
+    def setUp(self):
+        import start
+        self.dir = tempfile.TemporaryDirectory()
+        patch = mock.patch.object(cfg, 'FILES_DIR', self.dir.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.stems = os.path.join(self.dir.name, 'abc-2stems')
+        os.makedirs(self.stems)
+        rng = np.random.default_rng(1)
+        self.vocals = rng.integers(-8000, 8000, (500, 2))
+        self.accompaniment = rng.integers(-8000, 8000, (500, 2))
+        write_wav(os.path.join(self.stems, 'vocals.wav'), self.vocals)
+        write_wav(os.path.join(self.stems, 'accompaniment.wav'), self.accompaniment)
+        self.client = start.app.test_client()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_exclude_and_cache(self):
+        response = self.client.get('/remix/abc-2stems?exclude=vocals')
+        self.assertEqual(response.status_code, 200)
+        np.testing.assert_allclose(pcm(response.data), self.accompaniment, atol=1)
+        self.assertEqual(len(os.listdir(os.path.join(self.stems, remix.REMIX_DIR))), 1)
+        # kept apart from the stems
+        self.assertEqual(separation.list_stems(self.stems), ['accompaniment.wav', 'vocals.wav'])
+        again = self.client.get('/remix/abc-2stems?exclude=vocals')
+        self.assertEqual(again.data, response.data)
+        again.close()
+
+    def test_json_gains(self):
+        response = self.client.post('/remix/abc-2stems', json={'gains': {'vocals': 0.5, 'accompaniment': 0}})
+        self.assertEqual(response.status_code, 200)
+        np.testing.assert_allclose(pcm(response.data), self.vocals * 0.5, atol=1)
+
+    def test_invalid_input_is_400(self):
+        for url in ('/remix/abc-2stems?gain.vocals=11', '/remix/abc-2stems?gain.vocals=nan',
+                    '/remix/abc-2stems?gain.vocals=loud', '/remix/abc-2stems?gain.piano=1',
+                    '/remix/abc-2stems?stems=drums', '/remix/abc-2stems?format=xyz',
+                    '/remix/abc-2stems?format=mp3&bitrate=1k;rm'):
+            self.assertEqual(self.client.get(url).status_code, 400, url)
+        for body in ({'gains': [1, 2]}, {'gains': {'vocals': True}}, {'gains': {'vocals': -1}},
+                     {'stems': 5}, {'exclude': [1]}):
+            self.assertEqual(self.client.post('/remix/abc-2stems', json=body).status_code, 400, body)
+
+    def test_unknown_folder_is_404(self):
+        for name in ('missing', '..', '.hidden', 'abc-2stems%2F..'):
+            self.assertEqual(self.client.get(f'/remix/{name}').status_code, 404, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
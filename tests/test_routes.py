@@ -0,0 +1,172 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from vocal import batch, cache, cfg, jobs, models, transcode
+
+
+class RouteTest(unittest.TestCase):
+    def setUp(self):
+        import start
+        self.dir = tempfile.TemporaryDirectory()
+        self.files = os.path.join(self.dir.name, 'files')
+        self.tmp = os.path.join(self.dir.name, 'tmp')
+        os.makedirs(os.path.join(self.files, 'abc-2stems'))
+        os.makedirs(self.tmp)
+        with open(os.path.join(self.files, 'abc-2stems', 'vocals.wav'), 'wb') as f:
+            f.write(b'RIFF')
+        for patch in (mock.patch.object(cfg, 'FILES_DIR', self.files), mock.patch.object(cfg, 'TMP_DIR', self.tmp)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = start.app.test_client()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+
+class DownloadTest(RouteTest):
+    def setUp(self):
+        super().setUp()
+        self.encoded = []
+
+        def encode(source, target, codec, bitrate=None, timeout=None):
+            self.encoded.append((os.path.relpath(target, self.files), codec, bitrate))
+            shutil.copy(source, target)
+        patch = mock.patch.object(transcode, 'encode', encode)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_stored_stem(self):
+        response = self.client.get('/download/abc-2stems/vocals.wav')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'RIFF')
+        response.close()
+        self.assertEqual(self.encoded, [])
+
+    def test_other_codec_is_transcoded_once(self):
+        for _ in range(2):
+            response = self.client.get('/download/abc-2stems/vocals.flac')
+            self.assertEqual(response.status_code, 200)
+            response.close()
+        self.assertEqual(self.encoded, [('abc-2stems/vocals.flac', 'flac', None)])
+
+    def test_explicit_bitrate_goes_to_variants(self):
+        response = self.client.get('/download/abc-2stems/vocals.mp3?bitrate=128k')
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        self.assertEqual(self.encoded, [(os.path.join('abc-2stems', 'variants', 'vocals.128k.mp3'), 'mp3', '128k')])
+
+    def test_invalid_bitrate_is_400(self):
+        for bitrate in ('128', '0k', '99999k', '128k -y', '../128k'):
+            response = self.client.get('/download/abc-2stems/vocals.mp3', query_string={'bitrate': bitrate})
+            self.assertEqual(response.status_code, 400, bitrate)
+        self.assertEqual(self.encoded, [])
+
+    def test_unknown_or_outside_paths_are_404(self):
+        for url in ('/download/abc-2stems/piano.wav', '/download/abc-2stems/vocals.xyz',
+                    '/download/missing/vocals.wav', '/download/../vocals.wav', '/download/.abc/vocals.wav',
+                    '/download/abc-2stems/variants/vocals.wav', '/download/abc-2stems/.vocals.wav',
+                    '/download/abc-2stems/..%2Fvocals.wav'):
+            self.assertEqual(self.client.get(url).status_code, 404, url)
+        self.assertEqual(self.encoded, [])
+
+
+class BatchTest(RouteTest):
+    def setUp(self):
+        super().setUp()
+        self.root = os.path.join(self.dir.name, 'media')
+        os.makedirs(os.path.join(self.root, 'album'))
+        self.queue = mock.Mock()
+        self.queue.submit.return_value = jobs.Job({})
+        for patch in (mock.patch.object(cfg, 'BATCH_ROOT', self.root), mock.patch.object(jobs, 'job_queue', self.queue),
+                      mock.patch.object(models, 'model_exists', lambda model: model == '2stems')):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def post(self, inputs, model='2stems'):
+        return self.client.post('/batch', data={'model': model, 'inputs': inputs})
+
+    def test_inputs_under_the_root_are_submitted(self):
+        response = self.post('album\n*.mp3')
+        self.assertEqual(response.get_json()['code'], 0)
+        spec = self.queue.submit.call_args[0][0]
+        self.assertEqual((spec['kind'], spec['inputs'], spec['root']), ('batch', ['album', '*.mp3'], self.root))
+        self.assertEqual(os.path.dirname(spec['dirname']), self.files)
+
+    def test_inputs_outside_the_root_are_400(self):
+        os.symlink(self.dir.name, os.path.join(self.root, 'link'))
+        for inputs in ('../files', '/etc/passwd', 'album/../..', 'link/files', 'album\n../tmp'):
+            self.assertEqual(self.post(inputs).status_code, 400, inputs)
+        self.queue.submit.assert_not_called()
+
+    def test_disabled_without_a_root(self):
+        with mock.patch.object(cfg, 'BATCH_ROOT', ''):
+            self.assertEqual(self.post('album').status_code, 403)
+
+    def test_unknown_model_or_no_inputs(self):
+        self.assertEqual(self.post('album', model='9stems').get_json()['code'], 1)
+        self.assertEqual(self.post(' \n ').get_json()['code'], 1)
+        self.queue.submit.assert_not_called()
+
+    def test_inside(self):
+        self.assertTrue(batch.inside(os.path.join(self.root, 'album'), self.root))
+        self.assertTrue(batch.inside(self.root, self.root))
+        self.assertFalse(batch.inside(os.path.join(self.root, '..'), self.root))
+        self.assertFalse(batch.inside(self.root + '2', self.root))
+
+
+class JobRoutesTest(RouteTest):
+    def setUp(self):
+        super().setUp()
+        with open(os.path.join(self.tmp, 'abc.wav'), 'wb') as f:
+            f.write(b'RIFF')
+
+        def run(job_id, spec):
+            return {'dirname': os.path.join(self.files, 'abc-2stems'), 'files': ['vocals.wav'], 'bitrate': None}
+        self.queue = jobs.JobQueue(workers=0)
+        for patch in (mock.patch.object(jobs, '_run', run), mock.patch.object(jobs, '_init_worker', lambda *args: None),
+                      mock.patch.object(jobs, 'job_queue', self.queue), mock.patch.object(cache, 'result_cache', mock.Mock()),
+                      mock.patch.object(models, 'model_exists', lambda model: model == '2stems')):
+            patch.start()
+            self.addCleanup(patch.stop)
+        cache.result_cache.lookup_stems.return_value = None
+
+    def tearDown(self):
+        self.queue.shutdown()
+        super().tearDown()
+
+    def test_submit_and_result(self):
+        data = self.client.post('/jobs', data={'wav_name': 'abc.wav', 'model': '2stems'}).get_json()
+        self.assertEqual(data['code'], 0)
+        job_id = data['data']['job_id']
+        self.assertEqual(self.queue.wait(job_id, timeout=5).status, jobs.DONE)
+        self.assertEqual(self.client.get(f'/jobs/{job_id}').get_json()['data']['status'], jobs.DONE)
+        result = self.client.get(f'/jobs/{job_id}/result').get_json()
+        self.assertTrue(result['data'][0].endswith('/static/files/abc-2stems/vocals.wav'))
+        result = self.client.get(f'/jobs/{job_id}/result?codec=mp3').get_json()
+        self.assertIn('/download/abc-2stems/vocals.mp3', result['data'][0])
+        self.assertEqual(self.client.get(f'/jobs/{job_id}/result?codec=xyz').status_code, 400)
+        self.assertEqual(self.client.get(f'/jobs/{job_id}/result?codec=mp3&bitrate=fast').status_code, 400)
+
+    def test_wav_name_outside_tmp_is_400(self):
+        for wav_name in ('../files/abc-2stems/vocals.wav', '/etc/passwd', 'sub/abc.wav', '.abc.wav', '..'):
+            for url in ('/jobs', '/process'):
+                response = self.client.post(url, data={'wav_name': wav_name, 'model': '2stems'})
+                self.assertEqual(response.status_code, 400, (url, wav_name))
+        self.assertEqual(self.queue.pending(), 0)
+
+    def test_missing_wav_or_model(self):
+        self.assertEqual(self.client.post('/jobs', data={'wav_name': 'nope.wav', 'model': '2stems'}).get_json()['code'], 1)
+        self.assertEqual(self.client.post('/jobs', data={'wav_name': 'abc.wav', 'model': '9stems'}).get_json()['code'], 1)
+
+    def test_unknown_job_is_404(self):
+        self.assertEqual(self.client.get('/jobs/nope').status_code, 404)
+        self.assertEqual(self.client.get('/jobs/nope/result').status_code, 404)
+        self.assertEqual(self.client.delete('/jobs/nope').status_code, 404)
+        self.assertEqual(self.client.post('/jobs/nope/cancel').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
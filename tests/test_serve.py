@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+import urllib.request
+from unittest import mock
+
+import gevent
+from flask import Flask, send_file
+from gevent.pywsgi import WSGIServer
+
+from vocal import serve
+
+
+class SendfileHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'stem.wav')
+        self.data = bytes(range(256)) * 400
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        app = Flask(__name__)
+        app.add_url_rule('/file', 'file', lambda: send_file(self.path, conditional=True))
+        self.server = WSGIServer(('127.0.0.1', 0), app, handler_class=serve.SendfileHandler, log=None)
+        self.server.start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/file'
+        self.sent = []
+        original = os.sendfile
+
+        def sendfile(out_fd, in_fd, offset, count):
+            self.sent.append((offset, count))
+            return original(out_fd, in_fd, offset, count)
+        self.patch = mock.patch.object(os, 'sendfile', sendfile)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.server.stop()
+        self.dir.cleanup()
+
+    def fetch(self, headers=None):
+        # from a thread, the server runs in this one's hub
+        return gevent.get_hub().threadpool.apply(
+            lambda: urllib.request.urlopen(urllib.request.Request(self.url, headers=headers or {})).read())
+
+    def test_whole_file_is_sent_with_sendfile(self):
+        self.assertEqual(self.fetch(), self.data)
+        self.assertEqual(self.sent[0], (0, len(self.data)))
+
+    def test_byte_range_is_sent_with_sendfile(self):
+        self.assertEqual(self.fetch({'Range': 'bytes=1000-2999'}), self.data[1000:3000])
+        self.assertEqual(self.sent[0], (1000, 2000))
+
+    def test_content_range(self):
+        self.assertEqual(serve.content_range([(b'Content-Range', b'bytes 10-19/100')]), (10, 10))
+        self.assertEqual(serve.content_range([('content-range', 'bytes 0-0/*')]), (0, 1))
+        self.assertIsNone(serve.content_range([('Content-Type', 'audio/wav')]))
+        self.assertIsNone(serve.content_range([('Content-Range', 'bytes */100')]))
+
+
+if __name__ == '__main__':
+    unittest.main()
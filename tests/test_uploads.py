@@ -0,0 +1,145 @@
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from vocal import uploads
+
+
+class UploadStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = uploads.UploadStore(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_chunks_append_at_their_offset(self):
+        upload = self.store.create('movie.mp4', size=10)
+        self.assertEqual(upload.write(0, io.BytesIO(b'hello')), 5)
+        self.assertFalse(upload.complete)
+        self.assertEqual(upload.write(5, io.BytesIO(b'world')), 10)
+        self.assertTrue(upload.complete)
+        with open(upload.path, 'rb') as f:
+            self.assertEqual(f.read(), b'helloworld')
+        self.assertEqual(upload.digest(), hashlib.sha256(b'helloworld').hexdigest()[:32])
+
+    def test_wrong_offset_is_refused_with_the_current_one(self):
+        upload = self.store.create('movie.mp4')
+        upload.write(0, io.BytesIO(b'abc'))
+        for offset in (0, 2, 4):
+            with self.assertRaises(uploads.OffsetMismatch) as e:
+                upload.write(offset, io.BytesIO(b'x'))
+            self.assertEqual(e.exception.offset, 3)
+        self.assertEqual(upload.offset, 3)
+
+    def test_more_than_the_announced_size(self):
+        upload = self.store.create('movie.mp4', size=4)
+        with self.assertRaises(ValueError):
+            upload.write(0, io.BytesIO(b'12345'))
+
+    def test_broken_chunk_keeps_what_arrived(self):
+        class Broken(io.BytesIO):
+            def read(self, n=-1):
+                if self.tell():
+                    raise OSError('connection reset')
+                return super().read(3)
+        upload = self.store.create('movie.mp4')
+        with self.assertRaises(OSError):
+            upload.write(0, Broken(b'abcdef'))
+        self.assertEqual(upload.offset, 3)
+        self.assertEqual(upload.write(3, io.BytesIO(b'def')), 6)
+
+    def test_session_is_restored_by_another_store(self):
+        upload = self.store.create('movie.mp4', size=6)
+        upload.write(0, io.BytesIO(b'abc'))
+        other = uploads.UploadStore(self.dir.name, stream_decode=False)
+        restored = other.get(upload.id)
+        self.assertEqual((restored.offset, restored.size, restored.filename), (3, 6, 'movie.mp4'))
+        # both take the offset from the file from now on
+        restored.write(3, io.BytesIO(b'def'))
+        self.assertEqual(restored.digest(), hashlib.sha256(b'abcdef').hexdigest()[:32])
+
+    def test_unknown_and_foreign_ids(self):
+        for upload_id in ('0' * 32, '../../etc/passwd', 'x'):
+            with self.assertRaises(uploads.UploadNotFound):
+                self.store.get(upload_id)
+
+    def test_deleted_part_file_ends_the_session(self):
+        upload = self.store.create('movie.mp4')
+        upload.write(0, io.BytesIO(b'abc'))
+        os.remove(upload.path)
+        with self.assertRaises(uploads.UploadNotFound):
+            self.store.get(upload.id)
+
+    def test_idle_sessions_expire(self):
+        store = uploads.UploadStore(self.dir.name, ttl=60)
+        upload = store.create('movie.mp4')
+        self.assertIn(upload.path, store.in_use())
+        upload.updated -= 120
+        past = upload.updated
+        os.utime(upload.path, (past, past))
+        os.utime(upload.meta, (past, past))
+        self.assertNotIn(upload.path, store.in_use())
+        self.assertEqual(store.expire(), [upload.id])
+        self.assertFalse(os.path.exists(upload.path))
+
+
+class UploadRoutesTest(unittest.TestCase):
+    def setUp(self):
+        import start
+        self.dir = tempfile.TemporaryDirectory()
+        patch = mock.patch.object(uploads, 'store', uploads.UploadStore(self.dir.name))
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.client = start.app.test_client()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def create(self, size):
+        data = self.client.post('/uploads', json={'filename': 'movie.mp4', 'size': size}).get_json()
+        self.assertEqual(data['code'], 0)
+        return data['data']['upload_id']
+
+    def test_put_and_resume(self):
+        upload_id = self.create(6)
+        response = self.client.put(f'/uploads/{upload_id}', data=b'abc', headers={'Upload-Offset': '0'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Upload-Offset'], '3')
+        # a retried chunk is refused with the offset to continue from
+        response = self.client.put(f'/uploads/{upload_id}', data=b'abc', headers={'Upload-Offset': '0'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.headers['Upload-Offset'], '3')
+        response = self.client.get(f'/uploads/{upload_id}')
+        self.assertEqual(response.get_json()['data']['offset'], 3)
+        response = self.client.put(f'/uploads/{upload_id}?offset=3', data=b'def')
+        self.assertTrue(response.get_json()['data']['complete'])
+
+    def test_finalize_before_complete(self):
+        upload_id = self.create(6)
+        self.client.put(f'/uploads/{upload_id}', data=b'abc', headers={'Upload-Offset': '0'})
+        response = self.client.post(f'/uploads/{upload_id}/finalize')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.headers['Upload-Offset'], '3')
+
+    def test_unknown_upload(self):
+        self.assertEqual(self.client.get('/uploads/' + '0' * 32).status_code, 404)
+        self.assertEqual(self.client.put('/uploads/' + '0' * 32, data=b'x', headers={'Upload-Offset': '0'}).status_code, 404)
+        self.assertEqual(self.client.delete('/uploads/nope').status_code, 404)
+
+    def test_delete(self):
+        upload_id = self.create(None)
+        self.assertEqual(self.client.delete(f'/uploads/{upload_id}').get_json()['code'], 0)
+        self.assertEqual(self.client.get(f'/uploads/{upload_id}').status_code, 404)
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+    def test_bad_extension(self):
+        data = self.client.post('/uploads', json={'filename': 'notes.txt'}).get_json()
+        self.assertEqual(data['code'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+"""
+Separate many files with one model load.
+
+    python -m vocal.batch ./songs --model 2stems --out ./static/files/batch
+    python -m vocal.batch "./songs/**/*.mp3" manifest.txt --report report.json
+
+Inputs may be directories (searched recursively), glob patterns, or manifests: a
+.txt file with one path per line, or a .json/.jsonl file of paths or {"path": ...}
+objects. Decoding, inference and writing run as a pipeline: decoder threads read the
+next files while the model separates the current one and writer threads save the
+previous one's stems. A JSON report records the outcome of every file.
+"""
+import argparse
+import glob
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from vocal import cfg, chunked, media, models
+
+EXTS = ['.wav', '.mp3', '.flac', '.mp4', '.mov', '.avi', '.mkv', '.mpeg']
+
+
+def _read_manifest(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.json'):
+            items = json.load(f)
+        elif path.endswith('.jsonl'):
+            items = [json.loads(line) for line in f if line.strip()]
+        else:
+            items = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    base = os.path.dirname(os.path.abspath(path))
+    for item in items:
+        item = item['path'] if isinstance(item, dict) else item
+        yield item if os.path.isabs(item) else os.path.join(base, item)
+
+
+def inside(path, root):
+    """True when path resolves, symlinks followed, to root or below it."""
+    root = os.path.realpath(root)
+    return os.path.commonpath([os.path.realpath(path), root]) == root
+
+
+def collect(inputs, root=None):
+    """
+    Expand directories, globs and manifests into a de-duplicated list of media files.
+    With root, relative inputs are relative to it and files resolving outside it are left out.
+    """
+    if root is not None:
+        inputs = [os.path.join(root, it) for it in inputs]
+    files = []
+    for it in inputs:
+        if os.path.isdir(it):
+            for folder, _, names in os.walk(it):
+                files += [os.path.join(folder, n) for n in sorted(names) if os.path.splitext(n)[1].lower() in EXTS]
+        elif os.path.isfile(it) and os.path.splitext(it)[1].lower() in ['.txt', '.json', '.jsonl']:
+            files += list(_read_manifest(it))
+        elif os.path.isfile(it):
+            files.append(it)
+        else:
+            files += sorted(p for p in glob.glob(it, recursive=True) if os.path.splitext(p)[1].lower() in EXTS)
+    seen = set()
+    unique = []
+    for path in map(os.path.abspath, files):
+        if root is not None and not inside(path, root):
+            continue
+        if path not in seen:
+            seen.add(path)
+            unique.append(path)
+    return unique
+
+
+def _output_names(files):
+    # <stem name> per file, suffixed when two inputs share a name
+    names = {}
+    result = []
+    for path in files:
+        name = os.path.splitext(os.path.basename(path))[0]
+        count = names.get(name, 0)
+        names[name] = count + 1
+        result.append(name if count == 0 else f'{name}-{count}')
+    return result
+
+
+def _decode(path):
+    started = time.time()
+    info = media.probe(path)
+    if info is None:
+        raise ValueError(f'{path}: unreadable audio')
+    if info.duration > cfg.SEGMENT_MIN_DURATION:
+        # too long to hold in memory, the inference stage streams it in windows
+        return None, info, time.time() - started
+    blocks = list(chunked.read_frames(path, chunked.SAMPLE_RATE * 10))
+    waveform = np.concatenate(blocks) if blocks else np.zeros((0, chunked.CHANNELS), dtype=np.float32)
+    return waveform, info, time.time() - started
+
+
+def _write(dirname, stems):
+    started = time.time()
+    writer = chunked.StemWriter(dirname)
+    try:
+        for instrument, samples in stems.items():
+            writer.write(instrument, samples)
+    finally:
+        writer.close()
+    return time.time() - started
+
+
+def run(inputs, model, out_dir, report=None, decoders=2, writers=2, progress=None, root=None):
+    """
+    Separate every file matched by inputs with model into out_dir/<name>/.
+    Returns the report dict, also written to `report` (default out_dir/report.json).
+    progress(fraction) is called after each file. With root (batches submitted over
+    HTTP) only files inside root are read, and the report has no absolute paths.
+    """
+    files = collect(inputs, root)
+    names = _output_names(files)
+    os.makedirs(out_dir, exist_ok=True)
+    report = report or os.path.join(out_dir, 'report.json')
+    results = [{'input': path, 'output': os.path.join(out_dir, name), 'status': 'pending'}
+               for path, name in zip(files, names)]
+    started = time.time()
+
+    # bound the decoded files waiting in memory for the model
+    decoded = queue.Queue(maxsize=max(1, decoders))
+
+    def feed(pool):
+        for i, path in enumerate(files):
+            decoded.put((i, pool.submit(_decode, path)))
+        decoded.put(None)
+
+    with ThreadPoolExecutor(max_workers=max(1, decoders)) as decode_pool, \
+            ThreadPoolExecutor(max_workers=max(1, writers)) as write_pool, \
+            models.registry.use(model) as separator:
+        threading.Thread(target=feed, args=(decode_pool,), daemon=True).start()
+        pending_writes = []
+        done = 0
+        while True:
+            item = decoded.get()
+            if item is None:
+                break
+            i, future = item
+            result = results[i]
+            try:
+                waveform, info, result['decode_seconds'] = future.result()
+                result['duration'] = info.duration
+                os.makedirs(result['output'], exist_ok=True)
+                t = time.time()
+                if waveform is None:
+                    chunked.separate_chunked(separator, result['input'], result['output'],
+                                             segment=cfg.SEGMENT_SECONDS, overlap=cfg.SEGMENT_OVERLAP,
+                                             batch=cfg.INFERENCE_BATCH)
+                    result['separate_seconds'] = time.time() - t
+                    result['write_seconds'] = 0.0
+                    result['status'] = 'done'
+                else:
+                    stems = separator.separate(waveform)
+                    result['separate_seconds'] = time.time() - t
+                    pending_writes.append((i, write_pool.submit(_write, result['output'], stems)))
+                    del stems
+                    # don't let separated stems pile up in memory when writing is the bottleneck
+                    unfinished = [f for _, f in pending_writes if not f.done()]
+                    if len(unfinished) > max(1, writers):
+                        unfinished[0].exception()
+            except Exception as e:
+                result['status'] = 'failed'
+                result['error'] = str(e)
+            done += 1
+            if progress is not None and files:
+                progress(done / len(files))
+
+        for i, future in pending_writes:
+            try:
+                results[i]['write_seconds'] = future.result()
+                results[i]['status'] = 'done'
+            except Exception as e:
+                results[i]['status'] = 'failed'
+                results[i]['error'] = str(e)
+
+    for result in results:
+        if result['status'] == 'done':
+            result['files'] = sorted(it for it in os.listdir(result['output']) if it.endswith('.wav'))
+    if root is not None:
+        for result in results:
+            result['input'] = os.path.relpath(result['input'], root)
+            result['output'] = os.path.basename(result['output'])
+    data = {
+        'model': model,
+        'out_dir': out_dir if root is None else os.path.basename(out_dir),
+        'total': len(results),
+        'done': sum(1 for r in results if r['status'] == 'done'),
+        'failed': sum(1 for r in results if r['status'] == 'failed'),
+        'seconds': time.time() - started,
+        'files': results,
+    }
+    with open(report, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m vocal.batch', description='Separate many files with one model load')
+    parser.add_argument('inputs', nargs='+', help='directories, glob patterns or manifest files (.txt/.json/.jsonl)')
+    parser.add_argument('--model', default='2stems', choices=models.MODELS)
+    parser.add_argument('--out', default=os.path.join(cfg.FILES_DIR, 'batch'), help='output directory')
+    parser.add_argument('--report', default=None, help='JSON report path, default <out>/report.json')
+    parser.add_argument('--decoders', type=int, default=2, help='files decoded ahead of the model')
+    parser.add_argument('--writers', type=int, default=2, help='threads writing stems')
+    args = parser.parse_args(argv)
+
+    if not models.model_exists(args.model):
+        print(f"{args.model} {cfg.transobj['lang4']}")
+        return 1
+    data = run(args.inputs, args.model, args.out, args.report, args.decoders, args.writers,
+               progress=lambda fraction: print(f'\r{fraction * 100:.1f}%', end='', flush=True))
+    print(f"\n{data['done']}/{data['total']} done, {data['failed']} failed in {data['seconds']:.1f}s")
+    return 0 if data['failed'] == 0 else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
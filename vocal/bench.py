@@ -0,0 +1,403 @@
+"""
+Benchmark the conversion and separation pipeline.
+
+    python -m vocal.bench --out bench.json
+    python -m vocal.bench --lengths 10 60 --models 2stems --http-clients 4 --http-requests 8
+    python -m vocal.bench --stages inference --models 2stems --variants "" batch=4 workers=2,affinity=auto
+
+Synthetic audio (a few sines and noise) is generated for every length and channel
+layout, then each stage is timed: ffmpeg conversion through tool.runffmpeg, model load,
+and separation of every file with every model on the CPU. Each model runs in a fresh
+process so load times and peak RSS are not flattered by an earlier run. The HTTP stage
+starts the app on a free port and drives /upload + /process and /api with concurrent
+clients. Every result records seconds, the real-time factor (seconds of work per second
+of audio) and peak RSS, and the whole report is written as JSON so two commits can be
+compared with a diff.
+
+The inference stage compares inference settings (threads, CPU pinning, windows per
+inference call, precision, concurrent workers): every variant separates the same file
+in segmented mode on `workers` fresh processes started together, and reports their
+combined throughput in seconds of audio per second.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from vocal import cfg, models
+
+LAYOUTS = {'mono': 1, 'stereo': 2}
+# inference variant keys and the setting each one overrides, see cfg
+VARIANT_ENV = {
+    'threads': 'VOCAL_TF_INTRA_THREADS',
+    'inter': 'VOCAL_TF_INTER_THREADS',
+    'affinity': 'VOCAL_CPU_AFFINITY',
+    'batch': 'VOCAL_INFERENCE_BATCH',
+    'precision': 'VOCAL_PRECISION',
+    'workers': 'VOCAL_JOB_WORKERS',
+}
+DEFAULT_VARIANTS = ['', 'batch=2', 'batch=4', 'workers=2', 'workers=2,affinity=auto', 'precision=mixed']
+# checkout holding start.py, cfg.ROOT_DIR is the working directory
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def synth(path, seconds, channels=2, sample_rate=44100, seed=0):
+    """Write a PCM16 WAV of sines and noise, different for every seed."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate), dtype=np.float32) / sample_rate
+    freqs = rng.uniform(110, 880, size=3)
+    signal = sum(np.sin(2 * np.pi * f * t) for f in freqs) / 6
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        # write in blocks, an hour of audio shouldn't need an hour sized buffer
+        block = sample_rate * 10
+        for i in range(0, len(t), block):
+            part = signal[i:i + block, None] + rng.normal(0, 0.05, (len(t[i:i + block]), channels))
+            f.writeframes((np.clip(part, -1, 1) * 32767).astype('<i2').tobytes())
+    return path
+
+
+def peak_rss(pid=None):
+    """Peak resident set size in bytes of this process, or of pid (Linux only)."""
+    if pid is not None:
+        try:
+            with open(f'/proc/{pid}/status', encoding='ascii') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _result(stage, seconds, duration=None, **extra):
+    data = {'stage': stage, 'seconds': round(seconds, 4)}
+    if duration:
+        data['duration'] = duration
+        data['rtf'] = round(seconds / duration, 4)
+    data.update(extra)
+    return data
+
+
+def bench_convert(path, duration, work_dir):
+    """WAV -> mp3 -> WAV through tool.runffmpeg, the same way uploads are converted."""
+    from vocal import decode, models, tool
+    results = []
+    name = os.path.splitext(os.path.basename(path))[0]
+    mp3 = os.path.join(work_dir, f'{name}.mp3')
+    back = os.path.join(work_dir, f'{name}.back.wav')
+    to_wav = ['-i', mp3, *decode.wav_args(*models.input_format()), back]
+    for stage, args in [('convert_to_mp3', ['-i', path, mp3]), ('convert_to_wav', to_wav)]:
+        started = time.perf_counter()
+        rs = tool.runffmpeg(args)
+        results.append(_result(stage, time.perf_counter() - started, duration,
+                               file=os.path.basename(path), ok=rs == 'ok'))
+    return results
+
+
+def _separate(model, files, work_dir):
+    # runs in a fresh process: one cold model load, then every file
+    from vocal import separation
+    registry = models.registry
+    started = time.perf_counter()
+    registry.get(model)
+    results = [_result('model_load', time.perf_counter() - started, model=model, peak_rss=peak_rss())]
+    for path, duration in files:
+        name = os.path.splitext(os.path.basename(path))[0]
+        spec = {'wav_file': path, 'model': model, 'dirname': os.path.join(work_dir, f'{name}-{model}'), 'segment': 0}
+        started = time.perf_counter()
+        data = separation.run(spec)
+        seconds = time.perf_counter() - started
+        timings = {k: round(v, 4) for k, v in data['timings'].items() if k != 'duration'}
+        results.append(_result('separate', seconds, duration, model=model, file=os.path.basename(path),
+                               timings=timings, peak_rss=peak_rss()))
+    return results
+
+
+def bench_separate(model, files, work_dir):
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        return pool.submit(_separate, model, files, work_dir).result()
+
+
+def parse_variant(text):
+    """'threads=4,batch=2' -> {'threads': '4', 'batch': '2'}, '' is the current configuration."""
+    settings = {}
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        key, _, value = part.partition('=')
+        key = key.strip()
+        if key not in VARIANT_ENV:
+            raise ValueError(f'unknown setting {key}, use one of {", ".join(VARIANT_ENV)}')
+        settings[key] = value.strip()
+    return settings
+
+
+@contextmanager
+def _environ(values):
+    # spawned processes read their config from the environment they start with
+    saved = {key: os.environ.get(key) for key in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+def _infer(index, model, files, work_dir, segment, barrier, results):
+    # one worker of an inference variant: pin and tune like a job worker, load, then
+    # wait for the others so they all separate at the same time
+    try:
+        from vocal import jobs, separation
+        cpus = jobs.tune_worker(index)
+        models.registry.get(model)
+        barrier.wait(timeout=600)
+        started = time.perf_counter()
+        inference = 0.0
+        for path, _ in files:
+            name = os.path.splitext(os.path.basename(path))[0]
+            spec = {'wav_file': path, 'model': model, 'segment': segment,
+                    'dirname': os.path.join(work_dir, f'{name}-{model}-{index}')}
+            inference += separation.run(spec)['timings']['inference']
+        results.put({'seconds': time.perf_counter() - started, 'inference': inference,
+                     'cpus': cpus, 'peak_rss': peak_rss()})
+    except Exception as e:
+        barrier.abort()
+        results.put({'error': f'{type(e).__name__}: {e}'})
+
+
+def bench_inference(model, files, variant, work_dir, segment=None):
+    """Combined throughput of `workers` processes separating files with the settings of variant."""
+    settings = parse_variant(variant)
+    workers = max(1, int(settings.get('workers', 1)))
+    segment = segment or cfg.SEGMENT_SECONDS
+    ctx = multiprocessing.get_context('spawn')
+    barrier = ctx.Barrier(workers)
+    results = ctx.Queue()
+    with _environ({VARIANT_ENV[key]: value for key, value in settings.items()}):
+        procs = [ctx.Process(target=_infer, args=(i, model, files, work_dir, segment, barrier, results))
+                 for i in range(workers)]
+        for p in procs:
+            p.start()
+    try:
+        data = [results.get(timeout=3600) for _ in procs]
+    finally:
+        for p in procs:
+            p.join(10)
+            if p.is_alive():
+                p.terminate()
+    errors = [it['error'] for it in data if 'error' in it]
+    audio = workers * sum(duration for _, duration in files)
+    if errors:
+        return _result('inference', 0, model=model, variant=variant, settings=settings, error=errors[0])
+    seconds = max(it['seconds'] for it in data)
+    return _result('inference', seconds, audio, model=model, variant=variant, settings=settings,
+                   workers=workers, segment=segment, throughput=round(audio / seconds, 4),
+                   inference_seconds=round(sum(it['inference'] for it in data), 4),
+                   cpus=[it['cpus'] for it in data], peak_rss=max(it['peak_rss'] or 0 for it in data) or None)
+
+
+def _serve(port):
+    sys.path.insert(0, SOURCE_DIR)
+    from gevent.pywsgi import WSGIServer
+    import start
+    from vocal import jobs
+    jobs.job_queue.start()
+    WSGIServer(('127.0.0.1', port), start.app, handler_class=start.CustomRequestHandler).serve_forever()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(url, server, timeout=120):
+    import requests
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and server.is_alive():
+        try:
+            requests.get(url, timeout=2)
+            return True
+        except requests.RequestException:
+            time.sleep(0.2)
+    return False
+
+
+def bench_http(model, files, clients, job_workers=0):
+    """
+    Drive /upload + /process and /api with `clients` concurrent clients, one request per
+    file. Every file is distinct so the result cache never answers for the model.
+    With job_workers=0 inference runs inside the server, so its peak RSS covers it.
+    """
+    import requests
+    port = _free_port()
+    base = f'http://127.0.0.1:{port}'
+    # the server reads its config while unpickling _serve, so set it before the spawn
+    server = multiprocessing.get_context('spawn').Process(target=_serve, args=(port,))
+    with _environ({'VOCAL_JOB_WORKERS': str(job_workers)}):
+        server.start()
+    try:
+        if not _wait_for(f'{base}/status', server):
+            raise RuntimeError('server did not start')
+
+        def upload_process(path):
+            with open(path, 'rb') as f:
+                rs = requests.post(f'{base}/upload', files={'audio': (os.path.basename(path), f)}, timeout=600).json()
+            if rs['code'] != 0:
+                return rs
+            return requests.post(f'{base}/process', data={'wav_name': rs['data'], 'model': model}, timeout=3600).json()
+
+        def api(path):
+            with open(path, 'rb') as f:
+                return requests.post(f'{base}/api', files={'file': (os.path.basename(path), f)},
+                                     data={'model': model}, timeout=3600).json()
+
+        results = []
+        for stage, fn, batch in [('http_upload_process', upload_process, files[0::2]), ('http_api', api, files[1::2])]:
+            if not batch:
+                continue
+            latencies = []
+
+            def timed(item):
+                started = time.perf_counter()
+                rs = fn(item[0])
+                latencies.append(time.perf_counter() - started)
+                return rs.get('code') == 0
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as pool:
+                ok = list(pool.map(timed, batch))
+            seconds = time.perf_counter() - started
+            latencies.sort()
+            results.append(_result(stage, seconds, sum(d for _, d in batch), model=model, clients=clients,
+                                   requests=len(batch), failed=ok.count(False),
+                                   latency_p50=round(latencies[len(latencies) // 2], 4),
+                                   latency_max=round(latencies[-1], 4),
+                                   peak_rss=peak_rss(server.pid)))
+        return results
+    finally:
+        server.terminate()
+        server.join(10)
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SOURCE_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(lengths, layouts, model_names, http_clients=0, http_requests=0, http_length=10, work_dir=None,
+        stages=('convert', 'separate', 'http'), variants=DEFAULT_VARIANTS, inference_length=120):
+    """Run the selected stages and return the report dict."""
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='vocal-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+    started = time.time()
+    results = []
+    try:
+        files = []
+        for seconds in lengths:
+            for layout in layouts:
+                path = os.path.join(work_dir, f'synth-{seconds}s-{layout}.wav')
+                files.append((synth(path, seconds, LAYOUTS[layout], seed=len(files)), seconds))
+        if 'convert' in stages:
+            for path, duration in files:
+                results += bench_convert(path, duration, work_dir)
+        if 'separate' in stages:
+            for model in model_names:
+                results += bench_separate(model, files, work_dir)
+        if 'http' in stages and http_clients > 0 and http_requests > 0:
+            for model in model_names:
+                batch = [(synth(os.path.join(work_dir, f'http-{model}-{i}.wav'), http_length, seed=1000 + i), http_length)
+                         for i in range(http_requests)]
+                results += bench_http(model, batch, http_clients)
+        if 'inference' in stages:
+            path = os.path.join(work_dir, f'inference-{inference_length}s.wav')
+            batch = [(synth(path, inference_length, seed=2000), inference_length)]
+            for model in model_names:
+                for variant in variants:
+                    results.append(bench_inference(model, batch, variant, work_dir))
+    finally:
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        'commit': _commit(),
+        'started': started,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m vocal.bench', description='Benchmark conversion and separation')
+    parser.add_argument('--lengths', type=float, nargs='+', default=[10, 60, 300], help='seconds of synthetic audio')
+    parser.add_argument('--layouts', nargs='+', default=list(LAYOUTS), choices=list(LAYOUTS))
+    parser.add_argument('--models', nargs='+', default=models.MODELS, choices=models.MODELS)
+    parser.add_argument('--stages', nargs='+', default=['convert', 'separate', 'http'],
+                        choices=['convert', 'separate', 'http', 'inference'])
+    parser.add_argument('--http-clients', type=int, default=4, help='concurrent HTTP clients, 0 skips the HTTP stage')
+    parser.add_argument('--http-requests', type=int, default=8, help='requests per model and route pair')
+    parser.add_argument('--http-length', type=float, default=10, help='seconds of audio per HTTP request')
+    parser.add_argument('--variants', nargs='+', default=DEFAULT_VARIANTS,
+                        help=f'inference settings to compare, eg. "threads=4,batch=2", keys: {", ".join(VARIANT_ENV)}')
+    parser.add_argument('--inference-length', type=float, default=120, help='seconds of audio per inference variant')
+    parser.add_argument('--work-dir', default=None, help='keep generated audio and stems here')
+    parser.add_argument('--out', default=None, help='JSON report path, default stdout')
+    args = parser.parse_args(argv)
+
+    # the separation stages measure the CPU
+    os.environ.setdefault('VOCAL_CUDA', '0')
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+    for variant in args.variants:
+        try:
+            parse_variant(variant)
+        except ValueError as e:
+            parser.error(str(e))
+    missing = [m for m in args.models if not models.model_exists(m)]
+    if missing and set(args.stages) & {'separate', 'http', 'inference'}:
+        print(f"{', '.join(missing)} {cfg.transobj['lang4']}")
+        return 1
+    data = run(args.lengths, args.layouts, args.models, args.http_clients, args.http_requests,
+               args.http_length, args.work_dir, args.stages, args.variants, args.inference_length)
+    text = json.dumps(data, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from vocal import cfg
+
+CHUNK_SIZE = 1024 * 1024
+# Seconds a change may wait before the index is written; lookups run on the request path
+# and only mark it changed
+SAVE_DELAY = 5
+
+
+def hash_stream(stream, out_file):
+    """Copy stream into out_file while hashing it, returns the content digest."""
+    sha = hashlib.sha256()
+    with open(out_file, 'wb') as f:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+            f.write(chunk)
+    return sha.hexdigest()[:32]
+
+
+def path_size(path):
+    if os.path.isdir(path):
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ResultCache:
+    """
+    Content-addressed cache of converted WAVs and separated stems.
+
+    Uploads are named by the hash of their content, so the same song uploaded twice
+    (under any name) maps to one WAV, and (hash, model) maps to one stems directory
+    in FILES_DIR. The index is a JSON file recording the paths, size and last access
+    of every entry, written at most every SAVE_DELAY seconds. The cache deletes nothing
+    itself: when the total exceeds max_bytes it calls on_full(), and the janitor removes
+    the least recently used entries no job needs, like everything else it cleans up.
+    """
+
+    def __init__(self, index_file, max_bytes=0):
+        self.index_file = index_file
+        self.max_bytes = max_bytes
+        self.on_full = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._timer = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._entries = data.get('entries', {})
+            self.hits = data.get('hits', 0)
+            self.misses = data.get('misses', 0)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def _save(self):
+        # called with the lock held: the index is written SAVE_DELAY seconds after the first change
+        if self._timer is None:
+            self._timer = threading.Timer(SAVE_DELAY, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Write the index now if it changed."""
+        with self._lock:
+            if self._timer is None:
+                return
+            self._timer.cancel()
+            self._timer = None
+            tmp = f'{self.index_file}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'entries': self._entries, 'hits': self.hits, 'misses': self.misses}, f)
+            os.replace(tmp, self.index_file)
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and all(os.path.exists(p) for p in entry['paths']):
+                entry['atime'] = time.time()
+                # the index is per node, the mtime tells the janitors of other nodes sharing
+                # the data dir that the entry is in use
+                for path in entry['paths']:
+                    try:
+                        os.utime(path)
+                    except OSError:
+                        pass
+                # used again, no longer just an intermediate file
+                entry.pop('expires', None)
+                self.hits += 1
+                self._save()
+                return entry['paths'][0]
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+            self._save()
+            return None
+
+    def _add(self, key, paths):
+        size = sum(path_size(p) for p in paths)
+        with self._lock:
+            self._entries[key] = {
+                'paths': paths,
+                'size': size,
+                'atime': time.time()
+            }
+            self._save()
+            full = self.max_bytes > 0 and sum(entry['size'] for entry in self._entries.values()) > self.max_bytes
+        if full and self.on_full is not None:
+            self.on_full()
+
+    def usage(self):
+        """{path: (last access, expiry time or None)} for every indexed path."""
+        with self._lock:
+            return {path: (entry['atime'], entry.get('expires'))
+                    for entry in self._entries.values() for path in entry['paths']}
+
+    def entries(self):
+        """[(last access, paths, size)] of every entry."""
+        with self._lock:
+            return [(entry['atime'], list(entry['paths']), entry['size']) for entry in self._entries.values()]
+
+    def expire(self, key, seconds):
+        """Let key be removed `seconds` from now, whatever its last access."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['expires'] = time.time() + seconds
+                self._save()
+
+    def forget(self, paths):
+        """Drop the entries holding any of paths, after they were deleted from disk."""
+        paths = set(paths)
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if paths.intersection(entry['paths'])]:
+                del self._entries[key]
+            self._save()
+
+    def lookup_wav(self, digest):
+        return self._lookup(f'wav:{digest}')
+
+    def add_wav(self, digest, wav_file, *extra):
+        self._add(f'wav:{digest}', [wav_file, *extra])
+
+    def lookup_stems(self, digest, model):
+        return self._lookup(f'stems:{digest}:{model}')
+
+    def add_stems(self, digest, model, dirname):
+        self._add(f'stems:{digest}:{model}', [dirname])
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': sum(entry['size'] for entry in self._entries.values()),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0
+            }
+
+
+result_cache = ResultCache(cfg.CACHE_INDEX, cfg.CACHE_MAX_MB * 1024 * 1024)
+atexit.register(result_cache.flush)
+
@@ -1,7 +1,9 @@
+import json
 import locale
 import os
+import socket
 import sys
-import tensorflow
+import threading
 web_address = '127.0.0.1:9999'
 LANG = "en" if locale.getdefaultlocale()[0].split('_')[0].lower() != 'zh' else "zh"
 
@@ -9,8 +11,11 @@ LANG = "en" if locale.getdefaultlocale()[0].split('_')[0].lower() != 'zh' else "
 ROOT_DIR = os.getcwd()
 MODEL_DIR = os.path.join(ROOT_DIR, 'pretrained_models')
 STATIC_DIR = os.path.join(ROOT_DIR, 'static')
-TMP_DIR = os.path.join(STATIC_DIR, 'tmp')
-FILES_DIR = os.path.join(STATIC_DIR, 'files')
+# Uploads (tmp/) and stems (files/) live in DATA_DIR, served under /static; with several nodes it is the storage
+# they all mount
+DATA_DIR = os.environ.get('VOCAL_DATA_DIR') or STATIC_DIR
+TMP_DIR = os.path.join(DATA_DIR, 'tmp')
+FILES_DIR = os.path.join(DATA_DIR, 'files')
 if not os.path.exists(TMP_DIR):
     os.makedirs(TMP_DIR, 0o777, exist_ok=True)
 if not os.path.exists(MODEL_DIR):
@@ -25,6 +30,109 @@ if sys.platform == 'win32':
 else:
     os.environ['PATH'] = f'{ROOT_DIR}:{ROOT_DIR}/ffmpeg:' + os.environ['PATH']
 
+# Loaded separator models are kept warm, evicted least-recently-used above this budget (0 = unlimited)
+MODEL_CACHE_MB = int(os.environ.get('VOCAL_MODEL_CACHE_MB', 4096))
+# Comma separated models to load at startup, eg. "2stems,4stems"
+PRELOAD_MODELS = [m.strip() for m in os.environ.get('VOCAL_PRELOAD_MODELS', '').split(',') if m.strip()]
+
+# Separation worker processes (0 = a single in-process thread), max queued+running jobs, finished jobs remembered
+JOB_WORKERS = int(os.environ.get('VOCAL_JOB_WORKERS', 1))
+JOB_QUEUE_SIZE = int(os.environ.get('VOCAL_JOB_QUEUE_SIZE', 16))
+JOB_HISTORY = int(os.environ.get('VOCAL_JOB_HISTORY', 1000))
+
+# Job backend: 'local' runs jobs on this host's workers, 'sqlite' shares them between nodes through the database
+# JOB_STORE on storage every node mounts (with DATA_DIR), see vocal.jobstore. Nodes with VOCAL_INFERENCE=0 only
+# submit jobs; the others lease them for JOB_LEASE seconds, renewed while they run, and a job whose node stopped
+# renewing is run again, JOB_MAX_ATTEMPTS times at most. NODE_ID names this node in the database.
+JOB_BACKEND = os.environ.get('VOCAL_JOB_BACKEND', 'local').strip().lower()
+JOB_STORE = os.environ.get('VOCAL_JOB_STORE') or os.path.join(DATA_DIR, 'jobs.sqlite3')
+INFERENCE = os.environ.get('VOCAL_INFERENCE', '1') != '0'
+JOB_LEASE = float(os.environ.get('VOCAL_JOB_LEASE', 30))
+JOB_MAX_ATTEMPTS = int(os.environ.get('VOCAL_JOB_MAX_ATTEMPTS', 3))
+NODE_ID = os.environ.get('VOCAL_NODE_ID') or f'{socket.gethostname()}-{os.getpid()}'
+# Base of the stem URLs handed to clients, eg. the load balancer in front of several nodes (default http://web_address)
+PUBLIC_URL = os.environ.get('VOCAL_PUBLIC_URL', '').rstrip('/')
+
+# HTTP worker processes sharing the port; above 1 the main process only runs the job queue (JOB_WORKERS
+# inference processes) and serves it to them over a local socket, see vocal.modelserver. POSIX only.
+HTTP_WORKERS = int(os.environ.get('VOCAL_HTTP_WORKERS', 1))
+# TensorFlow intra-op and inter-op threads per inference worker (0 = TensorFlow's default)
+TF_INTRA_THREADS = int(os.environ.get('VOCAL_TF_INTRA_THREADS', 0))
+TF_INTER_THREADS = int(os.environ.get('VOCAL_TF_INTER_THREADS', 0))
+# Pin each inference worker to its own CPUs (Linux): '' = no pinning, 'auto' = split the available CPUs evenly
+# between the JOB_WORKERS workers, or one CPU list per worker, eg. '0-7;8-15'. A pinned worker defaults its
+# TensorFlow intra-op threads to the number of CPUs it owns.
+CPU_AFFINITY = os.environ.get('VOCAL_CPU_AFFINITY', '').strip()
+# Windows of a segmented separation passed to the model per inference call
+INFERENCE_BATCH = max(1, int(os.environ.get('VOCAL_INFERENCE_BATCH', 1)))
+# 'fp32', or 'mixed' to let TensorFlow rewrite the graph to float16 where the GPU runs it faster
+PRECISION = os.environ.get('VOCAL_PRECISION', 'fp32').strip().lower()
+# Inference backend: 'tf' (spleeter's own graph), or a model exported by vocal.export: 'frozen', 'xla' (the frozen
+# graph compiled with XLA) or 'tflite'. Models without that export use 'tf'.
+INFERENCE_BACKEND = os.environ.get('VOCAL_BACKEND', 'tf').strip().lower()
+# XLA only auto-clusters graphs on the CPU with this flag, which TensorFlow reads once, so it is set before any
+# process imports it; the inference workers inherit it
+if INFERENCE_BACKEND == 'xla' and '--tf_xla_cpu_global_jit' not in os.environ.get('TF_XLA_FLAGS', ''):
+    os.environ['TF_XLA_FLAGS'] = f"{os.environ.get('TF_XLA_FLAGS', '')} --tf_xla_cpu_global_jit".strip()
+
+# Files longer than SEGMENT_MIN_DURATION seconds are separated in SEGMENT_SECONDS windows overlapping by
+# SEGMENT_OVERLAP seconds, so memory stays flat however long the track is (SEGMENT_MIN_DURATION 0 = always)
+SEGMENT_SECONDS = float(os.environ.get('VOCAL_SEGMENT_SECONDS', 30))
+SEGMENT_OVERLAP = float(os.environ.get('VOCAL_SEGMENT_OVERLAP', 2))
+SEGMENT_MIN_DURATION = float(os.environ.get('VOCAL_SEGMENT_MIN_DURATION', 600))
+
+# Streaming separation (/stream): default latency target in seconds (emitted hop + look-ahead), the look-ahead
+# part of it, and the seconds of past audio the model sees before each hop
+STREAM_LATENCY = float(os.environ.get('VOCAL_STREAM_LATENCY', 1.0))
+STREAM_LOOKAHEAD = float(os.environ.get('VOCAL_STREAM_LOOKAHEAD', 0.5))
+STREAM_CONTEXT = float(os.environ.get('VOCAL_STREAM_CONTEXT', 2.0))
+
+# At most FFMPEG_CONCURRENCY ffmpeg conversions run at once, each is killed after FFMPEG_TIMEOUT seconds
+FFMPEG_CONCURRENCY = int(os.environ.get('VOCAL_FFMPEG_CONCURRENCY', os.cpu_count() or 2))
+FFMPEG_TIMEOUT = float(os.environ.get('VOCAL_FFMPEG_TIMEOUT', 3600))
+
+# Cache lifetime in seconds for stems in FILES_DIR. Behind nginx, set ACCEL_REDIRECT to an internal location
+# aliased to DATA_DIR (eg. /protected/) so nginx sends stems itself; USE_X_SENDFILE does the same for Apache/lighttpd
+STATIC_MAX_AGE = int(os.environ.get('VOCAL_STATIC_MAX_AGE', 86400))
+ACCEL_REDIRECT = os.environ.get('VOCAL_ACCEL_REDIRECT', '')
+USE_X_SENDFILE = os.environ.get('VOCAL_USE_X_SENDFILE', '') == '1'
+
+# Log level of the web app, json or text lines, and the fraction of records below WARNING that are kept
+LOG_LEVEL = os.environ.get('VOCAL_LOG_LEVEL', 'WARNING').upper()
+LOG_FORMAT = os.environ.get('VOCAL_LOG_FORMAT', 'json')
+LOG_SAMPLE = float(os.environ.get('VOCAL_LOG_SAMPLE', 1.0))
+
+# Index of the content-addressed WAV/stems cache, and the disk budget for TMP_DIR + FILES_DIR entries (0 = unlimited),
+# enforced by the janitor. The index is per node and stays out of the shared DATA_DIR: other nodes
+# only see its entries as files, and a cache hit touches them so their janitors keep them
+CACHE_INDEX = os.path.join(ROOT_DIR, 'cache_index.json')
+CACHE_MAX_MB = int(os.environ.get('VOCAL_CACHE_MAX_MB', 20480))
+
+# Directory /batch may read inputs from, which must resolve inside it ('' = batches only run from the command line)
+BATCH_ROOT = os.path.realpath(os.environ['VOCAL_BATCH_ROOT']) if os.environ.get('VOCAL_BATCH_ROOT') else ''
+# Chunk size resumable uploads (/uploads) are asked to send, in MB
+UPLOAD_CHUNK_MB = int(os.environ.get('VOCAL_UPLOAD_CHUNK_MB', 8))
+# A resumable upload that received no chunk for UPLOAD_TTL seconds is abandoned and deleted (0 = kept)
+UPLOAD_TTL = float(os.environ.get('VOCAL_UPLOAD_TTL', 3600))
+
+# Peaks and preview clips written next to the stems after a separation: PREVIEW_SECONDS of the loudest part
+# (0 = peaks only) encoded as mono MP3 at PREVIEW_BITRATE. VOCAL_PREVIEWS=0 skips both
+PREVIEWS = os.environ.get('VOCAL_PREVIEWS', '1') != '0'
+PREVIEW_SECONDS = float(os.environ.get('VOCAL_PREVIEW_SECONDS', 30))
+PREVIEW_BITRATE = os.environ.get('VOCAL_PREVIEW_BITRATE', '64k')
+
+# Janitor, runs every JANITOR_INTERVAL seconds (0 = never). Anything in TMP_DIR unused for TMP_TTL seconds is
+# deleted, and a converted WAV TMP_KEEP_AFTER_JOB seconds after its separation finished (0 = right away).
+# Stems unused for FILES_TTL seconds are deleted (0 = kept). Above a directory's quota in MB (0 = none) the
+# least recently used entries go first. Nothing used in the last JANITOR_GRACE seconds is deleted for space.
+JANITOR_INTERVAL = float(os.environ.get('VOCAL_JANITOR_INTERVAL', 300))
+TMP_TTL = float(os.environ.get('VOCAL_TMP_TTL', 6 * 3600))
+TMP_KEEP_AFTER_JOB = float(os.environ.get('VOCAL_TMP_KEEP_AFTER_JOB', 900))
+TMP_MAX_MB = int(os.environ.get('VOCAL_TMP_MAX_MB', 4096))
+FILES_TTL = float(os.environ.get('VOCAL_FILES_TTL', 7 * 86400))
+FILES_MAX_MB = int(os.environ.get('VOCAL_FILES_MAX_MB', 0))
+JANITOR_GRACE = float(os.environ.get('VOCAL_JANITOR_GRACE', 600))
+
 langlist = {
     "zh": {
         "lang1": "上传成功",
@@ -50,6 +158,57 @@ langlist = {
     }
 }
 updatetips = ""
-cuda = True if len(tensorflow.config.list_physical_devices('GPU'))>0 else False
 transobj = langlist[LANG]
 
+# GPU detection needs TensorFlow, which takes seconds to import. It is probed on first use of cfg.cuda
+# and the answer cached on disk per TensorFlow version, so later starts never import TF just for this.
+# VOCAL_CUDA=0/1 skips the probe entirely.
+DEVICE_CACHE = os.path.join(ROOT_DIR, '.device_probe.json')
+_cuda = None
+_cuda_lock = threading.Lock()
+
+
+def _tensorflow_version():
+    try:
+        from importlib.metadata import version
+        return version('tensorflow')
+    except Exception:
+        return ''
+
+
+def probe_cuda(wait=True):
+    """True/False when a GPU is usable; None when unknown yet and wait is False."""
+    global _cuda
+    if _cuda is not None:
+        return _cuda
+    if os.environ.get('VOCAL_CUDA') in ('0', '1'):
+        _cuda = os.environ['VOCAL_CUDA'] == '1'
+        return _cuda
+    key = f"{_tensorflow_version()}|{os.environ.get('CUDA_VISIBLE_DEVICES', '')}"
+    try:
+        with open(DEVICE_CACHE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('key') == key:
+            _cuda = bool(data['cuda'])
+            return _cuda
+    except (OSError, ValueError, KeyError):
+        pass
+    if not wait:
+        return None
+    with _cuda_lock:
+        if _cuda is None:
+            import tensorflow
+            _cuda = len(tensorflow.config.list_physical_devices('GPU')) > 0
+            try:
+                with open(DEVICE_CACHE, 'w', encoding='utf-8') as f:
+                    json.dump({'key': key, 'cuda': _cuda}, f)
+            except OSError:
+                pass
+    return _cuda
+
+
+def __getattr__(name):
+    if name == 'cuda':
+        return probe_cuda()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
@@ -0,0 +1,201 @@
+import os
+import subprocess
+import sys
+import time
+import wave
+
+import numpy as np
+
+from vocal import media
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+# samples per segment the bundled models separate at once: T=512 STFT frames, 1024 samples apart
+MODEL_SEGMENT = 512 * 1024
+
+
+def open_wav(audio_file, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    """
+    (memmap of the samples, factor to float) of a WAV already at sample_rate with
+    channels in a format the models read as it is, see media.conforms. None otherwise.
+    """
+    info = media.read_wav_header(audio_file) if audio_file.lower().endswith('.wav') else None
+    if not media.conforms(info, sample_rate, channels):
+        return None
+    data, scale, _ = media.open_wav(audio_file)
+    return data, scale
+
+
+def load_wav(audio_file, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    """The whole of a conforming WAV (see open_wav) as a float32 array, None when it needs ffmpeg."""
+    wav = open_wav(audio_file, sample_rate, channels)
+    if wav is None:
+        return None
+    data, scale = wav
+    return np.multiply(data, np.float32(scale), dtype=np.float32)
+
+
+def read_frames(audio_file, block, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    """
+    Decode audio_file with ffmpeg and yield float32 arrays of shape (block, channels),
+    the last one possibly shorter. Only one block is held in memory at a time. A WAV
+    already in that format is read from disk directly, no ffmpeg involved.
+    """
+    wav = open_wav(audio_file, sample_rate, channels)
+    if wav is not None:
+        data, scale = wav
+        for start in range(0, len(data), block):
+            yield np.multiply(data[start:start + block], np.float32(scale), dtype=np.float32)
+        return
+    cmd = ["ffmpeg", "-hide_banner", "-nostdin", "-v", "error", "-i", audio_file,
+           "-vn", "-f", "f32le", "-ac", str(channels), "-ar", str(sample_rate), "pipe:1"]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                         creationflags=0 if sys.platform != 'win32' else subprocess.CREATE_NO_WINDOW)
+    frame_bytes = 4 * channels
+    try:
+        while True:
+            data = p.stdout.read(block * frame_bytes)
+            if not data:
+                break
+            data = data[:len(data) - len(data) % frame_bytes]
+            yield np.frombuffer(data, dtype=np.float32).reshape(-1, channels)
+    finally:
+        p.stdout.close()
+        if p.poll() is None:
+            p.kill()
+        p.wait()
+
+
+class StemWriter:
+    """Appends stem audio to 16-bit PCM WAV files as it is produced."""
+
+    def __init__(self, dirname, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+        self.dirname = dirname
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self._files = {}
+
+    def write(self, instrument, samples):
+        f = self._files.get(instrument)
+        if f is None:
+            f = wave.open(os.path.join(self.dirname, f'{instrument}.wav'), 'wb')
+            f.setnchannels(self.channels)
+            f.setsampwidth(2)
+            f.setframerate(self.sample_rate)
+            self._files[instrument] = f
+        pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype('<i2')
+        f.writeframes(pcm.tobytes())
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+def _fit(samples, length):
+    # spleeter pads internally, keep each window exactly as long as its input
+    if len(samples) >= length:
+        return samples[:length]
+    return np.pad(samples, ((0, length - len(samples)), (0, 0)))
+
+
+def separate_batch(separator, chunks):
+    """
+    Separate several windows with one inference call. spleeter cuts its input into
+    MODEL_SEGMENT long segments and runs them as one batch, so each window is padded
+    to whole segments: the network sees it alone, only the STFT frames at its very
+    edges reach into its neighbours. Returns one {instrument: samples} per window.
+    """
+    if len(chunks) == 1:
+        return [separator.separate(chunks[0])]
+    padded = [_fit(chunk, -(-len(chunk) // MODEL_SEGMENT) * MODEL_SEGMENT) for chunk in chunks]
+    stems = separator.separate(np.concatenate(padded))
+    results = []
+    offset = 0
+    for chunk, part in zip(chunks, padded):
+        results.append({instrument: _fit(samples[offset:offset + len(part)], len(chunk))
+                        for instrument, samples in stems.items()})
+        offset += len(part)
+    return results
+
+
+def separate_chunked(separator, audio_file, dirname, segment=30.0, overlap=2.0,
+                     duration=None, progress=None, sample_rate=SAMPLE_RATE, timings=None, batch=1):
+    """
+    Separate audio_file in fixed windows of `segment` seconds that overlap by
+    `overlap` seconds, crossfading the overlaps so window edges don't click.
+
+    Audio is decoded as a stream and every stem is appended to its WAV as soon as a
+    window is done, so peak memory depends on the window size, not the track length.
+    `batch` windows are separated per inference call, see separate_batch.
+    progress(fraction) is called after every window when duration is known.
+    When a timings dict is given the seconds spent decoding, in inference and writing
+    are added to its 'decode', 'inference' and 'write' keys.
+    """
+    window = int(segment * sample_rate)
+    fade = min(int(overlap * sample_rate), window // 2)
+    hop = window - fade
+    ramp = np.linspace(0.0, 1.0, fade, dtype=np.float32)[:, None] if fade else None
+
+    timings = {} if timings is None else timings
+    for key in ('decode', 'inference', 'write'):
+        timings.setdefault(key, 0.0)
+    writer = StemWriter(dirname, sample_rate)
+    tails = {}
+    done = 0
+    frames = read_frames(audio_file, hop, sample_rate)
+
+    def windows():
+        # (window, is the last one), decoded just in time
+        buffer = np.zeros((0, CHANNELS), dtype=np.float32)
+        exhausted = False
+        while True:
+            t = time.perf_counter()
+            while len(buffer) < window:
+                block = next(frames, None)
+                if block is None:
+                    exhausted = True
+                    break
+                buffer = np.concatenate([buffer, block])
+            timings['decode'] += time.perf_counter() - t
+            if not len(buffer):
+                return
+            yield buffer[:window], exhausted
+            if exhausted:
+                return
+            buffer = buffer[hop:]
+
+    try:
+        pending = []
+        for chunk, last in windows():
+            pending.append((chunk, last))
+            if len(pending) < batch and not last:
+                continue
+            t = time.perf_counter()
+            results = separate_batch(separator, [chunk for chunk, _ in pending])
+            timings['inference'] += time.perf_counter() - t
+            for (chunk, last), stems in zip(pending, results):
+                length = len(chunk)
+                t = time.perf_counter()
+                for instrument, samples in stems.items():
+                    samples = _fit(samples, length)
+                    tail = tails.get(instrument)
+                    if tail is not None:
+                        n = min(len(tail), length)
+                        samples = samples.copy()
+                        samples[:n] = tail[:n] * (1.0 - ramp[:n]) + samples[:n] * ramp[:n]
+                    if last or not fade:
+                        writer.write(instrument, samples)
+                    else:
+                        # the overlap is written by the next window, crossfaded
+                        writer.write(instrument, samples[:hop])
+                        tails[instrument] = samples[hop:]
+                timings['write'] += time.perf_counter() - t
+                done += length if last or not fade else hop
+                if progress is not None and duration:
+                    progress(min(1.0, done / (duration * sample_rate)))
+            pending = []
+    finally:
+        frames.close()
+        writer.close()
+    return sorted(it for it in os.listdir(dirname) if it.endswith('.wav'))
@@ -0,0 +1,222 @@
+import hashlib
+import io
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+
+from vocal import cfg, media, models, tool, transcode
+
+# Containers ffmpeg can decode front to back from a pipe. mp4/mov may keep their
+# index at the end of the file and avi needs seeking, those are still saved first.
+STREAMABLE = ['.mp3', '.flac', '.mkv', '.mpeg', '.wav']
+# A WAV upload whose header is not complete within this many bytes goes through ffmpeg
+HEADER_LIMIT = 64 * 1024
+# Chunks queued for ffmpeg's stdin per decoder; once ffmpeg is that far behind, the upload waits for it
+FEED_CHUNKS = 64
+
+
+def wav_args(sample_rate, channels):
+    """ffmpeg output options for a 16-bit PCM WAV at sample_rate with channels."""
+    return ['-ar', str(sample_rate), '-ac', str(channels), '-c:a', 'pcm_s16le', '-f', 'wav']
+
+
+class StreamDecoder:
+    """
+    File-like sink for an upload that decodes it while it arrives.
+
+    The multipart parser writes the upload into it chunk by chunk; every chunk is
+    hashed and piped straight into ffmpeg's stdin, which writes the WAV once, resampled
+    and downmixed to fmt, (sample rate, channels), the models' input by default. The
+    original file never touches the disk. WAV uploads already in that format skip
+    ffmpeg and are written through as they are, decided once their header arrived.
+    Only a thread of the decoder writes to ffmpeg, the request greenlet queues chunks
+    for it, so an ffmpeg slower than the upload never blocks the gevent hub.
+
+    The piped ffmpeg holds one of transcode's cfg.FFMPEG_CONCURRENCY slots while it runs
+    and is killed cfg.FFMPEG_TIMEOUT seconds after it started. When no slot is free the
+    upload is spooled to disk instead and converted by transcode.run() in finish().
+    Its files in out_dir are named after name, a fresh uuid by default.
+    """
+
+    def __init__(self, ext, out_dir, fmt=None, name=None):
+        self.ext = ext
+        self.fmt = fmt or models.input_format()
+        name = name or uuid.uuid4().hex
+        self.wav_part = os.path.join(out_dir, f'{name}.wav.part')
+        self.spool = os.path.join(out_dir, f'{name}{ext}.part')
+        self.size = 0
+        # whether ffmpeg rewrote the upload, None until it is known
+        self.converted = None
+        self._sha = hashlib.sha256()
+        self._errors = deque(maxlen=20)
+        self._proc = None
+        self._started = None
+        self._slot = False
+        self._feed = None
+        self._file = None
+        self._spooled = False
+        # the beginning of a WAV upload, until its header says whether it needs ffmpeg
+        self._head = b'' if ext == '.wav' else None
+        if self._head is None:
+            self._start_ffmpeg()
+
+    def _ffmpeg_args(self, source):
+        args = ["-i", source]
+        if self.ext not in ['.mp3', '.flac']:
+            args.append('-vn')
+        return args + wav_args(*self.fmt) + [self.wav_part]
+
+    def _start_ffmpeg(self):
+        self.converted = True
+        if not transcode.acquire_slot():
+            self._spooled = True
+            self._file = open(self.spool, 'wb')
+            return
+        self._slot = True
+        self._started = time.monotonic()
+        self._proc = subprocess.Popen(
+            ["ffmpeg", "-hide_banner", "-nostdin", "-y"] + self._ffmpeg_args("pipe:0"),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            creationflags=0 if sys.platform != 'win32' else subprocess.CREATE_NO_WINDOW)
+        self._feed = queue.Queue(maxsize=FEED_CHUNKS)
+        threading.Thread(target=self._read_errors, daemon=True).start()
+        threading.Thread(target=self._write_stdin, args=(self._feed,), daemon=True).start()
+
+    def _write_stdin(self, feed):
+        # blocking pipe writes, in this thread only; None closes ffmpeg's input
+        stdin = self._proc.stdin
+        while True:
+            chunk = feed.get()
+            if chunk is None:
+                break
+            try:
+                stdin.write(chunk)
+            except OSError:
+                # ffmpeg gave up on the input (or was killed), finish() reports why
+                pass
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+    def _release(self):
+        if self._slot:
+            self._slot = False
+            transcode.release_slot()
+
+    def _close_feed(self):
+        # the writer thread writes (or, once ffmpeg is gone, drops) what is queued, then exits
+        if self._feed is not None:
+            self._queue(None)
+            self._feed = None
+
+    def _queue(self, chunk):
+        # a full queue means ffmpeg is behind: wait for it without blocking the hub
+        while True:
+            try:
+                self._feed.put_nowait(chunk)
+                return
+            except queue.Full:
+                tool.sleep(0.01)
+
+    def _sniff(self, chunk, final=False):
+        # buffer a WAV upload's first bytes, then write them through or into ffmpeg
+        self._head += chunk
+        info = media.parse_wav_header(io.BytesIO(self._head), None)
+        if info is None and not final and len(self._head) < HEADER_LIMIT:
+            return
+        head, self._head = self._head, None
+        if media.conforms(info, *self.fmt):
+            self.converted = False
+            self._file = open(self.wav_part, 'wb')
+        else:
+            self._start_ffmpeg()
+        self._send(head)
+
+    def _send(self, chunk):
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._queue(chunk)
+
+    def _read_errors(self):
+        for line in self._proc.stderr:
+            self._errors.append(line.decode('utf-8', errors='replace').strip())
+
+    def write(self, chunk):
+        self._sha.update(chunk)
+        self.size += len(chunk)
+        if self._head is not None:
+            self._sniff(chunk)
+        else:
+            self._send(chunk)
+        return len(chunk)
+
+    # The multipart parser rewinds the stream once it is done writing
+    def seek(self, offset, whence=0):
+        return 0
+
+    def tell(self):
+        return self.size
+
+    def read(self, size=-1):
+        return b''
+
+    @property
+    def digest(self):
+        return self._sha.hexdigest()[:32]
+
+    def finish(self):
+        """Flush the decoder. Returns (digest, wav_part), raises RuntimeError when decoding failed."""
+        if self._head is not None:
+            self._sniff(b'', final=True)
+        if self._file is not None:
+            self._file.close()
+        if self._spooled:
+            try:
+                transcode.run(self._ffmpeg_args(self.spool))
+            except transcode.TranscodeError as e:
+                self.abort()
+                raise RuntimeError(str(e))
+            finally:
+                if os.path.exists(self.spool):
+                    os.remove(self.spool)
+            return self.digest, self.wav_part
+        if self._proc is None:
+            return self.digest, self.wav_part
+        self._close_feed()
+        try:
+            code = self._proc.wait(timeout=max(0, self._started + cfg.FFMPEG_TIMEOUT - time.monotonic())
+                                   if cfg.FFMPEG_TIMEOUT else None)
+        except subprocess.TimeoutExpired:
+            self.abort()
+            raise RuntimeError(f'ffmpeg exceeded {cfg.FFMPEG_TIMEOUT:g}s')
+        self._release()
+        if code != 0 or not os.path.exists(self.wav_part):
+            self.abort()
+            errs = ' '.join(self._errors)
+            raise RuntimeError(errs[errs.find('Error'):] if 'Error' in errs else errs)
+        return self.digest, self.wav_part
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        self._close_feed()
+        self._release()
+        for path in (self.wav_part, self.spool):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        # Called when the request is torn down, kills a decoder nobody finished
+        self.abort()
@@ -0,0 +1,262 @@
+"""
+Export the bundled spleeter models to faster inference formats, and load them back.
+
+    python -m vocal.export --models 2stems 4stems --formats frozen tflite
+    python -m vocal.export --models 2stems --check-only
+
+The checkpoint's graph is rebuilt from the model's spleeter configuration with a plain
+waveform input and one output per stem, and written next to the checkpoint in
+pretrained_models/<model>/export/:
+
+    frozen.pb     variables folded into constants, no estimator or input pipeline,
+                  served by the 'frozen' backend and, compiled with XLA, by 'xla'
+    model.tflite  TensorFlow Lite with select TF ops for the STFT, fixed input length,
+                  served by the 'tflite' backend
+    info.json     tensor names, stems and input length
+
+Every export is checked against the stock Separator on synthetic audio (SNR of every
+stem must reach --min-snr dB) and both are timed on the CPU; the report is JSON like
+vocal.bench. cfg.INFERENCE_BACKEND picks the backend models.registry loads.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from vocal import cfg, models
+
+FORMATS = {'frozen': 'frozen.pb', 'tflite': 'model.tflite'}
+# what each backend loads
+BACKENDS = {'frozen': 'frozen', 'xla': 'frozen', 'tflite': 'tflite'}
+INPUT = 'waveform'
+# samples per TFLite call: two model segments (512 STFT frames of 1024 samples each)
+TFLITE_LENGTH = 2 * 512 * 1024
+
+
+def export_dir(model):
+    return os.path.join(cfg.MODEL_DIR, model, 'export')
+
+
+def exported(model, backend):
+    """Path of the export backend needs for model, None when it was not exported."""
+    fmt = BACKENDS.get(backend)
+    if fmt is None:
+        return None
+    path = os.path.join(export_dir(model), FORMATS[fmt])
+    if os.path.exists(path) and os.path.exists(os.path.join(export_dir(model), 'info.json')):
+        return path
+    return None
+
+
+def _session_config(xla=False):
+    import tensorflow as tf
+    config = tf.compat.v1.ConfigProto(intra_op_parallelism_threads=cfg.TF_INTRA_THREADS,
+                                      inter_op_parallelism_threads=cfg.TF_INTER_THREADS)
+    if xla:
+        # on the CPU this needs TF_XLA_FLAGS=--tf_xla_cpu_global_jit, which cfg sets for the 'xla' backend
+        config.graph_options.optimizer_options.global_jit_level = tf.compat.v1.OptimizerOptions.ON_1
+    return config
+
+
+def _build(model, length=None):
+    # the checkpoint's graph with a (length, 2) waveform placeholder, restored in a session
+    import tensorflow as tf
+    from spleeter.model import EstimatorSpecBuilder
+    from spleeter.utils.configuration import load_configuration
+    params = load_configuration(f'spleeter:{model}')
+    params['MWF'] = False
+    graph = tf.Graph()
+    with graph.as_default():
+        waveform = tf.compat.v1.placeholder(tf.float32, (length, 2), name=INPUT)
+        features = {'waveform': waveform, 'audio_id': tf.compat.v1.placeholder(tf.string, name='audio_id')}
+        builder = EstimatorSpecBuilder(features, params)
+        outputs = {instrument: tf.identity(tensor, name=f'stem_{instrument}')
+                   for instrument, tensor in builder.outputs.items()}
+        saver = tf.compat.v1.train.Saver()
+    session = tf.compat.v1.Session(graph=graph, config=_session_config())
+    saver.restore(session, tf.train.latest_checkpoint(os.path.join(cfg.MODEL_DIR, model)))
+    return session, waveform, outputs
+
+
+def export(model, formats=('frozen', 'tflite'), tflite_length=TFLITE_LENGTH):
+    """Write the requested formats of model to export_dir(model), returns {format: path}."""
+    import tensorflow as tf
+    out_dir = export_dir(model)
+    os.makedirs(out_dir, exist_ok=True)
+    info = {'model': model, 'input': f'{INPUT}:0', 'created': time.time(), 'tensorflow': tf.__version__}
+    paths = {}
+    if 'frozen' in formats:
+        session, _, outputs = _build(model)
+        with session:
+            graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+                session, session.graph.as_graph_def(), [f'stem_{instrument}' for instrument in outputs])
+        paths['frozen'] = os.path.join(out_dir, FORMATS['frozen'])
+        with open(paths['frozen'], 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        info['outputs'] = {instrument: f'stem_{instrument}:0' for instrument in outputs}
+    if 'tflite' in formats:
+        session, waveform, outputs = _build(model, tflite_length)
+        with session:
+            converter = tf.compat.v1.lite.TFLiteConverter.from_session(session, [waveform], list(outputs.values()))
+            # rfft/irfft of the STFT have no builtin kernels
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+            data = converter.convert()
+        paths['tflite'] = os.path.join(out_dir, FORMATS['tflite'])
+        with open(paths['tflite'], 'wb') as f:
+            f.write(data)
+        info['outputs'] = {instrument: f'stem_{instrument}:0' for instrument in outputs}
+        info['tflite_length'] = tflite_length
+    info_file = os.path.join(out_dir, 'info.json')
+    if os.path.exists(info_file):
+        with open(info_file, encoding='utf-8') as f:
+            info = {**json.load(f), **info}
+    with open(info_file, 'w', encoding='utf-8') as f:
+        json.dump(info, f, indent=2)
+    return paths
+
+
+def _info(model):
+    with open(os.path.join(export_dir(model), 'info.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+
+class FrozenSeparator:
+    """separate(waveform) on an exported frozen graph, optionally XLA compiled."""
+
+    def __init__(self, model, xla=False):
+        import tensorflow as tf
+        info = _info(model)
+        graph_def = tf.compat.v1.GraphDef()
+        with open(os.path.join(export_dir(model), FORMATS['frozen']), 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.compat.v1.import_graph_def(graph_def, name='')
+        self.session = tf.compat.v1.Session(graph=graph, config=_session_config(xla))
+        self.input = graph.get_tensor_by_name(info['input'])
+        self.outputs = {instrument: graph.get_tensor_by_name(name) for instrument, name in info['outputs'].items()}
+
+    def separate(self, waveform):
+        waveform = np.asarray(waveform, dtype=np.float32)
+        return self.session.run(self.outputs, {self.input: waveform})
+
+
+class TfliteSeparator:
+    """
+    separate(waveform) on an exported TFLite model. Its input length is fixed, longer
+    waveforms are run in pieces of whole model segments, like chunked.separate_batch.
+    """
+
+    def __init__(self, model):
+        import tensorflow as tf
+        info = _info(model)
+        self.length = info['tflite_length']
+        self.interpreter = tf.lite.Interpreter(model_path=os.path.join(export_dir(model), FORMATS['tflite']),
+                                               num_threads=cfg.TF_INTRA_THREADS or None)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]['index']
+        names = {name.split(':')[0]: instrument for instrument, name in info['outputs'].items()}
+        self.outputs = {}
+        for detail in self.interpreter.get_output_details():
+            # the converter may prefix or suffix tensor names
+            instrument = next((v for k, v in names.items() if k in detail['name']), None)
+            self.outputs[instrument or detail['name']] = detail['index']
+
+    def separate(self, waveform):
+        waveform = np.asarray(waveform, dtype=np.float32)
+        stems = {instrument: [] for instrument in self.outputs}
+        for start in range(0, max(1, len(waveform)), self.length):
+            piece = waveform[start:start + self.length]
+            self.interpreter.set_tensor(self.input, np.pad(piece, ((0, self.length - len(piece)), (0, 0))))
+            self.interpreter.invoke()
+            for instrument, index in self.outputs.items():
+                stems[instrument].append(self.interpreter.get_tensor(index)[:len(piece)])
+        return {instrument: np.concatenate(parts) for instrument, parts in stems.items()}
+
+
+def load(model, backend):
+    """The separator of backend for model, None when model was not exported for it."""
+    if exported(model, backend) is None:
+        return None
+    if backend == 'tflite':
+        return TfliteSeparator(model)
+    return FrozenSeparator(model, xla=backend == 'xla')
+
+
+def _snr(reference, estimate):
+    noise = np.sum((reference - estimate) ** 2)
+    signal = np.sum(reference ** 2)
+    if noise == 0:
+        return float('inf')
+    return float(10 * np.log10(max(signal, 1e-12) / noise))
+
+
+def _timed(separator, waveform, repeat):
+    separator.separate(waveform[:44100])
+    started = time.perf_counter()
+    for _ in range(repeat):
+        stems = separator.separate(waveform)
+    return stems, (time.perf_counter() - started) / repeat
+
+
+def check(model, backends, seconds=30.0, repeat=3, min_snr=30.0):
+    """Compare every exported backend with the stock Separator, returns the result dicts."""
+    from spleeter.separator import Separator
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * 44100), dtype=np.float32) / 44100
+    waveform = (sum(np.sin(2 * np.pi * f * t) for f in (220, 330, 440))[:, None] / 6
+                + rng.normal(0, 0.05, (len(t), 2))).astype(np.float32)
+    reference, ref_seconds = _timed(Separator(f'spleeter:{model}', multiprocess=False), waveform, repeat)
+    results = [{'model': model, 'backend': 'tf', 'seconds': round(ref_seconds, 4), 'rtf': round(ref_seconds / seconds, 4)}]
+    for backend in backends:
+        separator = load(model, backend)
+        if separator is None:
+            results.append({'model': model, 'backend': backend, 'error': 'not exported'})
+            continue
+        stems, backend_seconds = _timed(separator, waveform, repeat)
+        snr = {instrument: round(_snr(np.asarray(reference[instrument])[:len(waveform)],
+                                      np.asarray(stems[instrument])[:len(waveform)]), 2)
+               for instrument in reference}
+        results.append({'model': model, 'backend': backend, 'seconds': round(backend_seconds, 4),
+                        'rtf': round(backend_seconds / seconds, 4), 'speedup': round(ref_seconds / backend_seconds, 3),
+                        'snr_db': snr, 'ok': min(snr.values()) >= min_snr})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m vocal.export', description='Export models for faster inference')
+    parser.add_argument('--models', nargs='+', default=models.MODELS, choices=models.MODELS)
+    parser.add_argument('--formats', nargs='+', default=list(FORMATS), choices=list(FORMATS))
+    parser.add_argument('--check-only', action='store_true', help='only compare existing exports with the stock model')
+    parser.add_argument('--seconds', type=float, default=30, help='seconds of synthetic audio for the check')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per backend')
+    parser.add_argument('--min-snr', type=float, default=30, help='lowest acceptable SNR in dB against the stock model')
+    parser.add_argument('--out', default=None, help='JSON report path, default stdout')
+    args = parser.parse_args(argv)
+
+    # the comparison is for CPU serving
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+    missing = [m for m in args.models if not models.model_exists(m)]
+    if missing:
+        print(f"{', '.join(missing)} {cfg.transobj['lang4']}")
+        return 1
+    backends = [b for b, fmt in BACKENDS.items() if fmt in args.formats]
+    results = []
+    for model in args.models:
+        if not args.check_only:
+            export(model, args.formats)
+        results += check(model, backends, args.seconds, args.repeat, args.min_snr)
+    text = json.dumps({'results': results}, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0 if all(r.get('ok', True) and 'error' not in r for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
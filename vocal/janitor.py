@@ -0,0 +1,165 @@
+"""
+Deletes what TMP_DIR and FILES_DIR no longer need.
+
+Every entry (file in TMP_DIR, stems folder in FILES_DIR) has a last use: its result cache
+access time or its modification time, whichever is later. A sweep deletes entries past
+their directory's TTL or their explicit expiry (converted WAVs expire cfg.TMP_KEEP_AFTER_JOB
+seconds after their separation finished), then, above the directory's quota, the least
+recently used ones, and last, above the result cache's budget, its least recently used
+entries; the cache itself deletes nothing and asks for a sweep when it is over budget.
+Inputs and outputs of queued or running jobs and the files of live resumable uploads are
+never touched, and nothing used in the last `grace` seconds (eg. stems whose URLs were just handed out) is deleted for space. The
+result cache forgets whatever is deleted and the reclaimed space is counted in metrics.
+"""
+import logging
+import os
+import threading
+import time
+
+from vocal import cache, cfg, jobs, metrics, uploads
+
+logger = logging.getLogger(__name__)
+
+reclaimed_bytes = metrics.Counter('vocal_janitor_reclaimed_bytes_total', 'Bytes deleted by the janitor', ['dir'])
+removed_total = metrics.Counter('vocal_janitor_removed_total', 'Files and folders deleted by the janitor', ['dir', 'reason'])
+# Recorded by the process owning the job queue, where the janitor runs
+METRICS = {reclaimed_bytes.name, removed_total.name}
+
+
+class Janitor:
+    def __init__(self, rules, interval=300, grace=600):
+        # rules: (name, directory, ttl seconds or 0, max bytes or 0)
+        self.rules = rules
+        self.interval = interval
+        self.grace = grace
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._started = False
+        self.runs = 0
+        self.removed = 0
+        self.reclaimed = 0
+        self.last = None
+
+    def start(self):
+        if self.interval <= 0 or self._started:
+            return
+        self._started = True
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def wake(self):
+        """Sweep now rather than at the next interval, eg. when the result cache is over budget."""
+        if self._started:
+            self._wake.set()
+        elif not self._lock.locked():
+            threading.Thread(target=self._sweep, daemon=True).start()
+
+    def _loop(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self._sweep()
+
+    def _sweep(self):
+        try:
+            self.sweep()
+        except Exception as e:
+            logger.error(f'Sweep failed: {e}')
+
+    def _entries(self, directory, usage):
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            atime, expires = usage.get(path, (0, None))
+            entries.append((max(mtime, atime), expires, path, cache.path_size(path)))
+        return entries
+
+    def sweep(self):
+        """Run one pass now, returns what it deleted."""
+        with self._lock:
+            started = time.time()
+            uploads.store.expire()
+            usage = cache.result_cache.usage()
+            busy = jobs.job_queue.in_use() | uploads.store.in_use()
+            report = {'removed': [], 'reclaimed_bytes': 0}
+
+            def remove(name, path, size, reason):
+                cache.remove_path(path)
+                report['removed'].append({'path': path, 'bytes': size, 'reason': reason})
+                report['reclaimed_bytes'] += size
+                removed_total.inc(dir=name, reason=reason)
+                reclaimed_bytes.inc(size, dir=name)
+
+            for name, directory, ttl, max_bytes in self.rules:
+                if not os.path.isdir(directory):
+                    continue
+                entries = sorted(self._entries(directory, usage))
+                total = sum(size for *_, size in entries)
+                for last_used, expires, path, size in entries:
+                    if path in busy:
+                        continue
+                    if expires is not None and expires <= started:
+                        reason = 'expired'
+                    elif ttl and started - last_used > ttl:
+                        reason = 'ttl'
+                    elif max_bytes and total > max_bytes and started - last_used > self.grace:
+                        reason = 'quota'
+                    else:
+                        continue
+                    remove(name, path, size, reason)
+                    total -= size
+
+            budget = cache.result_cache.max_bytes
+            if budget > 0:
+                removed = {it['path'] for it in report['removed']}
+                entries = sorted(it for it in cache.result_cache.entries() if removed.isdisjoint(it[1]))
+                total = sum(size for *_, size in entries)
+                for last_used, paths, size in entries:
+                    if total <= budget:
+                        break
+                    if busy.intersection(paths) or started - last_used <= self.grace:
+                        continue
+                    for path in paths:
+                        remove('cache', path, cache.path_size(path), 'quota')
+                    total -= size
+            if report['removed']:
+                cache.result_cache.forget([it['path'] for it in report['removed']])
+            report['seconds'] = round(time.time() - started, 3)
+            self.runs += 1
+            self.removed += len(report['removed'])
+            self.reclaimed += report['reclaimed_bytes']
+            self.last = {'time': started, 'removed': len(report['removed']),
+                         'reclaimed_bytes': report['reclaimed_bytes'], 'seconds': report['seconds']}
+            if report['removed']:
+                logger.info(f"Removed {len(report['removed'])} entries, {report['reclaimed_bytes']} bytes")
+            return report
+
+    def stats(self):
+        return {'runs': self.runs, 'removed': self.removed, 'reclaimed_bytes': self.reclaimed, 'last': self.last,
+                'rules': [{'dir': name, 'ttl': ttl, 'max_bytes': max_bytes} for name, _, ttl, max_bytes in self.rules]}
+
+
+def separation_done(digest, model, job):
+    """
+    on_done of a separation job: index its stems, and let its converted WAV go
+    once no other job needs it (after cfg.TMP_KEEP_AFTER_JOB seconds).
+    """
+    cache.result_cache.add_stems(digest, model, job.result['dirname'])
+    wav_file = job.spec.get('wav_file')
+    if not wav_file:
+        return
+    if cfg.TMP_KEEP_AFTER_JOB <= 0 and wav_file not in jobs.job_queue.in_use():
+        cache.remove_path(wav_file)
+        cache.result_cache.forget([wav_file])
+    else:
+        cache.result_cache.expire(f'wav:{digest}', max(0, cfg.TMP_KEEP_AFTER_JOB))
+
+
+janitor = Janitor([
+    ('tmp', cfg.TMP_DIR, cfg.TMP_TTL, cfg.TMP_MAX_MB * 1024 * 1024),
+    ('files', cfg.FILES_DIR, cfg.FILES_TTL, cfg.FILES_MAX_MB * 1024 * 1024),
+], interval=cfg.JANITOR_INTERVAL, grace=cfg.JANITOR_GRACE)
+cache.result_cache.on_full = janitor.wake
@@ -0,0 +1,464 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor, CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from vocal import cfg, metrics, tool
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# Seconds between checks of a job's status while waiting for it
+WAIT_POLL = 0.05
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobNotFound(KeyError):
+    pass
+
+
+# Set in each worker by _init_worker, progress events go back to the parent through it
+_progress_queue = None
+
+
+def parse_cpus(text):
+    """'0-3,8' -> [0, 1, 2, 3, 8]"""
+    cpus = []
+    for part in text.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus += range(int(first), int(last) + 1)
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def worker_cpus(index, affinity=None, workers=None):
+    """CPUs inference worker `index` is pinned to under cfg.CPU_AFFINITY, None when it is not pinned."""
+    affinity = cfg.CPU_AFFINITY if affinity is None else affinity
+    if not affinity or not hasattr(os, 'sched_getaffinity'):
+        return None
+    if affinity == 'auto':
+        available = sorted(os.sched_getaffinity(0))
+        workers = max(1, workers or cfg.JOB_WORKERS)
+        if workers > len(available):
+            return [available[index % len(available)]]
+        index %= workers
+        return available[index * len(available) // workers:(index + 1) * len(available) // workers]
+    groups = [parse_cpus(it) for it in affinity.split(';') if it.strip()]
+    return groups[index % len(groups)] if groups else None
+
+
+def tune_worker(index=None):
+    """
+    Apply the inference settings of cfg to this process before TensorFlow is imported:
+    CPU pinning for worker `index` (None = don't pin), thread pools and precision.
+    Returns the CPUs the process was pinned to, or None.
+    """
+    cpus = worker_cpus(index) if index is not None else None
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    # TensorFlow reads these when it is first imported, which happens later in this worker
+    intra = cfg.TF_INTRA_THREADS or (len(cpus) if cpus else 0)
+    if intra:
+        os.environ.setdefault('TF_NUM_INTRAOP_THREADS', str(intra))
+        os.environ.setdefault('OMP_NUM_THREADS', str(intra))
+    if cfg.TF_INTER_THREADS:
+        os.environ.setdefault('TF_NUM_INTEROP_THREADS', str(cfg.TF_INTER_THREADS))
+    if cfg.PRECISION == 'mixed':
+        # grappler's float16 rewrite, applied to every session including spleeter's estimator
+        os.environ.setdefault('TF_ENABLE_AUTO_MIXED_PRECISION', '1')
+    return cpus
+
+
+def _init_worker(progress_queue, preload, counter=None):
+    global _progress_queue
+    _progress_queue = progress_queue
+    index = None
+    if counter is not None:
+        # worker processes number themselves in start order, replacements continue the count
+        with counter.get_lock():
+            index = counter.value
+            counter.value += 1
+    tune_worker(index)
+    # workers import TensorFlow anyway, probe the device here so the web process never has to
+    cfg.probe_cuda()
+    if preload:
+        from vocal import models
+        models.registry.preload(preload)
+
+
+def _report(job_id, stage, fraction):
+    if _progress_queue is not None:
+        _progress_queue.put((job_id, stage, fraction))
+
+
+def _warmup():
+    return True
+
+
+def _run(job_id, spec):
+    _report(job_id, RUNNING, 0.0)
+    if spec.get('kind') == 'batch':
+        from vocal import batch
+        data = batch.run(spec['inputs'], spec['model'], spec['dirname'],
+                         progress=lambda fraction: _report(job_id, 'separating', fraction), root=spec.get('root'))
+        files = [os.path.join(os.path.basename(r['output']), it) for r in data['files'] for it in r.get('files', [])]
+        return {'dirname': spec['dirname'], 'files': files, 'report': data}
+    from vocal import separation
+    if spec.get('kind') == 'waveform':
+        timings = {}
+        stems = separation.separate_waveform(spec['waveform'], spec['model'], timings=timings)
+        return {'stems': stems, 'timings': timings}
+    return separation.run(spec, progress=lambda stage, fraction: _report(job_id, stage, fraction))
+
+
+def _observe(model, status, result=None):
+    # stage timings come back from the worker with the result, record them in this process
+    model = model or ''
+    metrics.jobs_total.inc(model=model, status=status)
+    timings = (result or {}).get('timings') if status == DONE else None
+    if not timings:
+        return
+    if 'model_load' in timings:
+        metrics.model_load_seconds.observe(timings['model_load'], model=model)
+    metrics.decode_seconds.observe(timings['decode'], model=model)
+    metrics.write_seconds.observe(timings['write'], model=model)
+    if timings.get('duration'):
+        metrics.inference_ratio.observe(timings['inference'] / timings['duration'], model=model)
+
+
+class Job:
+    def __init__(self, spec):
+        self.id = uuid.uuid4().hex
+        self.spec = spec
+        self.status = QUEUED
+        self.stage = QUEUED
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+        # single-flight key, and how many requests are waiting for this job
+        self.key = None
+        self.waiters = 1
+        # failed because its worker process died, not because of the job itself
+        self.crashed = False
+
+    def __getstate__(self):
+        # sent to HTTP workers by the model server, without the future
+        state = self.__dict__.copy()
+        state['future'] = None
+        return state
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': round(self.progress, 3),
+            'model': self.spec.get('model'),
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class JobQueue:
+    """
+    Runs separation jobs on a bounded pool of workers.
+
+    With workers > 0 every worker is a separate process holding its own warm models,
+    so TensorFlow never runs inside the gevent server process. workers = 0 runs jobs
+    on a single in-process thread instead. At most max_pending jobs may be queued or
+    running at once, submit() raises QueueFull beyond that.
+    """
+
+    def __init__(self, workers=1, max_pending=16, history=1000):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.history = history
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._executor = None
+        self._progress = None
+        self._counter = None
+        # run() calls in flight, they count against max_pending but are not kept as jobs
+        self._inflight = 0
+        # key -> unfinished job submitted with that key
+        self._flights = {}
+
+    def start(self):
+        with self._lock:
+            if self._executor is not None:
+                return
+            if self.workers > 0:
+                ctx = multiprocessing.get_context('spawn')
+                self._progress = ctx.Queue()
+                self._counter = ctx.Value('i', 0)
+            else:
+                self._progress = queue.Queue()
+            self._executor = self._create_executor()
+            threading.Thread(target=self._drain, daemon=True).start()
+
+    def _create_executor(self):
+        if self.workers > 0:
+            executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self._progress, cfg.PRELOAD_MODELS, self._counter)
+            )
+        else:
+            executor = ThreadPoolExecutor(
+                max_workers=1,
+                initializer=_init_worker,
+                initargs=(self._progress, cfg.PRELOAD_MODELS)
+            )
+        # workers start lazily, an empty task per worker brings them (and their preloads) up now
+        for _ in range(max(1, self.workers)):
+            executor.submit(_warmup)
+        return executor
+
+    def _replace(self, broken):
+        """
+        Start new workers in place of the broken executor. When a worker process dies (eg.
+        killed for memory on a long file) the pool fails every job it holds and refuses any
+        new one; without this the queue would stay broken until the server restarts.
+        Called with the lock held.
+        """
+        if self._executor is not broken:
+            return
+        logger.warning('A worker process died, starting new workers')
+        self._executor = self._create_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, *args):
+        # called with the lock held; (future, executor it runs on)
+        try:
+            return self._executor.submit(*args), self._executor
+        except BrokenExecutor:
+            self._replace(self._executor)
+            return self._executor.submit(*args), self._executor
+
+    def _drain(self):
+        while True:
+            try:
+                job_id, stage, fraction = self._progress.get()
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None or job.status in FINISHED:
+                    continue
+                if job.status == QUEUED:
+                    job.status = RUNNING
+                    job.started = time.time()
+                job.stage = stage
+                job.progress = max(job.progress, fraction)
+
+    def _land(self, job):
+        # called with the lock held once job finished
+        if job.key is not None and self._flights.get(job.key) is job:
+            del self._flights[job.key]
+
+    def _done(self, job, future, executor, on_done=None):
+        with self._lock:
+            self._land(job)
+            if not future.cancelled() and isinstance(future.exception(), BrokenExecutor):
+                self._replace(executor)
+            if job.status == CANCELLED:
+                return
+            job.finished = time.time()
+            try:
+                job.result = future.result()
+                job.status = DONE
+                job.stage = DONE
+                job.progress = 1.0
+            except CancelledError:
+                job.status = CANCELLED
+            except BrokenExecutor as e:
+                job.status = FAILED
+                job.error = f'worker process died: {e}'
+                job.crashed = True
+            except Exception as e:
+                job.status = FAILED
+                job.error = str(e)
+        _observe(job.spec.get('model'), job.status, job.result)
+        if on_done is not None and job.status == DONE:
+            try:
+                on_done(job)
+            except Exception as e:
+                logger.error(f'on_done for {job.id} failed: {e}')
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in FINISHED]
+        for job_id in finished[:max(0, len(self._jobs) - self.history)]:
+            del self._jobs[job_id]
+
+    def _pending(self):
+        return self._inflight + sum(1 for job in self._jobs.values() if job.status not in FINISHED)
+
+    def pending(self):
+        with self._lock:
+            return self._pending()
+
+    def in_use(self):
+        """Input and output paths of the jobs queued or running."""
+        with self._lock:
+            specs = [job.spec for job in self._jobs.values() if job.status not in FINISHED]
+        return {spec[key] for spec in specs for key in ('wav_file', 'dirname') if spec.get(key)}
+
+    def submit(self, spec, on_done=None, key=None):
+        """
+        Queue spec for separation. on_done(job) runs once the job has finished successfully.
+        While a job submitted with the same key is queued or running, that job is returned
+        instead and its on_done stands for both.
+        """
+        self.start()
+        with self._lock:
+            job = self._flights.get(key) if key is not None else None
+            if job is not None and job.status not in FINISHED:
+                job.waiters += 1
+                metrics.jobs_deduplicated.inc(model=spec.get('model') or '')
+                return job
+            if self._pending() >= self.max_pending:
+                raise QueueFull(f'{self.max_pending} jobs already pending')
+            job = Job(spec)
+            job.key = key
+            self._jobs[job.id] = job
+            self._prune()
+            job.future, executor = self._submit(_run, job.id, spec)
+            if key is not None:
+                self._flights[key] = job
+        job.future.add_done_callback(lambda future: self._done(job, future, executor, on_done))
+        return job
+
+    def run(self, spec):
+        """
+        Run spec on a worker and return its result, blocking (a request greenlet only
+        blocks itself). Nothing is kept once it returns, so in-memory inputs and results
+        (eg. waveforms) don't stay in the history.
+        """
+        self.start()
+        with self._lock:
+            if self._pending() >= self.max_pending:
+                raise QueueFull(f'{self.max_pending} jobs already pending')
+            self._inflight += 1
+        status, result = FAILED, None
+        try:
+            with self._lock:
+                future, executor = self._submit(_run, None, spec)
+            done = threading.Event()
+            future.add_done_callback(lambda _: done.set())
+            tool.wait(done)
+            if isinstance(future.exception(), BrokenExecutor):
+                with self._lock:
+                    self._replace(executor)
+            result = future.result()
+            status = DONE
+            return result
+        finally:
+            with self._lock:
+                self._inflight -= 1
+            _observe(spec.get('model'), status, result)
+
+    def completed(self, spec, result):
+        """Record a job whose result is already known, eg. served from the result cache."""
+        job = Job(spec)
+        job.status = job.stage = DONE
+        job.progress = 1.0
+        job.result = result
+        job.started = job.finished = job.created
+        job.future = Future()
+        job.future.set_result(result)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise JobNotFound(job_id)
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancel a job. A queued job never starts; a running job cannot be interrupted
+        inside TensorFlow, it runs to completion but its result is discarded. A job
+        other requests joined keeps running for them, one waiter fewer.
+        """
+        job = self.get(job_id)
+        with self._lock:
+            if job.status in FINISHED:
+                return False
+            if job.waiters > 1:
+                job.waiters -= 1
+                return True
+            self._land(job)
+            job.status = CANCELLED
+            job.stage = CANCELLED
+            job.finished = time.time()
+        _observe(job.spec.get('model'), CANCELLED)
+        if job.future is not None:
+            job.future.cancel()
+        return True
+
+    def wait(self, job_id, timeout=None):
+        """
+        The job once it finished, or as it is after timeout seconds. Polled with tool.sleep,
+        so a request greenlet waiting for a separation holds neither the hub nor a thread.
+        """
+        job = self.get(job_id)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # the status is set by the done callback, once the future's result is in
+        while job.status not in FINISHED:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            tool.sleep(WAIT_POLL)
+        return job
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_queue(backend=None):
+    """
+    The job queue of cfg.JOB_BACKEND. Every backend has the interface of JobQueue (start,
+    submit, run, completed, get, cancel, wait, pending, in_use, shutdown):
+        local   JobQueue on this host's workers
+        sqlite  vocal.jobstore.SharedJobQueue, jobs shared by every node using cfg.JOB_STORE
+    """
+    backend = backend or cfg.JOB_BACKEND
+    local = JobQueue(cfg.JOB_WORKERS, cfg.JOB_QUEUE_SIZE, cfg.JOB_HISTORY)
+    if backend == 'local':
+        return local
+    if backend == 'sqlite':
+        from vocal import jobstore
+        store = jobstore.JobStore(cfg.JOB_STORE, cfg.JOB_QUEUE_SIZE, cfg.JOB_HISTORY, cfg.JOB_MAX_ATTEMPTS)
+        return jobstore.SharedJobQueue(store, local, cfg.INFERENCE, cfg.NODE_ID, cfg.JOB_LEASE)
+    raise ValueError(f'unknown job backend {backend!r}')
+
+
+job_queue = create_queue()
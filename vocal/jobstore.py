@@ -0,0 +1,441 @@
+"""
+Shared job backend: separation jobs of several nodes go through one SQLite database on
+storage they all mount (cfg.JOB_STORE, next to cfg.DATA_DIR), so any node can take them.
+
+    VOCAL_JOB_BACKEND=sqlite VOCAL_DATA_DIR=/mnt/vocal python start.py     web + inference
+    VOCAL_JOB_BACKEND=sqlite VOCAL_DATA_DIR=/mnt/vocal python -m vocal.jobstore   inference only
+
+Any node may submit. A node running inference leases the oldest queued job for
+cfg.JOB_LEASE seconds, runs it on its own jobs.JobQueue and renews the lease while it
+runs (the heartbeat, which also carries its progress), then writes the result back. A
+node that dies stops renewing; once its lease ran out the job is queued again, and after
+cfg.JOB_MAX_ATTEMPTS attempts it fails. A node whose worker process died gives the job
+back the same way, and leases nothing for a lease period. Cancelling marks the row, the
+node running it notices at its next heartbeat. Jobs and results are rows of the database,
+so they outlive restarts of any node, and a separation whose stems are still on disk is
+not run again.
+
+SharedJobQueue has the interface of jobs.JobQueue, its database calls run in the gevent
+threadpool: waiting for the lock on shared storage must not stall the server. Only specs
+that are plain JSON go through the database: in-memory jobs (run(), eg. /waveform) run on
+this node's workers. The database uses SQLite's rollback journal, not WAL, which needs
+shared memory that network filesystems don't have.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from vocal import cfg, jobs, metrics, tool
+
+logger = logging.getLogger(__name__)
+
+# Seconds between polls of the database while waiting for a job or for work
+POLL = 0.5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    key TEXT,
+    spec TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    node TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    waiters INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key);
+"""
+
+UNFINISHED = (jobs.QUEUED, jobs.RUNNING)
+
+
+def _job(row):
+    # a jobs.Job snapshot of a row, read by routes like a local job
+    job = jobs.Job(json.loads(row['spec']))
+    job.id = row['id']
+    job.key = row['key']
+    job.status = row['status']
+    job.stage = row['stage']
+    job.progress = row['progress']
+    job.result = json.loads(row['result']) if row['result'] else None
+    job.error = row['error']
+    job.created = row['created']
+    job.started = row['started']
+    job.finished = row['finished']
+    job.waiters = row['waiters']
+    return job
+
+
+class JobStore:
+    """The jobs table; every method is one transaction, safe across threads, processes and hosts."""
+
+    def __init__(self, path, max_pending=16, history=1000, max_attempts=3):
+        self.path = path
+        self.max_pending = max_pending
+        self.history = history
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+
+    def _conn(self):
+        # one connection per thread and process, none is carried over a fork
+        pid, conn = getattr(self._local, 'conn', (None, None))
+        if pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.executescript(SCHEMA)
+            self._local.conn = (os.getpid(), conn)
+        return conn
+
+    @contextmanager
+    def _tx(self):
+        # IMMEDIATE takes the write lock up front, so two nodes never lease the same job
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _expire(self, conn, now):
+        # jobs of nodes that stopped renewing their lease: queued again, or failed after max_attempts
+        conn.execute("UPDATE jobs SET status = ?, stage = ?, finished = ?, error = 'lost by node ' || node "
+                     "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                     (jobs.FAILED, jobs.FAILED, now, jobs.RUNNING, now, self.max_attempts))
+        conn.execute('UPDATE jobs SET status = ?, stage = ?, node = NULL, lease_expires = NULL '
+                     'WHERE status = ? AND lease_expires < ?', (jobs.QUEUED, jobs.QUEUED, jobs.RUNNING, now))
+
+    def _prune(self, conn):
+        conn.execute('DELETE FROM jobs WHERE status NOT IN (?, ?) AND id NOT IN '
+                     '(SELECT id FROM jobs WHERE status NOT IN (?, ?) ORDER BY created DESC LIMIT ?)',
+                     (*UNFINISHED, *UNFINISHED, self.history))
+
+    def _pending(self, conn):
+        return conn.execute('SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)', UNFINISHED).fetchone()[0]
+
+    def submit(self, spec, key=None):
+        """
+        Queue spec, returns (job, joined). joined is True when an unfinished job with the
+        same key was returned instead, or the latest finished one whose stems are still there.
+        """
+        now = time.time()
+        with self._tx() as conn:
+            if key is not None:
+                self._expire(conn, now)
+                row = conn.execute('SELECT * FROM jobs WHERE key = ? AND status IN (?, ?, ?) ORDER BY created DESC',
+                                   (key, *UNFINISHED, jobs.DONE)).fetchone()
+                if row is not None and row['status'] in UNFINISHED:
+                    conn.execute('UPDATE jobs SET waiters = waiters + 1 WHERE id = ?', (row['id'],))
+                    return _job(row), True
+                if row is not None and os.path.isdir(json.loads(row['result'])['dirname']):
+                    return _job(row), True
+            if self._pending(conn) >= self.max_pending:
+                raise jobs.QueueFull(f'{self.max_pending} jobs already pending')
+            job_id = uuid.uuid4().hex
+            conn.execute('INSERT INTO jobs (id, key, spec, status, stage, created) VALUES (?, ?, ?, ?, ?, ?)',
+                         (job_id, key, json.dumps(spec), jobs.QUEUED, jobs.QUEUED, now))
+            self._prune(conn)
+            return _job(conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()), False
+
+    def completed(self, spec, result):
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with self._tx() as conn:
+            conn.execute('INSERT INTO jobs (id, spec, status, stage, progress, result, created, started, finished) '
+                         'VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?)',
+                         (job_id, json.dumps(spec), jobs.DONE, jobs.DONE, json.dumps(result), now, now, now))
+            self._prune(conn)
+        return self.get(job_id)
+
+    def get(self, job_id):
+        row = self._conn().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            raise jobs.JobNotFound(job_id)
+        return _job(row)
+
+    def lease(self, node, seconds):
+        """Take the oldest queued job for node, None when there is none."""
+        now = time.time()
+        with self._tx() as conn:
+            self._expire(conn, now)
+            row = conn.execute('SELECT id FROM jobs WHERE status = ? ORDER BY created LIMIT 1', (jobs.QUEUED,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE jobs SET status = ?, stage = ?, node = ?, lease_expires = ?, attempts = attempts + 1, '
+                         'started = COALESCE(started, ?) WHERE id = ?',
+                         (jobs.RUNNING, jobs.RUNNING, node, now + seconds, now, row['id']))
+            return _job(conn.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone())
+
+    def heartbeat(self, job_id, node, seconds, stage=None, progress=None):
+        """Renew node's lease on job_id. False when the job was cancelled or leased to another node."""
+        with self._tx() as conn:
+            cursor = conn.execute('UPDATE jobs SET lease_expires = ?, stage = COALESCE(?, stage), '
+                                  'progress = MAX(progress, COALESCE(?, 0)) WHERE id = ? AND node = ? AND status = ?',
+                                  (time.time() + seconds, stage, progress, job_id, node, jobs.RUNNING))
+            return cursor.rowcount == 1
+
+    def finish(self, job_id, node, status, result=None, error=None):
+        """Record the outcome of node's run of job_id, False when the job is no longer node's."""
+        with self._tx() as conn:
+            cursor = conn.execute('UPDATE jobs SET status = ?, stage = ?, progress = ?, result = ?, error = ?, '
+                                  'finished = ?, lease_expires = NULL WHERE id = ? AND node = ? AND status = ?',
+                                  (status, status, 1.0 if status == jobs.DONE else 0.0,
+                                   json.dumps(result) if result is not None else None, error, time.time(),
+                                   job_id, node, jobs.RUNNING))
+            return cursor.rowcount == 1
+
+    def release(self, job_id, node, error=None):
+        """
+        Give node's lease on job_id back without a result, eg. when the worker process running
+        it died: the job is queued again, or fails with error after max_attempts attempts.
+        False when the job is no longer node's.
+        """
+        with self._tx() as conn:
+            row = conn.execute('SELECT attempts FROM jobs WHERE id = ? AND node = ? AND status = ?',
+                               (job_id, node, jobs.RUNNING)).fetchone()
+            if row is None:
+                return False
+            if row['attempts'] >= self.max_attempts:
+                conn.execute('UPDATE jobs SET status = ?, stage = ?, error = ?, finished = ?, lease_expires = NULL '
+                             'WHERE id = ?', (jobs.FAILED, jobs.FAILED, error, time.time(), job_id))
+            else:
+                conn.execute('UPDATE jobs SET status = ?, stage = ?, node = NULL, lease_expires = NULL WHERE id = ?',
+                             (jobs.QUEUED, jobs.QUEUED, job_id))
+            return True
+
+    def cancel(self, job_id):
+        """Like jobs.JobQueue.cancel(); returns (cancelled, status the job had)."""
+        with self._tx() as conn:
+            row = conn.execute('SELECT status, waiters FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                raise jobs.JobNotFound(job_id)
+            if row['status'] not in UNFINISHED:
+                return False, row['status']
+            if row['waiters'] > 1:
+                conn.execute('UPDATE jobs SET waiters = waiters - 1 WHERE id = ?', (job_id,))
+                return True, row['status']
+            conn.execute('UPDATE jobs SET status = ?, stage = ?, finished = ? WHERE id = ?',
+                         (jobs.CANCELLED, jobs.CANCELLED, time.time(), job_id))
+            return True, row['status']
+
+    def pending(self):
+        return self._pending(self._conn())
+
+    def in_use(self):
+        rows = self._conn().execute('SELECT spec FROM jobs WHERE status IN (?, ?)', UNFINISHED).fetchall()
+        specs = [json.loads(row['spec']) for row in rows]
+        return {spec[key] for spec in specs for key in ('wav_file', 'dirname') if spec.get(key)}
+
+
+class Worker:
+    """Leases jobs from a JobStore and runs them on a local jobs.JobQueue, `slots` at a time."""
+
+    def __init__(self, store, local, slots=1, node=None, lease=30):
+        self.store = store
+        self.local = local
+        self.slots = max(1, slots)
+        self.node = node or cfg.NODE_ID
+        self.lease = lease
+        self._stop = threading.Event()
+        # no leasing before this time.monotonic(), set when the local workers failed
+        self._paused_until = 0
+
+    def start(self):
+        for _ in range(self.slots):
+            threading.Thread(target=self._loop, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            if time.monotonic() < self._paused_until:
+                self._stop.wait(POLL)
+                continue
+            try:
+                job = self.store.lease(self.node, self.lease)
+            except sqlite3.Error as e:
+                logger.error(f'Leasing failed: {e}')
+                job = None
+            if job is None:
+                self._stop.wait(POLL)
+                continue
+            try:
+                self._execute(job)
+            except sqlite3.Error as e:
+                # the lease runs out and the job is retried
+                logger.error(f'Job {job.id} lost: {e}')
+
+    def _release(self, job, error):
+        # this node could not run the job, which is not the job's fault: hand it back (another
+        # node may take it) and stop leasing until the local workers had time to come back
+        logger.warning(f'Giving job {job.id} back: {error}')
+        self._paused_until = time.monotonic() + self.lease
+        self.store.release(job.id, self.node, error)
+
+    def _execute(self, job):
+        try:
+            local = self.local.submit(job.spec)
+        except Exception as e:
+            self._release(job, str(e))
+            return
+        # renewed three times per lease, a missed heartbeat or two is not fatal
+        while local.status not in jobs.FINISHED:
+            self.local.wait(local.id, timeout=self.lease / 3)
+            if local.status in jobs.FINISHED:
+                break
+            try:
+                alive = self.store.heartbeat(job.id, self.node, self.lease, local.stage, local.progress)
+            except sqlite3.Error as e:
+                logger.warning(f'Heartbeat for {job.id} failed: {e}')
+                continue
+            if not alive:
+                # cancelled, or given to another node after we missed the lease
+                self.local.cancel(local.id)
+                return
+        if local.crashed:
+            # the worker process died; jobs.JobQueue started new ones
+            self._release(job, local.error)
+            return
+        self.store.finish(job.id, self.node, local.status, local.result, local.error)
+
+
+class SharedJobQueue:
+    """
+    jobs.JobQueue interface on a JobStore. With inference, this node also leases jobs and
+    runs them on `local`. on_done callbacks run on the node that submitted the job.
+    """
+
+    def __init__(self, store, local, inference=True, node=None, lease=30):
+        self.store = store
+        self.local = local
+        self.worker = Worker(store, local, local.workers, node, lease) if inference else None
+        self._lock = threading.Lock()
+        self._started = False
+        # job id -> on_done of a job submitted here
+        self._callbacks = {}
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        if self.worker is not None:
+            self.local.start()
+            self.worker.start()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(POLL)
+            with self._lock:
+                waiting = list(self._callbacks)
+            for job_id in waiting:
+                try:
+                    self._settle(self.store.get(job_id))
+                except jobs.JobNotFound:
+                    self._callbacks.pop(job_id, None)
+                except sqlite3.Error as e:
+                    logger.warning(f'Polling {job_id} failed: {e}')
+
+    def _settle(self, job):
+        if job.status not in jobs.FINISHED:
+            return
+        with self._lock:
+            on_done = self._callbacks.pop(job.id, None)
+        if on_done is not None and job.status == jobs.DONE:
+            try:
+                on_done(job)
+            except Exception as e:
+                logger.error(f'on_done for {job.id} failed: {e}')
+
+    def submit(self, spec, on_done=None, key=None):
+        self.start()
+        job, joined = tool.offload(self.store.submit, spec, key)
+        if joined and job.status == jobs.DONE:
+            # separated before, possibly by another node or before a restart
+            if on_done is not None:
+                on_done(job)
+        elif joined:
+            metrics.jobs_deduplicated.inc(model=spec.get('model') or '')
+        elif on_done is not None:
+            with self._lock:
+                self._callbacks[job.id] = on_done
+        return job
+
+    def run(self, spec):
+        # in-memory inputs and results stay on this node
+        return self.local.run(spec)
+
+    def completed(self, spec, result):
+        return tool.offload(self.store.completed, spec, result)
+
+    def get(self, job_id):
+        return tool.offload(self.store.get, job_id)
+
+    def cancel(self, job_id):
+        cancelled, status = tool.offload(self.store.cancel, job_id)
+        if cancelled and status == jobs.QUEUED:
+            # a running job is counted by the node running it
+            metrics.jobs_total.inc(model=self.get(job_id).spec.get('model') or '', status=jobs.CANCELLED)
+        return cancelled
+
+    def wait(self, job_id, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if job.status in jobs.FINISHED:
+                self._settle(job)
+                return job
+            if deadline is not None and time.monotonic() >= deadline:
+                return job
+            tool.sleep(POLL)
+
+    def pending(self):
+        return tool.offload(self.store.pending)
+
+    def in_use(self):
+        return tool.offload(self.store.in_use)
+
+    def shutdown(self):
+        if self.worker is not None:
+            self.worker.stop()
+        self.local.shutdown()
+
+
+def main():
+    # an inference-only node, without start.py's log handlers
+    from vocal import janitor
+    logging.basicConfig(level=cfg.LOG_LEVEL, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if cfg.JOB_BACKEND != 'sqlite':
+        logger.error('Set VOCAL_JOB_BACKEND=sqlite (and VOCAL_DATA_DIR to the shared storage)')
+        return 1
+    queue = jobs.job_queue
+    queue.start()
+    janitor.janitor.start()
+    logger.warning(f'Node {cfg.NODE_ID} running jobs from {cfg.JOB_STORE}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        queue.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,153 @@
+import json
+import os
+import struct
+import subprocess
+import sys
+from collections import namedtuple
+from functools import lru_cache
+
+MediaInfo = namedtuple('MediaInfo', [
+    'duration',         # seconds
+    'sample_rate',
+    'channels',
+    'bits_per_sample',  # 0 when unknown (non-WAV containers)
+    'format_tag',       # WAV format tag: 1 PCM, 3 IEEE float, 0xFFFE extensible; 0 otherwise
+    'data_offset',      # byte offset of the sample data in a WAV, 0 otherwise
+    'data_size',        # bytes of sample data in a WAV, 0 otherwise
+])
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+# (WAV format tag, bits per sample) -> (sample dtype, factor to [-1, 1]) of the WAVs open_wav() reads
+DTYPES = {
+    (WAVE_FORMAT_PCM, 16): ('<i2', 1 / 32768),
+    (WAVE_FORMAT_PCM, 32): ('<i4', 1 / 2 ** 31),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): ('<f4', 1.0),
+}
+
+
+def parse_wav_header(f, file_size):
+    """
+    Parse a RIFF header from the file object f, positioned at its start. Returns MediaInfo,
+    or None if it isn't a WAV or f ends before the data chunk. With file_size None (the
+    beginning of a stream) the data size is taken from the header as it is.
+    """
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        return None
+    fmt = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        chunk_id, chunk_size = struct.unpack('<4sI', header)
+        if chunk_id == b'fmt ':
+            body = f.read(chunk_size)
+            if len(body) < 16:
+                return None
+            format_tag, channels, sample_rate, byte_rate, block_align, bits = struct.unpack('<HHIIHH', body[:16])
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                # the real format tag is the first two bytes of the sub-format GUID
+                format_tag = struct.unpack('<H', body[24:26])[0]
+            fmt = (format_tag, channels, sample_rate, byte_rate, block_align, bits)
+        elif chunk_id == b'data':
+            if fmt is None:
+                return None
+            offset = f.tell()
+            # streamed WAVs may leave the size as 0 or 0xFFFFFFFF, trust the file size then
+            if file_size is not None and (chunk_size in (0, 0xFFFFFFFF) or offset + chunk_size > file_size):
+                chunk_size = file_size - offset
+            format_tag, channels, sample_rate, byte_rate, block_align, bits = fmt
+            if not byte_rate:
+                return None
+            return MediaInfo(chunk_size / byte_rate, sample_rate, channels, bits, format_tag, offset, chunk_size)
+        else:
+            # chunks are word aligned
+            f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+        if chunk_id == b'fmt ' and chunk_size & 1:
+            f.seek(1, os.SEEK_CUR)
+
+
+def read_wav_header(path):
+    """Parse the RIFF header of a WAV file in-process, returns MediaInfo or None if it isn't one."""
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        return parse_wav_header(f, file_size)
+
+
+def conforms(info, sample_rate, channels):
+    """
+    True when info describes a 16-bit PCM or 32-bit float WAV at sample_rate with channels,
+    which the models read as it is (see models.input_format).
+    """
+    return (info is not None and info.sample_rate == sample_rate and info.channels == channels
+            and (info.format_tag, info.bits_per_sample) in ((WAVE_FORMAT_PCM, 16), (WAVE_FORMAT_IEEE_FLOAT, 32)))
+
+
+def open_wav(path):
+    """(frames, channels) memmap of a WAV's samples, the factor scaling them to [-1, 1], and its MediaInfo."""
+    # imported here, the web process reads headers only
+    import numpy as np
+    info = read_wav_header(path)
+    if info is None or (info.format_tag, info.bits_per_sample) not in DTYPES:
+        raise ValueError(f'{os.path.basename(path)}: not a 16/32-bit PCM or float WAV')
+    dtype, scale = DTYPES[(info.format_tag, info.bits_per_sample)]
+    frames = info.data_size // (np.dtype(dtype).itemsize * info.channels)
+    if not frames:
+        return np.zeros((0, info.channels), dtype=dtype), scale, info
+    return np.memmap(path, dtype=dtype, mode='r', offset=info.data_offset, shape=(frames, info.channels)), scale, info
+
+
+def run_ffprobe(path):
+    p = subprocess.run(
+        [
+            'ffprobe', '-v', 'error',
+            '-select_streams', 'a:0',
+            '-show_entries', 'stream=sample_rate,channels,bits_per_sample:format=duration',
+            '-of', 'json',
+            path
+        ],
+        capture_output=True,
+        check=False,
+        creationflags=0 if sys.platform != 'win32' else subprocess.CREATE_NO_WINDOW
+    )
+    if p.returncode != 0:
+        return None
+    data = json.loads(p.stdout or b'{}')
+    streams = data.get('streams') or [{}]
+    duration = data.get('format', {}).get('duration')
+    if duration is None:
+        return None
+    return MediaInfo(
+        float(duration),
+        int(streams[0].get('sample_rate', 0)),
+        int(streams[0].get('channels', 0)),
+        int(streams[0].get('bits_per_sample', 0)),
+        0, 0, 0
+    )
+
+
+@lru_cache(maxsize=1024)
+def _probe(path, size, mtime_ns):
+    info = None
+    if path.lower().endswith('.wav'):
+        info = read_wav_header(path)
+    if info is None:
+        info = run_ffprobe(path)
+    return info
+
+
+def probe(path):
+    """
+    Duration, sample rate and channel layout of path.
+
+    WAV headers are read in-process; other containers fall back to one ffprobe call.
+    Results are memoized per (path, size, mtime), so probing the same file again is free
+    and a rewritten file is probed afresh. Returns None when the file can't be read.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return _probe(os.path.abspath(path), st.st_size, st.st_mtime_ns)
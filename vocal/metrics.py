@@ -0,0 +1,150 @@
+"""
+Minimal Prometheus metrics: counters, gauges and histograms with labels, rendered in
+the text exposition format by render(). Everything is in-process and lock protected;
+job workers send their stage timings back with the job result and the parent records
+them, so /metrics on the web process sees the whole pipeline.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_metrics = []
+
+# Seconds, from quick conversions to hour long separations
+TIME_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+# Bytes, 1MB .. 4GB
+SIZE_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(0, 13, 2))
+# Seconds of work per second of audio
+RATIO_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{k}="{str(v)}"' for k, v in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labels)
+        self._values = {}
+        with _lock:
+            _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(k, '') for k in self.labelnames)
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with _lock:
+            items = list(self._values.items())
+        return self._header() + [f'{self.name}{_labels(self.labelnames, k)} {v}' for k, v in items]
+
+
+class Gauge(_Metric):
+    """A gauge set explicitly, or read from fn() at render time."""
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=(), fn=None):
+        super().__init__(name, doc, labels)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        with _lock:
+            self._values[self._key(labels)] = value
+
+    def render(self):
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception:
+                value = None
+            if value is None:
+                return []
+            return self._header() + [f'{self.name} {value}']
+        with _lock:
+            items = list(self._values.items())
+        return self._header() + [f'{self.name}{_labels(self.labelnames, k)} {v}' for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        with _lock:
+            items = [(k, list(counts), total) for k, (counts, total) in self._values.items()]
+        lines = self._header()
+        for key, counts, total in items:
+            base = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                names, values = zip(*(base + [('le', le)]))
+                lines.append(f'{self.name}_bucket{_labels(names, values)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+def render(names=None, exclude=()):
+    """Text exposition of every metric, or only those in names, minus those in exclude."""
+    with _lock:
+        metrics = [m for m in _metrics if (names is None or m.name in names) and m.name not in exclude]
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+upload_bytes = Histogram('vocal_upload_bytes', 'Size of uploaded files', buckets=SIZE_BUCKETS)
+upload_seconds = Histogram('vocal_upload_seconds', 'Time to receive, hash and decode an upload')
+ffmpeg_seconds = Histogram('vocal_ffmpeg_seconds', 'Wall time of ffmpeg conversions', ['status'])
+model_load_seconds = Histogram('vocal_model_load_seconds', 'Time to build a Separator and restore its checkpoint', ['model'])
+decode_seconds = Histogram('vocal_decode_seconds', 'Time to load the input waveform for separation', ['model'])
+inference_ratio = Histogram('vocal_inference_seconds_per_audio_second', 'Inference time per second of audio',
+                            ['model'], buckets=RATIO_BUCKETS)
+write_seconds = Histogram('vocal_output_write_seconds', 'Time to write the separated stems', ['model'])
+jobs_total = Counter('vocal_jobs_total', 'Finished separation jobs', ['model', 'status'])
+jobs_deduplicated = Counter('vocal_jobs_deduplicated_total', 'Separations that joined an identical job in flight', ['model'])
+
+# Recorded by the process owning the job queue
+JOB_METRICS = {m.name for m in (model_load_seconds, decode_seconds, inference_ratio, write_seconds, jobs_total,
+                                 jobs_deduplicated)}
@@ -0,0 +1,148 @@
+import gc
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from vocal import cfg
+
+logger = logging.getLogger(__name__)
+
+MODELS = ['2stems', '4stems', '5stems']
+# stems each model produces
+STEMS = {
+    '2stems': ['vocals', 'accompaniment'],
+    '4stems': ['vocals', 'drums', 'bass', 'other'],
+    '5stems': ['vocals', 'drums', 'bass', 'piano', 'other'],
+}
+
+# (sample rate, channels) each model takes, the rate and layout it was trained at
+INPUT_FORMAT = {model: (44100, 2) for model in MODELS}
+
+# spleeter resolves "spleeter:<model>" against MODEL_PATH, point it at our bundled models
+os.environ.setdefault('MODEL_PATH', cfg.MODEL_DIR)
+
+
+def input_format(model=None):
+    """
+    (sample rate, channels) of model's input. Uploads are converted before a model is
+    picked, to the format of the first model, which every bundled model shares.
+    """
+    return INPUT_FORMAT.get(model) or INPUT_FORMAT[MODELS[0]]
+
+
+def model_exists(model):
+    return bool(model) and os.path.exists(os.path.join(cfg.MODEL_DIR, model, 'model.meta'))
+
+
+def estimate_size(model):
+    # Checkpoint size on disk times a rough factor for the TF graph and session buffers
+    model_dir = os.path.join(cfg.MODEL_DIR, model)
+    total = 0
+    for name in os.listdir(model_dir):
+        path = os.path.join(model_dir, name)
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+    return total * 3
+
+
+class ModelRegistry:
+    """
+    Keeps one warm spleeter Separator per model.
+
+    Each model is built and its checkpoint restored once, then reused by every request.
+    Models are evicted least-recently-used first when the estimated resident size of
+    all loaded models exceeds the budget. A model is never loaded twice concurrently,
+    and one Separator only runs one separation at a time since spleeter feeds
+    its prediction generator through shared state.
+    """
+
+    def __init__(self, budget_mb=0):
+        self.budget = budget_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        # model -> (separator, estimated bytes)
+        self._models = OrderedDict()
+        # model -> lock held while the model is loading
+        self._loading = {}
+        # model -> lock held while a separation is running on it
+        self._running = {}
+        # model -> seconds its last load took
+        self.load_seconds = {}
+
+    def _load(self, model):
+        # TensorFlow/spleeter are only imported once a model is actually needed
+        import numpy as np
+        separator = None
+        if cfg.INFERENCE_BACKEND != 'tf':
+            from vocal import export
+            separator = export.load(model, cfg.INFERENCE_BACKEND)
+            if separator is None:
+                logger.warning(f'{model} has no {cfg.INFERENCE_BACKEND} export, using the stock graph')
+        if separator is None:
+            from spleeter.separator import Separator
+            separator = Separator(f'spleeter:{model}', multiprocess=False)
+        # Run a second of silence through the model so the graph is built and
+        # the checkpoint restored now, not on the first real request
+        separator.separate(np.zeros((44100, 2), dtype=np.float32))
+        return separator
+
+    def _evict(self, keep):
+        if self.budget <= 0:
+            return
+        total = sum(size for _, size in self._models.values())
+        for model in list(self._models):
+            if total <= self.budget:
+                break
+            if model == keep:
+                continue
+            _, size = self._models.pop(model)
+            total -= size
+        gc.collect()
+
+    def get(self, model):
+        if not model_exists(model):
+            raise FileNotFoundError(f"{model} {cfg.transobj['lang4']}")
+        with self._lock:
+            if model in self._models:
+                self._models.move_to_end(model)
+                return self._models[model][0]
+            load_lock = self._loading.setdefault(model, threading.Lock())
+        with load_lock:
+            with self._lock:
+                if model in self._models:
+                    self._models.move_to_end(model)
+                    return self._models[model][0]
+            started = time.perf_counter()
+            separator = self._load(model)
+            with self._lock:
+                self.load_seconds[model] = time.perf_counter() - started
+                self._models[model] = (separator, estimate_size(model))
+                self._evict(keep=model)
+        return separator
+
+    @contextmanager
+    def use(self, model):
+        """Borrow the warm Separator for model, holding its run lock for the duration."""
+        separator = self.get(model)
+        with self._lock:
+            run_lock = self._running.setdefault(model, threading.Lock())
+        with run_lock:
+            yield separator
+
+    def preload(self, models=None):
+        for model in models or MODELS:
+            if not model_exists(model):
+                continue
+            try:
+                self.get(model)
+            except Exception as e:
+                logger.error(f'Preloading {model} failed: {e}')
+
+    def loaded(self):
+        with self._lock:
+            return list(self._models)
+
+
+registry = ModelRegistry(cfg.MODEL_CACHE_MB)
@@ -0,0 +1,187 @@
+"""
+Shares one job queue (and its warm models) between several HTTP worker processes.
+
+The process owning jobs.job_queue runs a ModelServer; HTTP workers replace their
+jobs.job_queue and cache.result_cache with RemoteJobQueue / RemoteResultCache, which
+forward every call over a local socket (multiprocessing.connection, a Unix socket on
+POSIX, loopback TCP on Windows, authenticated with a per-run key). Jobs travel as
+pickled Job snapshots, so routes read them exactly like local ones.
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+from vocal import metrics
+
+# What HTTP workers may call, per target
+ALLOWED = {
+    'jobs': {'submit', 'run', 'completed', 'get', 'cancel', 'wait', 'pending'},
+    'cache': {'lookup_wav', 'add_wav', 'lookup_stems', 'add_stems', 'stats'},
+    'metrics': {'render'},
+    'janitor': {'stats', 'sweep'},
+}
+
+
+def default_address():
+    if sys.platform == 'win32':
+        return ('127.0.0.1', 0)
+    return os.path.join(tempfile.gettempdir(), f'vocal-{os.getpid()}.sock')
+
+
+class ModelServer:
+    """Serves calls on the local job queue and result cache, one thread per connection."""
+
+    def __init__(self, job_queue, result_cache, address=None, authkey=None):
+        from vocal import janitor
+        self.targets = {'jobs': job_queue, 'cache': result_cache, 'metrics': metrics, 'janitor': janitor.janitor}
+        self.authkey = authkey or os.urandom(32)
+        self._listener = Listener(address or default_address(), authkey=self.authkey)
+        # the bound address, with the actual port for ('127.0.0.1', 0)
+        self.address = self._listener.address
+
+    def start(self):
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                return
+            except Exception:
+                # failed authentication, keep serving the others
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    target, method, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                if method not in ALLOWED.get(target, ()):
+                    reply = ('error', AttributeError(f'{target}.{method}'))
+                else:
+                    try:
+                        reply = ('ok', getattr(self.targets[target], method)(*args, **kwargs))
+                    except Exception as e:
+                        reply = ('error', e)
+                try:
+                    conn.send(reply)
+                except (EOFError, OSError):
+                    return
+
+    def close(self):
+        self._listener.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class ModelClient:
+    """One connection per thread to a ModelServer, reopened once if it broke."""
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = Client(self.address, authkey=self.authkey)
+        return conn
+
+    def _call(self, target, method, args, kwargs):
+        for attempt in range(2):
+            try:
+                conn = self._conn()
+                conn.send((target, method, args, kwargs))
+                return conn.recv()
+            except (EOFError, OSError) as e:
+                self._local.conn = None
+                if attempt:
+                    return 'error', e
+
+    def call(self, target, method, *args, **kwargs):
+        # blocking socket I/O, keep it off the gevent hub; errors are raised here rather
+        # than inside the threadpool, which would log every JobNotFound
+        from vocal import tool
+        status, value = tool.offload(lambda: self._call(target, method, args, kwargs))
+        if status == 'error':
+            raise value
+        return value
+
+
+class RemoteJobQueue:
+    """jobs.JobQueue interface backed by the queue of a ModelServer."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def start(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def submit(self, spec, on_done=None, key=None):
+        # on_done runs in the server process, so it must be picklable (eg. a functools.partial)
+        return self.client.call('jobs', 'submit', spec, on_done, key)
+
+    def run(self, spec):
+        return self.client.call('jobs', 'run', spec)
+
+    def completed(self, spec, result):
+        return self.client.call('jobs', 'completed', spec, result)
+
+    def get(self, job_id):
+        return self.client.call('jobs', 'get', job_id)
+
+    def cancel(self, job_id):
+        return self.client.call('jobs', 'cancel', job_id)
+
+    def wait(self, job_id, timeout=None):
+        # polled from here, a wait in the server would hold a threadpool thread of this process throughout
+        from vocal import cfg, jobs, jobstore, tool
+        interval = jobstore.POLL if cfg.JOB_BACKEND == 'sqlite' else jobs.WAIT_POLL
+        deadline = None if timeout is None else time.monotonic() + timeout
+        job = self.get(job_id)
+        while job.status not in jobs.FINISHED and (deadline is None or time.monotonic() < deadline):
+            tool.sleep(interval)
+            job = self.get(job_id)
+        return job
+
+    def pending(self):
+        return self.client.call('jobs', 'pending')
+
+    def render_metrics(self, names):
+        return self.client.call('metrics', 'render', names=names)
+
+    def janitor(self, method):
+        return self.client.call('janitor', method)
+
+
+class RemoteResultCache:
+    """cache.ResultCache interface backed by the cache of a ModelServer."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def lookup_wav(self, digest):
+        return self.client.call('cache', 'lookup_wav', digest)
+
+    def add_wav(self, digest, wav, *extra):
+        return self.client.call('cache', 'add_wav', digest, wav, *extra)
+
+    def lookup_stems(self, digest, model):
+        return self.client.call('cache', 'lookup_stems', digest, model)
+
+    def add_stems(self, digest, model, dirname):
+        return self.client.call('cache', 'add_stems', digest, model, dirname)
+
+    def stats(self):
+        return self.client.call('cache', 'stats')
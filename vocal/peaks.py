@@ -0,0 +1,181 @@
+"""
+Waveform peaks and preview clips of separated stems, so a result can be drawn and
+listened to without downloading its full resolution stems.
+
+Every stem is read once, in blocks: the finest level holds the min, max and RMS of each
+PEAK_SAMPLES frames (both channels), every coarser level merges FACTOR buckets of the
+one below. A stem's levels are stored one after the other in preview/<stem>.peaks as
+int8 (min, max, rms) triples scaled to 127, and preview/peaks.json indexes them. The
+cfg.PREVIEW_SECONDS window where the stems are loudest together is encoded once per stem
+as a low bitrate mono MP3, preview/<stem>.mp3; it is the same window for every stem, so
+previews can be played together.
+"""
+import json
+import logging
+import os
+import time
+import uuid
+
+import numpy as np
+
+from vocal import cfg, media, transcode
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_DIR = 'preview'
+INDEX = 'peaks.json'
+PEAK_SAMPLES = 256
+FACTOR = 4
+# coarser levels are added while they still have this many peaks
+MIN_PEAKS = 512
+BLOCK = PEAK_SAMPLES * 256
+
+
+def summarize(data, scale=1.0):
+    """
+    Peak levels of a (frames, channels) array: [(samples per peak, (n, 3) int8)], finest
+    first, and the mean square of every finest bucket.
+    """
+    frames = len(data)
+    count = -(-frames // PEAK_SAMPLES)
+    lo = np.zeros(count, dtype=np.float32)
+    hi = np.zeros(count, dtype=np.float32)
+    sq = np.zeros(count, dtype=np.float32)
+    for start in range(0, frames, BLOCK):
+        block = np.asarray(data[start:start + BLOCK], dtype=np.float32).reshape(min(BLOCK, frames - start), -1)
+        pad = -len(block) % PEAK_SAMPLES
+        if pad:
+            block = np.concatenate([block, np.zeros((pad, block.shape[1]), dtype=np.float32)])
+        buckets = block.reshape(-1, PEAK_SAMPLES * block.shape[1])
+        i = start // PEAK_SAMPLES
+        lo[i:i + len(buckets)] = buckets.min(axis=1)
+        hi[i:i + len(buckets)] = buckets.max(axis=1)
+        sq[i:i + len(buckets)] = np.einsum('ij,ij->i', buckets, buckets) / buckets.shape[1]
+    lo *= scale
+    hi *= scale
+    sq *= scale * scale
+    energy = sq
+    levels = [(PEAK_SAMPLES, _quantize(lo, hi, sq))]
+    while len(lo) >= MIN_PEAKS * FACTOR:
+        pad = -len(lo) % FACTOR
+        lo = np.pad(lo, (0, pad), mode='edge').reshape(-1, FACTOR).min(axis=1)
+        hi = np.pad(hi, (0, pad), mode='edge').reshape(-1, FACTOR).max(axis=1)
+        sq = np.pad(sq, (0, pad), mode='edge').reshape(-1, FACTOR).mean(axis=1)
+        levels.append((levels[-1][0] * FACTOR, _quantize(lo, hi, sq)))
+    return levels, energy
+
+
+def _quantize(lo, hi, sq):
+    peaks = np.stack([lo, hi, np.sqrt(sq)], axis=1)
+    return np.round(np.clip(peaks, -1.0, 1.0) * 127).astype(np.int8)
+
+
+def preview_window(energies, sample_rate, seconds):
+    """(start, duration) in seconds of the loudest window over all stems' bucket energies."""
+    length = min(len(it) for it in energies)
+    total = np.sum([it[:length] for it in energies], axis=0, dtype=np.float64)
+    width = int(np.ceil(seconds * sample_rate / PEAK_SAMPLES))
+    if length <= width:
+        return 0.0, length * PEAK_SAMPLES / sample_rate
+    sums = np.cumsum(np.concatenate([[0.0], total]))
+    start = int(np.argmax(sums[width:] - sums[:-width]))
+    return start * PEAK_SAMPLES / sample_rate, float(seconds)
+
+
+def _stem_file(dirname, stem):
+    # the stored stem in whatever codec it was written
+    return next((it for it in (os.path.join(dirname, f'{stem}.{codec}') for codec in transcode.CODECS)
+                 if os.path.exists(it)), None)
+
+
+def _encode_preview(source, target, start, duration):
+    encoder, _ = transcode.CODECS['mp3']
+    part = f'{target}.{uuid.uuid4().hex[:8]}.part'
+    try:
+        transcode.run(['-ss', f'{start:.3f}', '-t', f'{duration:.3f}', '-i', source, '-vn', '-ac', '1', *encoder,
+                       '-b:a', cfg.PREVIEW_BITRATE, '-f', 'mp3', part])
+        os.replace(part, target)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+
+
+def build(dirname, sources, sample_rate=44100):
+    """
+    Write the peaks of sources ({stem: (frames, channels) array or memmap, scale}) and,
+    when cfg.PREVIEW_SECONDS > 0, their preview clips to dirname/preview. Returns the index.
+    """
+    out_dir = os.path.join(dirname, PREVIEW_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+    started = time.perf_counter()
+    index = {'sample_rate': sample_rate, 'stems': {}}
+    energies = []
+    for stem, (data, scale) in sorted(sources.items()):
+        levels, energy = summarize(data, scale)
+        energies.append(energy)
+        entry = index['stems'][stem] = {'frames': len(data), 'levels': []}
+        offset = 0
+        with open(os.path.join(out_dir, f'{stem}.peaks'), 'wb') as f:
+            for samples_per_peak, peaks in levels:
+                f.write(peaks.tobytes())
+                entry['levels'].append({'samples_per_peak': samples_per_peak, 'offset': offset, 'count': len(peaks)})
+                offset += peaks.nbytes
+    if energies and cfg.PREVIEW_SECONDS > 0:
+        start, duration = preview_window(energies, sample_rate, cfg.PREVIEW_SECONDS)
+        index['preview'] = {'start': round(start, 3), 'duration': round(duration, 3)}
+        for stem in index['stems']:
+            source = _stem_file(dirname, stem)
+            if source is None:
+                continue
+            try:
+                _encode_preview(source, os.path.join(out_dir, f'{stem}.mp3'), start, duration)
+            except (transcode.TranscodeError, OSError) as e:
+                # the peaks are still worth having, the page plays the full stem
+                logger.warning(f'No preview of {source}: {e}')
+                continue
+            index['stems'][stem]['preview'] = f'{stem}.mp3'
+    index['seconds'] = round(time.perf_counter() - started, 3)
+    # written last, an index means everything it lists is there
+    tmp = os.path.join(out_dir, f'{INDEX}.{uuid.uuid4().hex[:8]}.part')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(tmp, os.path.join(out_dir, INDEX))
+    return index
+
+
+def build_dir(dirname):
+    """build() from the WAV stems in dirname, None when there are none."""
+    sources, sample_rate = {}, 44100
+    for name in sorted(os.listdir(dirname)):
+        stem, ext = os.path.splitext(name)
+        if ext != '.wav':
+            continue
+        data, scale, info = media.open_wav(os.path.join(dirname, name))
+        sources[stem] = (data, scale)
+        sample_rate = info.sample_rate
+    if not sources:
+        return None
+    return build(dirname, sources, sample_rate)
+
+
+def load(dirname):
+    """The index written by build(), None when dirname has none."""
+    path = os.path.join(dirname, PREVIEW_DIR, INDEX)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def read_level(dirname, stem, index, width=None):
+    """
+    (level, int8 bytes) of the coarsest level of stem with at least width peaks, the
+    finest one when none has as many or width is not given.
+    """
+    levels = index['stems'][stem]['levels']
+    level = levels[0]
+    if width:
+        level = next((it for it in reversed(levels) if it['count'] >= width), level)
+    with open(os.path.join(dirname, PREVIEW_DIR, f'{stem}.peaks'), 'rb') as f:
+        f.seek(level['offset'])
+        return level, f.read(level['count'] * 3)
@@ -0,0 +1,98 @@
+"""
+Mix separated stems back into one file with a gain per stem, eg. everything but the
+vocals, or drums + bass.
+
+Stem WAVs are memory mapped from their sample data (media.open_wav) and summed in
+blocks of BLOCK frames, so a remix never holds more than one block of audio however
+long the track is. The mix is a 16-bit PCM WAV whose size is known up
+front, streamed while it is written to the cache file in the stems folder's own
+subfolder, <stems dir>/remix/remix-<key>.<codec>, key being a hash of the gains and
+format; it never shows up among the stems. WAVs of stems stored in another codec are
+kept there too, as remix/<stem>.wav.
+"""
+import hashlib
+import json
+import os
+import struct
+import uuid
+
+import numpy as np
+
+from vocal import media, metrics, transcode
+
+BLOCK = 1 << 16
+REMIX_DIR = 'remix'
+
+remix_total = metrics.Counter('vocal_remix_total', 'Remix requests, served from the cache or mixed', ['cache'])
+
+
+def cache_name(gains, codec, bitrate=None):
+    """File name of the remix with these gains in the stems directory's REMIX_DIR."""
+    key = json.dumps({'gains': {k: round(float(v), 4) for k, v in sorted(gains.items()) if v},
+                      'codec': codec, 'bitrate': (bitrate or transcode.DEFAULT_BITRATE) if transcode.CODECS[codec][1] else None}, sort_keys=True)
+    return f'remix-{hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]}.{codec}'
+
+
+def wav_header(frames, channels, sample_rate):
+    data_size = frames * channels * 2
+    return (b'RIFF' + struct.pack('<I', 36 + data_size) + b'WAVE'
+            + b'fmt ' + struct.pack('<IHHIIHH', 16, media.WAVE_FORMAT_PCM, channels, sample_rate,
+                                    sample_rate * channels * 2, channels * 2, 16)
+            + b'data' + struct.pack('<I', data_size))
+
+
+class Remix:
+    """The mix of {stem wav path: gain}, as PCM16 WAV bytes."""
+
+    def __init__(self, gains):
+        if not gains:
+            raise ValueError('no stems to mix')
+        opened = [(media.open_wav(path), gain) for path, gain in gains.items()]
+        # stems of one separation have the same length, rate and layout
+        _, _, info = opened[0][0]
+        self.sample_rate = info.sample_rate
+        self.channels = max(2, max(it.channels for (_, _, it), _ in opened))
+        self.frames = min(len(data) for (data, _, _), _ in opened)
+        self.sources = [(data, np.float32(scale * gain)) for (data, scale, _), gain in opened if gain]
+
+    @property
+    def size(self):
+        return 44 + self.frames * self.channels * 2
+
+    def blocks(self, block=BLOCK):
+        """PCM16 bytes of the mix, block frames at a time."""
+        acc = np.empty((block, self.channels), dtype=np.float32)
+        tmp = np.empty((block, self.channels), dtype=np.float32)
+        for start in range(0, self.frames, block):
+            n = min(block, self.frames - start)
+            out = acc[:n]
+            out.fill(0)
+            for data, factor in self.sources:
+                # a mono stem is broadcast to both channels
+                np.multiply(data[start:start + n], factor, out=tmp[:n], casting='unsafe')
+                out += tmp[:n]
+            np.clip(out, -1.0, 1.0, out=out)
+            out *= 32767
+            yield out.astype('<i2').tobytes()
+
+    def stream(self):
+        yield wav_header(self.frames, self.channels, self.sample_rate)
+        yield from self.blocks()
+
+    def stream_to(self, target):
+        """stream(), writing the bytes to target too; it only appears once complete."""
+        part = f'{target}.{uuid.uuid4().hex[:8]}.part'
+        try:
+            with open(part, 'wb') as f:
+                for data in self.stream():
+                    f.write(data)
+                    yield data
+            os.replace(part, target)
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+
+    def write(self, target):
+        for _ in self.stream_to(target):
+            pass
+        return target
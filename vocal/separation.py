@@ -0,0 +1,146 @@
+import logging
+import os
+import time
+
+from vocal import cfg, media, models, transcode
+
+logger = logging.getLogger(__name__)
+
+
+def list_stems(dirname, codec=None):
+    # stem files in dirname, only those in codec when given
+    exts = [f'.{codec}'] if codec else [f'.{it}' for it in transcode.CODECS]
+    return sorted(it for it in os.listdir(dirname) if os.path.splitext(it)[1] in exts)
+
+
+def separate_waveform(waveform, model='2stems', sample_rate=44100, timings=None):
+    """
+    Separate an in-memory waveform, returning {instrument: float32 (samples, 2) array}.
+
+    waveform is a float or int16 array of shape (samples,), (samples, 1) or (samples, 2)
+    at 44.1kHz, the rate the models were trained at. Nothing is written to disk, the
+    whole waveform and its stems are held in memory. When a timings dict is given the
+    duration and inference seconds are stored in it.
+    """
+    from vocal import waveform as wf
+    if sample_rate != wf.SAMPLE_RATE:
+        raise ValueError(f'sample rate must be {wf.SAMPLE_RATE}, got {sample_rate}')
+    if not models.model_exists(model):
+        raise FileNotFoundError(f"{model} {cfg.transobj['lang4']}")
+    samples = wf.as_stereo(waveform)
+    with models.registry.use(model) as separator:
+        started = time.perf_counter()
+        stems = separator.separate(samples)
+    if timings is not None:
+        timings.update(duration=len(samples) / sample_rate, decode=0.0, write=0.0,
+                       inference=time.perf_counter() - started)
+    return {instrument: wf.as_stereo(data[:len(samples)]) for instrument, data in stems.items()}
+
+
+def run(spec, progress=None):
+    """
+    Separate one file into stems.
+
+    spec is a plain dict so it can be shipped to a worker process:
+        wav_file: input audio path
+        model:    2stems / 4stems / 5stems
+        dirname:  output directory for the stems
+        segment:  optional window length in seconds, 0 separates the whole file in one
+                  pass; by default files longer than cfg.SEGMENT_MIN_DURATION are segmented
+        codec:    optional stem format, one of transcode.CODECS, default wav
+        bitrate:  optional bitrate for lossy codecs, eg. 192k
+    progress(stage, fraction) is called as the job moves through its stages.
+    Returns {'dirname': ..., 'files': [stem file names], 'timings': {stage: seconds}};
+    timings has duration (of the audio), decode, inference, write, previews (see
+    vocal.peaks, with cfg.PREVIEWS) and, when this run had to load the model, model_load.
+    """
+    report = progress or (lambda stage, fraction: None)
+    wav_file = spec['wav_file']
+    model = spec['model']
+    dirname = spec['dirname']
+    codec = spec.get('codec') or 'wav'
+    bitrate = spec.get('bitrate') or transcode.DEFAULT_BITRATE
+
+    if not os.path.exists(wav_file):
+        raise FileNotFoundError(f"{wav_file} {cfg.transobj['lang5']}")
+    if not models.model_exists(model):
+        raise FileNotFoundError(f"{model} {cfg.transobj['lang4']}")
+
+    report('probing', 0.0)
+    info = media.probe(wav_file)
+    if info is None:
+        raise ValueError(f'{wav_file}: unreadable audio')
+    sec = info.duration
+    os.makedirs(dirname, exist_ok=True)
+
+    segment = spec.get('segment')
+    if segment is None:
+        segment = cfg.SEGMENT_SECONDS if sec > cfg.SEGMENT_MIN_DURATION else 0
+
+    report('loading', 0.05)
+    # numpy is only needed by the worker, keep it out of the web process' imports
+    from vocal import chunked
+    timings = {'duration': sec, 'decode': 0.0, 'inference': 0.0, 'write': 0.0}
+    cold = model not in models.registry.loaded()
+    with models.registry.use(model) as separator:
+        if cold and model in models.registry.load_seconds:
+            timings['model_load'] = models.registry.load_seconds[model]
+        report('separating', 0.1)
+        if segment > 0:
+            chunked.separate_chunked(
+                separator,
+                wav_file,
+                dirname,
+                sample_rate=models.input_format(model)[0],
+                segment=segment,
+                overlap=cfg.SEGMENT_OVERLAP,
+                duration=sec,
+                progress=lambda fraction: report('separating', 0.1 + 0.9 * fraction),
+                timings=timings,
+                batch=cfg.INFERENCE_BATCH
+            )
+        else:
+            # what separate_to_file does, step by step so each stage can be timed
+            from spleeter.audio.adapter import AudioAdapter
+            adapter = AudioAdapter.default()
+            t = time.perf_counter()
+            # uploads are converted to the model's input format, read those without ffmpeg
+            sample_rate, channels = models.input_format(model)
+            waveform = chunked.load_wav(wav_file, sample_rate, channels)
+            if waveform is None:
+                waveform, _ = adapter.load(wav_file, duration=sec, sample_rate=sample_rate)
+            timings['decode'] = time.perf_counter() - t
+            t = time.perf_counter()
+            stems = separator.separate(waveform)
+            timings['inference'] = time.perf_counter() - t
+            report('writing', 0.9)
+            t = time.perf_counter()
+            for instrument, data in stems.items():
+                adapter.save(os.path.join(dirname, f'{instrument}.{codec}'), data, chunked.SAMPLE_RATE, codec, bitrate)
+            timings['write'] = time.perf_counter() - t
+    if cfg.PREVIEWS:
+        # drawn and played by the page before it fetches any stem
+        report('previews', 0.93)
+        t = time.perf_counter()
+        try:
+            from vocal import peaks
+            if segment > 0:
+                peaks.build_dir(dirname)
+            else:
+                peaks.build(dirname, {instrument: (data, 1.0) for instrument, data in stems.items()},
+                            chunked.SAMPLE_RATE)
+        except Exception as e:
+            logger.warning(f'No peaks/previews for {dirname}: {e}')
+        timings['previews'] = time.perf_counter() - t
+    if segment > 0 and codec != 'wav':
+        # segmented separation appends to WAVs, compress them once complete
+        report('encoding', 0.95)
+        t = time.perf_counter()
+        for it in list_stems(dirname, 'wav'):
+            source = os.path.join(dirname, it)
+            transcode.encode(source, f'{source[:-4]}.{codec}', codec, bitrate)
+            os.remove(source)
+        timings['write'] += time.perf_counter() - t
+    report('done', 1.0)
+    return {'dirname': dirname, 'files': list_stems(dirname, codec), 'timings': timings,
+            'bitrate': bitrate if transcode.CODECS[codec][1] else None}
@@ -0,0 +1,226 @@
+import base64
+import hashlib
+import os
+import re
+import struct
+
+from gevent.pywsgi import WSGIHandler
+from gevent.socket import wait_write
+from werkzeug.wsgi import FileWrapper
+
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def websocket_accept(key):
+    """Sec-WebSocket-Accept value for a client's Sec-WebSocket-Key."""
+    return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+
+
+def websocket_response_headers(environ):
+    """Headers of the 101 answer to a websocket handshake, None if environ is not one."""
+    key = environ.get('HTTP_SEC_WEBSOCKET_KEY')
+    if environ.get('HTTP_UPGRADE', '').lower() != 'websocket' or not key:
+        return None
+    return {'Upgrade': 'websocket', 'Connection': 'Upgrade', 'Sec-WebSocket-Accept': websocket_accept(key)}
+
+
+class WebSocketClosed(Exception):
+    pass
+
+
+class WebSocket:
+    """
+    Server side of an RFC 6455 connection: text and binary messages, fragmentation,
+    ping/pong and close. No extensions or subprotocols.
+    """
+    TEXT, BINARY, CLOSE, PING, PONG = 0x1, 0x2, 0x8, 0x9, 0xA
+
+    def __init__(self, sock, rfile, max_size=64 * 1024 * 1024):
+        self.sock = sock
+        self.rfile = rfile
+        self.max_size = max_size
+        self.closed = False
+
+    def _read(self, n):
+        data = self.rfile.read(n)
+        if len(data) < n:
+            raise WebSocketClosed('connection lost')
+        return data
+
+    def _frame(self):
+        b1, b2 = self._read(2)
+        length = b2 & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self._read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read(8))[0]
+        if length > self.max_size:
+            self.close(1009)
+            raise WebSocketClosed('message too big')
+        mask = self._read(4) if b2 & 0x80 else None
+        data = self._read(length)
+        if mask and length:
+            # xor as one big integer, a Python loop over the bytes is far too slow for audio
+            key = (mask * (length // 4 + 1))[:length]
+            data = (int.from_bytes(data, 'big') ^ int.from_bytes(key, 'big')).to_bytes(length, 'big')
+        return bool(b1 & 0x80), b1 & 0x0F, data
+
+    def receive(self):
+        """Next message as str (text) or bytes (binary), None once the client closed."""
+        if self.closed:
+            return None
+        opcode, parts, size = None, [], 0
+        while True:
+            fin, op, data = self._frame()
+            if op == self.CLOSE:
+                self.close()
+                return None
+            if op == self.PING:
+                self._send(self.PONG, data)
+                continue
+            if op == self.PONG:
+                continue
+            if op:
+                opcode = op
+            size += len(data)
+            if size > self.max_size:
+                self.close(1009)
+                raise WebSocketClosed('message too big')
+            parts.append(data)
+            if fin:
+                break
+        data = b''.join(parts)
+        return data.decode('utf-8') if opcode == self.TEXT else data
+
+    @staticmethod
+    def frame(data, opcode=None):
+        if opcode is None:
+            opcode = WebSocket.TEXT if isinstance(data, str) else WebSocket.BINARY
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        length = len(data)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        return header + data
+
+    def _send(self, opcode, data):
+        self.sock.sendall(self.frame(data, opcode))
+
+    def send(self, data):
+        if self.closed:
+            raise WebSocketClosed('closed')
+        self.sock.sendall(self.frame(data))
+
+    def close(self, code=1000):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._send(self.CLOSE, struct.pack('!H', code))
+        except OSError:
+            pass
+
+
+class SendfileWrapper(FileWrapper):
+    """wsgi.file_wrapper marking a response body SendfileHandler may send with sendfile()."""
+
+
+def content_range(headers):
+    """(first byte, byte count) of a response's Content-Range header, None without one."""
+    for name, value in headers:
+        if isinstance(name, bytes):
+            name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name.lower() == 'content-range':
+            match = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+|\*)', value.strip())
+            if match is None:
+                return None
+            first, last = int(match.group(1)), int(match.group(2))
+            return (first, last - first + 1) if last >= first else None
+    return None
+
+
+def _sendfile_target(result, wrapper, code, headers):
+    # (wrapper, offset, count) when result is the whole file of wrapper, or (a 206) a byte
+    # range of it; the range comes from the Content-Range header, the body of a 206 being
+    # werkzeug's range iterator around the wrapper
+    if wrapper is None:
+        return None
+    if result is wrapper:
+        return wrapper, 0, None
+    if code == 206:
+        byte_range = content_range(headers)
+        if byte_range is not None:
+            return (wrapper,) + byte_range
+    return None
+
+
+class SendfileHandler(WSGIHandler):
+    """
+    gevent handler that sends file responses with os.sendfile.
+
+    Flask's send_file wraps files with the server's wsgi.file_wrapper; for those (and
+    for byte ranges of them, read from Content-Range) the headers are written as usual
+    and the body goes from the page cache to the socket without being copied through
+    Python.
+    The socket is non-blocking, so a full send buffer yields to other greenlets.
+
+    It also completes websocket handshakes: a view answers 101 with
+    websocket_response_headers() and stores a callable under environ['vocal.websocket'];
+    once the 101 is sent that callable is run with the WebSocket in this greenlet.
+    """
+
+    def get_environ(self):
+        env = super().get_environ()
+        self._file_wrapper = None
+        if hasattr(os, 'sendfile'):
+            env['wsgi.file_wrapper'] = self._wrap_file
+        return env
+
+    def _wrap_file(self, file, buffer_size=8192):
+        # the wrapper of this request's file, werkzeug may hand back another iterable around it
+        self._file_wrapper = SendfileWrapper(file, buffer_size)
+        return self._file_wrapper
+
+    def process_result(self):
+        session = self.environ.get('vocal.websocket')
+        if session is not None and self.code == 101:
+            super().process_result()
+            self.close_connection = True
+            ws = WebSocket(self.socket, self.rfile)
+            try:
+                session(ws)
+            except WebSocketClosed:
+                pass
+            finally:
+                ws.close()
+            return
+        target = _sendfile_target(self.result, getattr(self, '_file_wrapper', None), self.code, self.response_headers)
+        if target is None or self.provided_content_length is None or self.code in (304, 204):
+            return super().process_result()
+        wrapper, offset, count = target
+        try:
+            in_fd = wrapper.file.fileno()
+            if count is None:
+                count = os.fstat(in_fd).st_size - offset
+        except (AttributeError, OSError, ValueError):
+            return super().process_result()
+
+        # flush the status line and headers, then the body straight from the file
+        self.write(b'')
+        out_fd = self.socket.fileno()
+        while count > 0:
+            try:
+                sent = os.sendfile(out_fd, in_fd, offset, count)
+            except BlockingIOError:
+                wait_write(out_fd)
+                continue
+            if sent == 0:
+                break
+            offset += sent
+            count -= sent
+            self.response_length += sent
@@ -0,0 +1,69 @@
+"""
+Single-flight: concurrent calls for the same key run once, the others wait for that
+run and share its result or its exception. Nothing is kept once the call returns,
+caching finished results is the result cache's job.
+"""
+import threading
+
+from vocal import metrics, tool
+
+shared_total = metrics.Counter('vocal_singleflight_shared_total',
+                               'Calls answered by an identical call already in flight', ['kind'])
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, kind):
+        self.kind = kind
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args):
+        """
+        fn(*args) unless a call for key is already running, in which case wait for it.
+        Returns (result, shared), shared is True for the callers that waited.
+        A waiting request greenlet polls with gevent.sleep (tool.wait): it neither blocks the
+        hub nor takes a threadpool thread, which the leader's work may be waiting for.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+        if not leader:
+            shared_total.inc(kind=self.kind)
+            tool.wait(call.done)
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def running(self):
+        with self._lock:
+            return list(self._calls)
+
+
+# ffmpeg conversions of uploads to WAV, keyed by content digest
+conversions = SingleFlight('conversion')
+# stems transcoded for /download, keyed by target path
+transcodes = SingleFlight('transcode')
+# peaks and previews built on request for results that have none, keyed by stems folder
+previews = SingleFlight('previews')
@@ -0,0 +1,94 @@
+"""
+Low-latency separation of a live stream with a sliding window.
+
+Each step separates `context` seconds already emitted, `hop` new seconds and `lookahead`
+seconds after them, and emits only the hop. The model sees audio on both sides of what it
+emits, and the first `fade` samples of every hop are crossfaded with what the previous
+step predicted for them (its look-ahead), so hops join without clicks. A sample comes
+out hop + lookahead seconds after it went in, plus the time one step takes to separate.
+"""
+import numpy as np
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+
+
+def _fit(samples, length):
+    if len(samples) >= length:
+        return samples[:length]
+    return np.pad(samples, ((0, length - len(samples)), (0, 0)))
+
+
+class StreamSeparator:
+    """
+    Feed interleaved stereo float32 blocks of any size to push(), get separated blocks
+    back as they become ready; flush() separates what is left once the input ended.
+    separate(window) -> {instrument: (samples, 2) array} does the inference, eg. a warm
+    spleeter Separator's separate.
+    """
+
+    def __init__(self, separate, hop=0.5, lookahead=0.5, context=2.0, fade=0.05, sample_rate=SAMPLE_RATE):
+        self.separate = separate
+        self.sample_rate = sample_rate
+        self.hop = max(1, int(hop * sample_rate))
+        self.lookahead = int(lookahead * sample_rate)
+        self.context = int(context * sample_rate)
+        self.fade = min(int(fade * sample_rate), self.lookahead, self.hop)
+        self.window = self.context + self.hop + self.lookahead
+        self.ramp = np.linspace(0.0, 1.0, self.fade, dtype=np.float32)[:, None]
+        # the first window's context is silence
+        self.buffer = np.zeros((self.context, CHANNELS), dtype=np.float32)
+        self.tails = {}
+        self.received = 0
+        self.emitted = 0
+
+    @property
+    def latency(self):
+        """Seconds between a sample arriving and its stems being emitted, without inference."""
+        return (self.hop + self.lookahead) / self.sample_rate
+
+    def push(self, samples):
+        """Append samples, returns the list of {instrument: block} ready now."""
+        self.received += len(samples)
+        self.buffer = np.concatenate([self.buffer, samples.astype(np.float32, copy=False)])
+        blocks = []
+        while len(self.buffer) >= self.window:
+            blocks.append(self._step())
+        return blocks
+
+    def flush(self):
+        """Separate the rest of the input, zero padded, returns the remaining blocks."""
+        blocks = []
+        while self.emitted < self.received:
+            missing = self.window - len(self.buffer)
+            if missing > 0:
+                self.buffer = np.concatenate([self.buffer, np.zeros((missing, CHANNELS), dtype=np.float32)])
+            left = self.received - self.emitted
+            block = self._step()
+            if left < self.hop:
+                block = {instrument: samples[:left] for instrument, samples in block.items()}
+            blocks.append(block)
+        return blocks
+
+    def _step(self):
+        window = self.buffer[:self.window]
+        stems = self.separate(window)
+        start, end = self.context, self.context + self.hop
+        block = {}
+        for instrument, samples in stems.items():
+            samples = _fit(np.asarray(samples, dtype=np.float32), self.window)
+            out = samples[start:end].copy()
+            tail = self.tails.get(instrument)
+            if tail is not None and self.fade:
+                out[:self.fade] = tail * (1.0 - self.ramp) + out[:self.fade] * self.ramp
+            # this step's prediction for the start of the next hop
+            self.tails[instrument] = samples[end:end + self.fade].copy()
+            block[instrument] = out
+        self.buffer = self.buffer[self.hop:]
+        self.emitted += self.hop
+        return block
+
+
+def interleave(block, stems):
+    """One (samples, 2 * len(stems)) array with the stereo pairs of stems side by side."""
+    return np.concatenate([block[instrument] for instrument in stems], axis=1)
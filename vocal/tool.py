@@ -1,44 +1,92 @@
-import subprocess
-import sys
+import json
+import logging
+import random
+import time
 import webbrowser
-import requests
-import tensorflow
 import vocal
 from vocal import cfg
 
-def runffmpeg(arg):
-    cmd = ["ffmpeg","-hide_banner","-vsync","0","-y"]
-    if cfg.cuda>0:
-        cmd.extend(["-hwaccel", "cuda","-hwaccel_output_format","cuda"])
-    cmd = cmd + arg
-    p = subprocess.Popen(cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            creationflags=0 if sys.platform != 'win32' else subprocess.CREATE_NO_WINDOW)
-    while True:
-        try:
-            #等待0.1未结束则异常
-            outs, errs = p.communicate(timeout=0.5)
-            errs=str(errs)
-            if errs:
-                errs = errs.replace('\\\\','\\').replace('\r',' ').replace('\n',' ')
-                errs=errs[errs.find("Error"):]
-            # 成功
-            if p.returncode==0:
-                return "ok"
-            # 失败
-            if cfg.cuda:
-                errs+="[error] Please try upgrading the graphics card driver and reconfigure CUDA"
-            return errs
-        except subprocess.TimeoutExpired as e:
-            # 如果前台要求停止
-            pass
-        except Exception as e:
-            #出错异常
-            errs=f"[error]ffmpeg:error {cmd=},\n{str(e)}"
-            return errs
+def runffmpeg(arg, timeout=None, video=False, on_progress=None, key=None):
+    # Returns "ok" or the ffmpeg error, see vocal.transcode for the deadline/cancel/progress handling
+    from vocal import transcode
+    try:
+        transcode.run(arg, timeout=timeout, video=video, on_progress=on_progress, key=key)
+        return "ok"
+    except transcode.TranscodeError as e:
+        return str(e)
+    except Exception as e:
+        return f"[error]ffmpeg:error {arg=},\n{str(e)}"
+
+
+def _gevent():
+    # gevent when called from a request greenlet, None from plain threads and processes
+    try:
+        import gevent
+    except ImportError:
+        return None
+    return gevent if isinstance(gevent.getcurrent(), gevent.Greenlet) else None
+
+
+def offload(fn, *args):
+    # Inside a gevent request greenlet, run blocking calls on the hub's threadpool so the server keeps serving
+    gevent = _gevent()
+    if gevent is not None:
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+
+def sleep(seconds):
+    # time.sleep that lets the other greenlets run when called from one (nothing is monkey-patched)
+    gevent = _gevent()
+    if gevent is not None:
+        gevent.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+
+def wait(event, timeout=None, interval=0.05):
+    # event.wait() for a threading.Event. A request greenlet polls it instead: waiting through offload would
+    # hold one of the hub's few threadpool threads, which the work being waited for may need itself
+    if _gevent() is None:
+        return event.wait(timeout)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while not event.is_set():
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        sleep(interval)
+    return True
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line; extra={...} fields passed to the logger are included
+    _skip = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        data = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        data.update({k: v for k, v in vars(record).items() if k not in self._skip})
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SampleFilter(logging.Filter):
+    # Keeps every WARNING and above, and roughly `rate` of the records below
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1.0 or random.random() < self.rate
+
+
 def checkupdate():
     try:
+        import requests
         res=requests.get("https://raw.githubusercontent.com/jianchang512/vocal-separate/main/version.json")
         print(f"{res.status_code=}")
         if res.status_code==200:
@@ -0,0 +1,222 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+
+from vocal import cfg, media, metrics, tool
+
+
+class TranscodeError(Exception):
+    pass
+
+
+class TranscodeTimeout(TranscodeError):
+    pass
+
+
+class TranscodeCancelled(TranscodeError):
+    pass
+
+
+# Output formats for stems: ffmpeg encoder arguments, and whether a bitrate applies
+CODECS = {
+    'wav': (['-c:a', 'pcm_s16le'], False),
+    'flac': (['-c:a', 'flac'], False),
+    'mp3': (['-c:a', 'libmp3lame'], True),
+    'ogg': (['-c:a', 'libvorbis'], True),
+    'm4a': (['-c:a', 'aac'], True),
+}
+DEFAULT_BITRATE = '192k'
+
+# Caps the number of ffmpeg processes running at once
+_slots = threading.BoundedSemaphore(max(1, cfg.FFMPEG_CONCURRENCY))
+# key -> running Transcode, for progress lookups and cancellation
+active = {}
+_active_lock = threading.Lock()
+
+
+def acquire_slot():
+    """Take an ffmpeg slot if one is free, for ffmpeg processes not started by run()."""
+    return _slots.acquire(blocking=False)
+
+
+def release_slot():
+    _slots.release()
+
+
+def _input_of(args):
+    for i, arg in enumerate(args[:-1]):
+        if arg == '-i':
+            return args[i + 1]
+    return None
+
+
+class Transcode:
+    """
+    One ffmpeg run with a deadline, cancellation and progress.
+
+    Progress comes from ffmpeg's machine readable `-progress pipe:1` output, stderr is
+    streamed line by line and only the last lines are kept for the error message.
+    run() blocks, call it through tool.offload() from a request greenlet (the module
+    level run() does that). -hwaccel cuda is only added for jobs that decode video frames.
+    """
+
+    def __init__(self, args, duration=None, timeout=None, video=False, on_progress=None):
+        cmd = ["ffmpeg", "-hide_banner", "-nostdin", "-nostats", "-progress", "pipe:1", "-y"]
+        if video and cfg.cuda:
+            cmd.extend(["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"])
+        self.cmd = cmd + list(args)
+        self.video = video
+        self.timeout = timeout if timeout is not None else cfg.FFMPEG_TIMEOUT
+        self.on_progress = on_progress
+        self.duration = duration
+        self.progress = 0.0
+        self.stderr = deque(maxlen=50)
+        self.returncode = None
+        self._proc = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    def _read_progress(self):
+        for line in self._proc.stdout:
+            key, _, value = line.decode('utf-8', errors='replace').strip().partition('=')
+            if key in ('out_time_us', 'out_time_ms') and self.duration and value.lstrip('-').isdigit():
+                # out_time_ms is in microseconds too, despite its name
+                self._set_progress(min(0.999, int(value) / 1e6 / self.duration))
+            elif key == 'progress' and value == 'end':
+                self._set_progress(1.0)
+
+    def _set_progress(self, fraction):
+        if fraction <= self.progress:
+            return
+        self.progress = fraction
+        if self.on_progress is not None:
+            self.on_progress(fraction)
+
+    def _read_stderr(self):
+        for line in self._proc.stderr:
+            self.stderr.append(line.decode('utf-8', errors='replace').rstrip())
+
+    def error(self):
+        errs = ' '.join(self.stderr)
+        errs = errs[errs.find("Error"):] if "Error" in errs else errs
+        if self.video and cfg.cuda:
+            errs += "[error] Please try upgrading the graphics card driver and reconfigure CUDA"
+        return errs
+
+    def run(self):
+        started = time.monotonic()
+        status = 'failed'
+        try:
+            self._run(started)
+            status = 'ok'
+        except TranscodeTimeout:
+            status = 'timeout'
+            raise
+        except TranscodeCancelled:
+            status = 'cancelled'
+            raise
+        finally:
+            metrics.ffmpeg_seconds.observe(time.monotonic() - started, status=status)
+
+    def _run(self, started):
+        deadline = started + self.timeout if self.timeout else None
+        if self.duration is None:
+            source = _input_of(self.cmd)
+            info = media.probe(source) if source else None
+            self.duration = info.duration if info else None
+
+        if not _slots.acquire(timeout=max(0, deadline - time.monotonic()) if deadline else None):
+            raise TranscodeTimeout(f'no ffmpeg slot within {self.timeout}s')
+        try:
+            with self._lock:
+                if self._cancelled:
+                    raise TranscodeCancelled('cancelled')
+                self._proc = subprocess.Popen(
+                    self.cmd,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    creationflags=0 if sys.platform != 'win32' else subprocess.CREATE_NO_WINDOW)
+            readers = [threading.Thread(target=self._read_progress, daemon=True),
+                       threading.Thread(target=self._read_stderr, daemon=True)]
+            for t in readers:
+                t.start()
+            try:
+                self.returncode = self._proc.wait(timeout=max(0, deadline - time.monotonic()) if deadline else None)
+            except subprocess.TimeoutExpired:
+                self._kill()
+                raise TranscodeTimeout(f'ffmpeg exceeded {self.timeout}s')
+            for t in readers:
+                t.join()
+        finally:
+            _slots.release()
+
+        if self._cancelled:
+            raise TranscodeCancelled('cancelled')
+        if self.returncode != 0:
+            raise TranscodeError(self.error())
+        self._set_progress(1.0)
+
+    def _kill(self):
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+
+    def cancel(self):
+        # ffmpeg exits cleanly on SIGTERM, run() notices and raises TranscodeCancelled
+        with self._lock:
+            self._cancelled = True
+            if self._proc is not None and self._proc.poll() is None:
+                self._proc.terminate()
+
+
+def run(args, duration=None, timeout=None, video=False, on_progress=None, key=None):
+    """
+    Run ffmpeg with args, raising TranscodeError on failure. With a key the run is
+    listed in `active` while it lasts so it can be polled and cancelled.
+    """
+    job = Transcode(args, duration=duration, timeout=timeout, video=video, on_progress=on_progress)
+    if key:
+        with _active_lock:
+            active[key] = job
+    try:
+        tool.offload(job.run)
+    finally:
+        if key:
+            with _active_lock:
+                active.pop(key, None)
+    return job
+
+
+def cancel(key):
+    with _active_lock:
+        job = active.get(key)
+    if job is None:
+        return False
+    job.cancel()
+    return True
+
+
+def encode(source, target, codec, bitrate=None, timeout=None):
+    """
+    Transcode an audio file to one of CODECS, writing through a temporary name so a
+    half written target is never served.
+    """
+    encoder, lossy = CODECS[codec]
+    args = ['-i', source, '-vn'] + encoder
+    if lossy:
+        args += ['-b:a', bitrate or DEFAULT_BITRATE]
+    # unique, so concurrent encodes of one target never write the same file
+    part = f'{target}.{uuid.uuid4().hex[:8]}.part'
+    args += ['-f', 'ipod' if codec == 'm4a' else codec, part]
+    try:
+        run(args, timeout=timeout)
+        os.replace(part, target)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+    return target
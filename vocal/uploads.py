@@ -0,0 +1,252 @@
+"""
+Resumable uploads: create a session, PUT the file in chunks at explicit offsets, then
+finalize it like a regular upload.
+
+Each chunk is copied from the request body to the end of `<id><ext>.part` in blocks
+as it arrives, and hashed on the way. Streamable formats also go straight into a
+decode.StreamDecoder, so the WAV is mostly decoded by the time the last chunk lands.
+A dropped connection keeps every byte that reached the disk; the client asks for the
+offset and continues from there. Sessions are described by `<id>.upload.json` next to
+the part file, so another process (or a restarted server) can pick one up; it then
+hashes what is already on disk and converts it through transcode once finalized. With several HTTP workers
+every session works that way, taking its offset from the file on every request.
+Sessions that receive no chunk for cfg.UPLOAD_TTL seconds are discarded, with their
+decoder, by UploadStore.expire(), which the janitor and every new session run. Until
+then the janitor leaves every `<id>.*` file of a session alone, see UploadStore.in_use();
+a session whose part file was deleted anyway is gone, it does not start over at 0.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+from vocal import cfg, decode
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 64 * 1024
+
+
+class UploadNotFound(KeyError):
+    pass
+
+
+class OffsetMismatch(Exception):
+    """A chunk started somewhere else than the end of what was received."""
+
+    def __init__(self, offset):
+        super().__init__(f'expected offset {offset}')
+        self.offset = offset
+
+
+class UploadBusy(Exception):
+    """Another chunk for the same upload is still being received."""
+
+
+class Upload:
+    def __init__(self, upload_id, filename, out_dir, size=None, stream_decode=True):
+        self.id = upload_id
+        self.filename = filename
+        self.ext = os.path.splitext(filename)[1].lower()
+        self.size = size
+        self.path = os.path.join(out_dir, f'{upload_id}{self.ext}.part')
+        self.meta = os.path.join(out_dir, f'{upload_id}.upload.json')
+        self.out_dir = out_dir
+        self.offset = 0
+        self.created = self.updated = time.time()
+        self.decoder = (decode.StreamDecoder(self.ext, out_dir, name=f'{upload_id}.decode')
+                        if stream_decode and self.ext in decode.STREAMABLE else None)
+        # None: the file may grow in another process, see refresh()
+        self._sha = hashlib.sha256() if stream_decode else None
+        self._busy = threading.Lock()
+
+    @classmethod
+    def restore(cls, meta, out_dir):
+        # a session started by another process: what's on disk, no decoder, hashed on finalize
+        upload = cls(meta['id'], meta['filename'], out_dir, meta.get('size'), stream_decode=False)
+        upload.created = meta.get('created', upload.created)
+        upload.refresh()
+        return upload
+
+    def refresh(self):
+        """Take the offset from the file on disk when other processes may append to it."""
+        if self._sha is None:
+            self.offset = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return self.offset
+
+    def _save(self):
+        with open(self.meta, 'w', encoding='utf-8') as f:
+            json.dump({'id': self.id, 'filename': self.filename, 'size': self.size, 'created': self.created}, f)
+
+    def write(self, offset, stream):
+        """
+        Append the chunk read from stream, which must start at offset. Returns the new
+        offset; when the stream breaks off, whatever arrived until then is kept.
+        """
+        if not self._busy.acquire(blocking=False):
+            raise UploadBusy(self.id)
+        try:
+            if not os.path.exists(self.path):
+                raise UploadNotFound(self.id)
+            if offset != self.refresh():
+                raise OffsetMismatch(self.offset)
+            with open(self.path, 'ab') as f:
+                try:
+                    while True:
+                        block = stream.read(BLOCK_SIZE)
+                        if not block:
+                            break
+                        if self.size is not None and self.offset + len(block) > self.size:
+                            raise ValueError(f'more than the announced {self.size} bytes')
+                        f.write(block)
+                        if self._sha is not None:
+                            self._sha.update(block)
+                        if self.decoder is not None:
+                            self.decoder.write(block)
+                        self.offset += len(block)
+                finally:
+                    self.updated = time.time()
+            return self.offset
+        finally:
+            self._busy.release()
+
+    @property
+    def complete(self):
+        return self.size is None or self.offset == self.size
+
+    def digest(self):
+        if self._sha is None:
+            sha = hashlib.sha256()
+            with open(self.path, 'rb') as f:
+                for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                    sha.update(block)
+            return sha.hexdigest()[:32]
+        return self._sha.hexdigest()[:32]
+
+    def decode(self):
+        """
+        Finish decoding to a WAV part file, returns (digest, wav_part) like
+        StreamDecoder.finish(), or None when the file on disk has to be converted (or,
+        a WAV, may be kept as it is), as for restored sessions, which have no decoder.
+        Blocking, run it through tool.offload().
+        """
+        decoder = self.decoder
+        if decoder is None:
+            return None
+        self.decoder = None
+        _, wav_part = decoder.finish()
+        return self.digest(), wav_part
+
+    def to_dict(self):
+        return {'upload_id': self.id, 'filename': self.filename, 'offset': self.offset, 'size': self.size,
+                'complete': self.complete}
+
+    def discard(self):
+        if self.decoder is not None:
+            self.decoder.abort()
+            self.decoder = None
+        for path in (self.path, self.meta):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class UploadStore:
+    """Upload sessions of this process, restored from their .upload.json when unknown."""
+
+    def __init__(self, out_dir, stream_decode=True, ttl=0):
+        self.out_dir = out_dir
+        self.stream_decode = stream_decode
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._uploads = {}
+
+    def create(self, filename, size=None):
+        self.expire()
+        upload = Upload(uuid.uuid4().hex, filename, self.out_dir, size, self.stream_decode)
+        open(upload.path, 'wb').close()
+        upload._save()
+        with self._lock:
+            self._uploads[upload.id] = upload
+        return upload
+
+    def get(self, upload_id):
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+            if upload is not None and os.path.exists(upload.path):
+                return upload
+        if upload is not None:
+            # its files were deleted under it, appending at the old offset would corrupt the upload
+            self.remove(upload_id)
+            raise UploadNotFound(upload_id)
+        with self._lock:
+            # ids are ours, never let one walk out of out_dir
+            if not re.fullmatch(r'[0-9a-f]{32}', upload_id):
+                raise UploadNotFound(upload_id)
+            meta = os.path.join(self.out_dir, f'{upload_id}.upload.json')
+            if not os.path.exists(meta):
+                raise UploadNotFound(upload_id)
+            with open(meta, encoding='utf-8') as f:
+                upload = Upload.restore(json.load(f), self.out_dir)
+            if not os.path.exists(upload.path):
+                raise UploadNotFound(upload_id)
+            self._uploads[upload_id] = upload
+            return upload
+
+    def remove(self, upload_id, discard=True):
+        with self._lock:
+            upload = self._uploads.pop(upload_id, None)
+        if upload is not None and discard:
+            upload.discard()
+        return upload
+
+    def in_use(self):
+        """
+        Paths of every file of the sessions in out_dir, of any process, that received a
+        chunk within ttl seconds or are receiving one here.
+        """
+        busy = {it.id for it in list(self._uploads.values()) if it._busy.locked()}
+        files = {}
+        for name in os.listdir(self.out_dir):
+            files.setdefault(name.split('.', 1)[0], []).append(os.path.join(self.out_dir, name))
+        paths = set()
+        cutoff = time.time() - self.ttl
+        for upload_id, session in files.items():
+            if os.path.join(self.out_dir, f'{upload_id}.upload.json') not in session:
+                continue
+            try:
+                updated = max(os.stat(path).st_mtime for path in session)
+            except OSError:
+                # a file went away meanwhile, keep the session for this sweep
+                updated = cutoff + 1
+            if upload_id in busy or self.ttl <= 0 or updated > cutoff:
+                paths.update(session)
+        return paths
+
+    def expire(self):
+        """Discard the sessions that received no chunk for ttl seconds, returns their ids."""
+        if self.ttl <= 0:
+            return []
+        cutoff = time.time() - self.ttl
+        idle = []
+        with self._lock:
+            for upload in list(self._uploads.values()):
+                # a chunk being received holds _busy, and keeps the session until it is done
+                if upload.updated < cutoff and upload._busy.acquire(blocking=False):
+                    del self._uploads[upload.id]
+                    idle.append(upload)
+        for upload in idle:
+            logger.info(f'{upload.id} received nothing for {self.ttl:g}s, discarded')
+            try:
+                upload.discard()
+            finally:
+                upload._busy.release()
+        return [it.id for it in idle]
+
+
+# Uploads of this process; with several HTTP workers or nodes a session's chunks may reach any of them
+store = UploadStore(cfg.TMP_DIR, stream_decode=cfg.HTTP_WORKERS <= 1 and cfg.JOB_BACKEND == 'local',
+                    ttl=cfg.UPLOAD_TTL)
@@ -0,0 +1,117 @@
+"""
+Waveforms in and out of memory: raw PCM and .npy bodies to float32 arrays, separated
+stems to a streamed zip of WAVs or a multipart/mixed body of raw PCM. Nothing here
+touches the disk.
+"""
+import io
+import wave
+import zipfile
+
+import numpy as np
+
+SAMPLE_RATE = 44100
+# raw PCM sample formats, named like ffmpeg's
+FORMATS = {'f32le': '<f4', 's16le': '<i2'}
+
+
+def from_pcm(data, fmt='f32le', channels=2):
+    """Interleaved PCM bytes to a float32 (samples, 2) array, mono is duplicated."""
+    if fmt not in FORMATS:
+        raise ValueError(f'unsupported PCM format {fmt}, use one of {", ".join(FORMATS)}')
+    if channels not in (1, 2):
+        raise ValueError('only mono and stereo PCM are supported')
+    dtype = np.dtype(FORMATS[fmt])
+    usable = len(data) - len(data) % (dtype.itemsize * channels)
+    samples = np.frombuffer(data[:usable], dtype=dtype).reshape(-1, channels)
+    return as_stereo(samples)
+
+
+class PcmDecoder:
+    """from_pcm() for a stream cut at arbitrary byte offsets, partial frames wait for the next data."""
+
+    def __init__(self, fmt='f32le', channels=2):
+        from_pcm(b'', fmt, channels)
+        self.fmt = fmt
+        self.channels = channels
+        self.frame = np.dtype(FORMATS[fmt]).itemsize * channels
+        self.pending = b''
+
+    def feed(self, data):
+        data = self.pending + data
+        usable = len(data) - len(data) % self.frame
+        self.pending = data[usable:]
+        return from_pcm(data[:usable], self.fmt, self.channels)
+
+
+def from_npy(data):
+    return as_stereo(np.load(io.BytesIO(data), allow_pickle=False))
+
+
+def as_stereo(samples):
+    """float32 (samples, 2) from float or int16 arrays of shape (n,), (n, 1) or (n, 2)."""
+    samples = np.asarray(samples)
+    if samples.ndim == 1:
+        samples = samples[:, None]
+    if samples.ndim != 2 or samples.shape[1] not in (1, 2):
+        raise ValueError(f'expected (samples, channels) with 1 or 2 channels, got {samples.shape}')
+    if samples.dtype == np.int16:
+        samples = samples.astype(np.float32) / 32768
+    samples = samples.astype(np.float32, copy=False)
+    if samples.shape[1] == 1:
+        samples = np.repeat(samples, 2, axis=1)
+    return samples
+
+
+def to_pcm(samples, fmt='f32le'):
+    if fmt == 's16le':
+        return (np.clip(samples, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+    return np.asarray(samples, dtype='<f4').tobytes()
+
+
+def wav_bytes(samples, sample_rate=SAMPLE_RATE):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(samples.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(to_pcm(samples, 's16le'))
+    return buffer.getvalue()
+
+
+class _Chunks:
+    # write-only, unseekable file zipfile streams into; drained after every member
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data, self.parts = b''.join(self.parts), []
+        return data
+
+
+def stream_zip(stems, sample_rate=SAMPLE_RATE):
+    """Yield a zip with one <instrument>.wav per stem, one member at a time."""
+    sink = _Chunks()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+        for instrument, samples in stems.items():
+            archive.writestr(f'{instrument}.wav', wav_bytes(samples, sample_rate))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def stream_multipart(stems, boundary, fmt='f32le', sample_rate=SAMPLE_RATE):
+    """Yield a multipart/mixed body with one raw interleaved stereo PCM part per stem."""
+    for instrument, samples in stems.items():
+        yield (f'--{boundary}\r\n'
+               f'Content-Type: application/octet-stream\r\n'
+               f'Content-Disposition: attachment; name="{instrument}"; filename="{instrument}.pcm"\r\n'
+               f'X-Audio-Format: {fmt}; rate={sample_rate}; channels=2\r\n\r\n').encode('ascii')
+        yield to_pcm(samples, fmt)
+        yield b'\r\n'
+    yield f'--{boundary}--\r\n'.encode('ascii')